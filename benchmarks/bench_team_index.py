@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of the team DEF/OFF index: the previous row-by-row implementation vs the vectorized one.
+Both must select the same teams.
+
+Usage: python -m benchmarks.bench_team_index
+"""
+import timeit
+
+import pandas as pd
+
+from data_processing.actual.process_actual_data import (ActualDataProcessor, FUTURE_GW_LIMIT, TEAMS_LIMIT,
+                                                        get_matchups, get_team_off_def_idx)
+from data_processing.constants import DEF, OFF
+from .synthetic import make_payloads
+
+SCENARIOS = [
+    # teams, gameweeks
+    (20, 38),
+    (100, 38),
+]
+REPEATS = 5
+
+
+def legacy_team_off_def_idx(teams_df: pd.DataFrame, matchups_df: pd.DataFrame):
+    teams_idx = dict()
+    for i in range(len(teams_df)):
+        team_id = teams_df.iloc[i, teams_df.columns.get_loc("id")]
+        teams_idx[team_id] = dict()
+        teams_idx[team_id]["name"] = teams_df.iloc[i, teams_df.columns.get_loc("name")]
+
+        team_matchups_df = matchups_df[(matchups_df['team_a'] == team_id) | (matchups_df['team_h'] == team_id)]
+        teams_idx[team_id]["DEF_IDX"] = 0
+        teams_idx[team_id]["OFF_IDX"] = 0
+        for _, row in team_matchups_df.head(FUTURE_GW_LIMIT).iterrows():
+            if team_id == row["team_h"]:
+                teams_idx[team_id]["DEF_IDX"] += row['team_h_str_def_diff']
+                teams_idx[team_id]["OFF_IDX"] += row['team_h_str_att_diff']
+            else:
+                teams_idx[team_id]["DEF_IDX"] -= row['team_h_str_att_diff']
+                teams_idx[team_id]["OFF_IDX"] -= row['team_h_str_def_diff']
+    return teams_idx
+
+
+def legacy_best_teams(teams_idx, profile: str):
+    key = 'DEF_IDX' if profile == DEF else 'OFF_IDX'
+    best = sorted(teams_idx.keys(), key=lambda x: teams_idx[x][key], reverse=True)[:TEAMS_LIMIT]
+    return [teams_idx[x]['name'] for x in best]
+
+
+def build_matchups(n_teams: int, n_gws: int, seed: int = 0):
+    """Teams and their matchups collected from synthetic data, without touching the API"""
+    bootstrap, fixtures = make_payloads(n_teams=n_teams, n_players=0, n_gws=n_gws, finished_gws=0, seed=seed)
+    teams_df = pd.DataFrame(bootstrap["teams"])
+    return teams_df, get_matchups(pd.DataFrame(fixtures), teams_df)
+
+
+def check_same_output(teams_df: pd.DataFrame, matchups_df: pd.DataFrame) -> None:
+    legacy_idx = legacy_team_off_def_idx(teams_df, matchups_df)
+    teams_idx = get_team_off_def_idx(teams_df, matchups_df)
+    for team_id, legacy in legacy_idx.items():
+        assert teams_idx.loc[team_id, 'DEF_IDX'] == legacy['DEF_IDX'], team_id
+        assert teams_idx.loc[team_id, 'OFF_IDX'] == legacy['OFF_IDX'], team_id
+    for profile in (DEF, OFF):
+        assert ActualDataProcessor.get_best_teams(teams_idx, profile) == legacy_best_teams(legacy_idx, profile)
+
+
+def main():
+    print(f"{'teams':>6} {'GWs':>4} {'legacy [ms]':>12} {'vectorized [ms]':>16} {'speedup':>8}")
+    for n_teams, n_gws in SCENARIOS:
+        for seed in range(3):
+            check_same_output(*build_matchups(n_teams, n_gws, seed))
+        teams_df, matchups_df = build_matchups(n_teams, n_gws)
+
+        legacy_time = min(timeit.repeat(
+            lambda: legacy_team_off_def_idx(teams_df, matchups_df), number=1, repeat=REPEATS))
+        vectorized_time = min(timeit.repeat(
+            lambda: get_team_off_def_idx(teams_df, matchups_df), number=1, repeat=REPEATS))
+        print(f"{n_teams:>6} {n_gws:>4} {legacy_time * 1000:>12.2f} {vectorized_time * 1000:>16.2f} "
+              f"{legacy_time / vectorized_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
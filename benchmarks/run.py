@@ -0,0 +1,424 @@
+"""
+Benchmarks of the hot paths of the pipeline, on deterministic synthetic data - the network is never used.
+Everything runs in a temporary directory holding the API snapshots and the historical season folders.
+The results are saved as JSON, so runs of different commits can be compared.
+
+Usage: python -m benchmarks.run [--teams 20] [--players 700] [--gws 38] [--seasons 3] [--only NAME ...]
+                                [--output FILE] [--compare OLD_FILE]
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from data_processing.actual import act_team_selection
+from data_processing.actual.expected_points import add_expected_points, get_expected_points_matrix
+from data_processing.actual.process_actual_data import (TEAMS_LIMIT, ActualDataProcessor, augment_elements_df,
+                                                        get_best_teams_by_profile, get_matchups, get_team_off_def_idx)
+from data_processing.actual.simulation import simulate_squads
+from data_processing.actual.mini_league import Manager, plan_league
+from data_processing.actual.transfer_planner import BEAM_WIDTH, plan_transfers
+from data_processing.constants import LIMITS
+from data_processing.historical import hist_team_selection
+from data_processing.historical.feature_store import GWS_COLS, compute_features, get_gw_steps
+from data_processing.historical.process_historical_data import HistoricalDataProcessor
+from data_processing.historical.season_store import read_table
+from data_processing.tools.fixtures import get_future_difficulty_matrix, get_players_difficulty
+from data_processing.tools.fpl_api import FplApiClient, get_base_api_data, set_client
+from data_processing.tools.report import save_report, to_long
+from data_processing.tools.snapshot_history import SnapshotHistory
+from .synthetic import write_historical_season, write_snapshot
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+# Trials of the hyperparameter search in the `train_model` benchmark (100 in a real run)
+BENCH_TRIALS = 5
+FIRST_SEASON = 2019
+# Hourly polls of bootstrap-static in the benchmarked snapshot history, and how many players change in each of them
+HISTORY_SNAPSHOTS = 200
+HISTORY_CHANGED_PLAYERS = 40
+
+# name -> function(context) returning (setup, func); setup() builds the arguments of a timed func(*args) call
+BENCHMARKS: Dict[str, Callable[["Context"], Tuple[Callable[[], tuple], Callable]]] = dict()
+
+
+def benchmark(name: str) -> Callable:
+    def decorator(build: Callable) -> Callable:
+        BENCHMARKS[name] = build
+        return build
+    return decorator
+
+
+class Context:
+    """Synthetic data shared by the benchmarks, built once per run"""
+
+    def __init__(self, root_dir: str, n_teams: int, n_players: int, n_gws: int, n_seasons: int,
+                 n_trials: int, seed: int = 0):
+        self.root_dir = root_dir
+        self.n_gws = n_gws
+        self.n_trials = n_trials
+        self.cache_dir = os.path.join(root_dir, "data", "cache")
+        write_snapshot(self.cache_dir, n_teams=n_teams, n_players=n_players, n_gws=n_gws,
+                       finished_gws=n_gws // 3, seed=seed)
+        self.client = FplApiClient(cache_dir=self.cache_dir, offline=True)
+        set_client(self.client)
+
+        historical_dir = os.path.join(root_dir, "data", "historical")
+        self.season_dirs = [
+            write_historical_season(historical_dir, f"{year}-{(year + 1) % 100:02d}", n_teams=n_teams,
+                                    n_players=n_players, n_gws=n_gws, seed=seed + year)
+            for year in range(FIRST_SEASON, FIRST_SEASON + n_seasons)
+        ]
+
+        self.elements_df = self.client.get_table("elements")
+        self.element_types_df = self.client.get_table("element_types")
+        self.teams_df = self.client.get_table("teams")
+        self.fixtures_df = self.client.fixtures()
+
+    @property
+    def augmented_df(self) -> pd.DataFrame:
+        return augment_elements_df(self.elements_df, self.element_types_df, self.teams_df)
+
+    @property
+    def matchups_df(self) -> pd.DataFrame:
+        return get_matchups(self.fixtures_df, self.teams_df)
+
+    def candidates_df(self) -> pd.DataFrame:
+        """Preseason candidates, with deterministic 'predictions' in place of the model"""
+        actual_set = HistoricalDataProcessor.prepare_dataset_from_api(self.elements_df, self.teams_df)
+        candidates_df = actual_set.drop('points_per_game', axis=1)
+        noise = np.random.default_rng(0).normal(0, 0.5, len(candidates_df))
+        candidates_df["predicted_ppg"] = (actual_set['points_per_game'] + noise).clip(lower=0).round(2)
+        candidates_df["predicted_value"] = candidates_df["predicted_ppg"] / candidates_df["now_cost"] * 10
+        return HistoricalDataProcessor.clean_candidates_dataset(candidates_df, self.elements_df,
+                                                                self.element_types_df, self.teams_df)
+
+    def snapshot_history(self) -> Tuple[SnapshotHistory, Dict[str, Any], float]:
+        """(history, last payload, time of the last snapshot) of hourly polls changing the ownership and prices"""
+        if not hasattr(self, "_snapshot_history"):
+            history = SnapshotHistory(os.path.join(self.root_dir, "history.db"))
+            # a copy of the snapshot, changed in place
+            payload, _ = self.client.load_snapshot("bootstrap-static")
+            rng = np.random.default_rng(0)
+            taken_at = time.time() - HISTORY_SNAPSHOTS * 3600
+            for _ in range(HISTORY_SNAPSHOTS):
+                elements = payload["elements"]
+                for i in rng.choice(len(elements), HISTORY_CHANGED_PLAYERS, replace=False):
+                    elements[i]["selected_by_percent"] = f"{rng.uniform(0, 60):.1f}"
+                    elements[i]["transfers_in"] = elements[i].get("transfers_in", 0) + int(rng.integers(1000))
+                elements[int(rng.integers(len(elements)))]["now_cost"] += int(rng.choice([-1, 1]))
+                taken_at += 3600
+                history.record("bootstrap-static", payload, taken_at)
+            self._snapshot_history = history, payload, taken_at
+        return self._snapshot_history
+
+
+@benchmark("api_parsing")
+def bench_api_parsing(ctx: Context):
+    def setup():
+        # the timed call reads the snapshot, decodes the JSON and builds the DataFrame
+        ctx.client.refresh()
+        return "elements",
+    return setup, get_base_api_data
+
+
+@benchmark("augment_elements_df")
+def bench_augment_elements_df(ctx: Context):
+    return lambda: (ctx.elements_df, ctx.element_types_df, ctx.teams_df), augment_elements_df
+
+
+@benchmark("get_matchups")
+def bench_get_matchups(ctx: Context):
+    return lambda: (ctx.fixtures_df, ctx.teams_df), get_matchups
+
+
+@benchmark("get_team_off_def_idx")
+def bench_get_team_off_def_idx(ctx: Context):
+    matchups_df = ctx.matchups_df
+    return lambda: (ctx.teams_df, matchups_df), get_team_off_def_idx
+
+
+@benchmark("fixtures_difficulty")
+def bench_fixtures_difficulty(ctx: Context):
+    def find_matchups(fixtures_df: pd.DataFrame, players_df: pd.DataFrame) -> pd.Series:
+        return get_players_difficulty(players_df, get_future_difficulty_matrix(fixtures_df))
+    return lambda: (ctx.fixtures_df, ctx.elements_df), find_matchups
+
+
+@benchmark("expected_points_matrix")
+def bench_expected_points_matrix(ctx: Context):
+    augmented_df, matchups_df = ctx.augmented_df, ctx.matchups_df
+    # every remaining GW of the season
+    return lambda: (augmented_df, matchups_df, ctx.n_gws), get_expected_points_matrix
+
+
+def first_valid_squad(players_df: pd.DataFrame) -> List[int]:
+    """The first players of every position (in the frame's order) within the club limit"""
+    squad, clubs = list(), dict()
+    for position, count in LIMITS['position'].items():
+        picked = 0
+        for player in players_df[players_df['position'] == position].itertuples():
+            if picked == count:
+                break
+            if clubs.get(player.team, 0) < LIMITS['one_team']:
+                squad.append(player.id)
+                clubs[player.team] = clubs.get(player.team, 0) + 1
+                picked += 1
+    return squad
+
+
+@benchmark("transfer_plan")
+def bench_transfer_plan(ctx: Context):
+    processor = ActualDataProcessor()
+    # the cheapest valid squad - the most room for improvement
+    squad = first_valid_squad(processor.elements_df.sort_values(['now_cost', 'id']))
+    # a 5 GW horizon with money to spend and 2 free transfers
+    return lambda: (processor, squad, 100, 2, 5), plan_transfers
+
+
+@benchmark("mini_league_plans")
+def bench_mini_league_plans(ctx: Context):
+    processor = ActualDataProcessor()
+    # squads of players in random orders
+    managers = [Manager(str(seed), tuple(first_valid_squad(processor.elements_df.sample(frac=1, random_state=seed))),
+                        bank=20) for seed in range(4)]
+    # a 3 GW horizon, in 2 processes mapping the shared arrays
+    return lambda: (processor, managers, 3, BEAM_WIDTH, 2), plan_league
+
+
+@benchmark("simulate_squad")
+def bench_simulate_squad(ctx: Context):
+    processor = ActualDataProcessor()
+    squads = {"selected": processor.launch_pipeline()}
+    # one chunk in the main process: the cost of the draws, not of starting a pool
+    return lambda: (processor, squads, 10_000, 0, 1), simulate_squads
+
+
+@benchmark("save_report")
+def bench_save_report(ctx: Context):
+    processor = ActualDataProcessor()
+    stages = {
+        "my_team": processor.launch_pipeline(),
+        "candidates": add_expected_points(processor.elements_df, processor.expected_points_df),
+        "teams_idx": processor.get_team_off_def_idx().reset_index(),
+        "fixture_difficulty": to_long(processor.difficulty_matrix_df, "difficulty"),
+        "expected_points": to_long(processor.expected_points_df, "expected_points"),
+    }
+    report_dir = os.path.join(ctx.root_dir, "report")
+    # the workbook with every player and the sidecars in all the formats
+    return lambda: (stages, os.path.join(ctx.root_dir, "report.xlsx"), report_dir), save_report
+
+
+def in_season_selection(ctx: Context, exact: bool):
+    augmented_df = ctx.augmented_df
+    def_teams, off_teams = get_best_teams_by_profile(get_team_off_def_idx(ctx.teams_df, ctx.matchups_df),
+                                                     TEAMS_LIMIT)
+    return (lambda: (augmented_df, def_teams, off_teams, exact)), act_team_selection.select_my_team
+
+
+@benchmark("in_season_select_my_team")
+def bench_in_season_select(ctx: Context):
+    return in_season_selection(ctx, exact=False)
+
+
+@benchmark("in_season_select_my_team_exact")
+def bench_in_season_select_exact(ctx: Context):
+    return in_season_selection(ctx, exact=True)
+
+
+def preseason_selection(ctx: Context, exact: bool):
+    candidates_df = ctx.candidates_df()
+    return (lambda: (candidates_df, exact)), hist_team_selection.select_my_team
+
+
+@benchmark("preseason_select_my_team")
+def bench_preseason_select(ctx: Context):
+    return preseason_selection(ctx, exact=False)
+
+
+@benchmark("preseason_select_my_team_exact")
+def bench_preseason_select_exact(ctx: Context):
+    return preseason_selection(ctx, exact=True)
+
+
+@benchmark("prepare_dataset")
+def bench_prepare_dataset(ctx: Context):
+    processor = HistoricalDataProcessor()
+    # the first call converts the season into the columnar store, the timed ones read it
+    processor.prepare_dataset(ctx.season_dirs[0])
+    return lambda: (ctx.season_dirs[0],), processor.prepare_dataset
+
+
+@benchmark("prepare_gw_dataset")
+def bench_prepare_gw_dataset(ctx: Context):
+    processor = HistoricalDataProcessor()
+    processor.prepare_gw_dataset(ctx.season_dirs[0])
+    return lambda: (ctx.season_dirs[0],), processor.prepare_gw_dataset
+
+
+def rolling_steps(ctx: Context) -> pd.DataFrame:
+    season, historical_dir = os.path.basename(ctx.season_dirs[0]), os.path.dirname(ctx.season_dirs[0])
+    gws_df = read_table(season, "gws", columns=GWS_COLS, historical_dir=historical_dir)
+    return get_gw_steps(gws_df, read_table(season, "teams", historical_dir=historical_dir))
+
+
+@benchmark("rolling_features_season")
+def bench_rolling_features_season(ctx: Context):
+    steps_df = rolling_steps(ctx)
+    return lambda: (steps_df,), compute_features
+
+
+@benchmark("rolling_features_gw_step")
+def bench_rolling_features_gw_step(ctx: Context):
+    # the last GW added to the stored ones
+    steps_df = rolling_steps(ctx)
+    last_gw = steps_df['GW'] == steps_df['GW'].max()
+    history_df = compute_features(steps_df[~last_gw])
+    return lambda: (steps_df[last_gw], history_df), compute_features
+
+
+@benchmark("snapshot_history_record")
+def bench_snapshot_history_record(ctx: Context):
+    history, payload, taken_at = ctx.snapshot_history()
+    return lambda: ("bootstrap-static", payload, taken_at), history.record
+
+
+@benchmark("snapshot_history_league_state")
+def bench_snapshot_history_league_state(ctx: Context):
+    # a past state, rebuilt from a keyframe and a few dozen snapshots after it
+    history, _, taken_at = ctx.snapshot_history()
+    return lambda: (taken_at - (HISTORY_SNAPSHOTS // 3) * 3600,), history.league_state
+
+
+@benchmark("snapshot_history_player_series")
+def bench_snapshot_history_player_series(ctx: Context):
+    history, payload, _ = ctx.snapshot_history()
+    element_id = payload["elements"][0]["id"]
+    return lambda: (element_id, ["now_cost", "selected_by_percent", "chance_of_playing_next_round"]), \
+        history.player_series
+
+
+@benchmark("train_model")
+def bench_train_model(ctx: Context):
+    processor = HistoricalDataProcessor()
+    train_loaders = [lambda season_dir=season_dir: processor.prepare_dataset(season_dir)
+                     for season_dir in ctx.season_dirs[:-1]]
+    last_season_df = processor.prepare_dataset(ctx.season_dirs[-1])
+    runs = itertools.count()
+
+    def setup():
+        # a new study every time - a finished one would just be reused
+        return train_loaders, last_season_df, "points_per_game", f"bench-{next(runs)}", ctx.n_trials
+    return setup, processor.train_model
+
+
+def measure(setup: Callable[[], tuple], func: Callable, repeat: int) -> Dict[str, Any]:
+    times = []
+    result = None
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    rows = len(result) if isinstance(result, (pd.DataFrame, pd.Series, list, dict)) else None
+    return {
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.fmean(times),
+        "repeat": repeat,
+        "rows": rows,
+    }
+
+
+@contextmanager
+def working_dir(path: str) -> Iterator[None]:
+    """The data directories are relative to the working directory - keep them in the temporary one"""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names: List[str], repeat: int, **scale) -> Dict[str, Any]:
+    results = dict()
+    with tempfile.TemporaryDirectory(prefix="fpl-bench-") as root_dir, working_dir(root_dir):
+        ctx = Context(root_dir, **scale)
+        for name in names:
+            setup, func = BENCHMARKS[name](ctx)
+            # train_model is by far the slowest one, a single run is enough
+            results[name] = measure(setup, func, 1 if name == "train_model" else repeat)
+            print(f"{name:<32} {results[name]['min_s'] * 1000:>12.2f} ms")
+    return {
+        "meta": {
+            "commit": get_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "scale": scale,
+        },
+        "results": results,
+    }
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    print(f"\n{'benchmark':<32} {'old [ms]':>12} {'new [ms]':>12} {'ratio':>8}  "
+          f"({old['meta'].get('commit')} -> {new['meta'].get('commit')})")
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        old_time, new_time = old["results"][name]["min_s"], result["min_s"]
+        print(f"{name:<32} {old_time * 1000:>12.2f} {new_time * 1000:>12.2f} {new_time / old_time:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data")
+    parser.add_argument("--teams", type=int, default=20)
+    parser.add_argument("--players", type=int, default=700)
+    parser.add_argument("--gws", type=int, default=38)
+    parser.add_argument("--seasons", type=int, default=3, help="historical seasons (at least 2)")
+    parser.add_argument("--trials", type=int, default=BENCH_TRIALS, help="Optuna trials in train_model")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument("--output", help=f"results file (default: {RESULTS_DIR}/<commit>.json)")
+    parser.add_argument("--compare", help="results file of another run to compare with")
+    args = parser.parse_args()
+
+    report = run(args.only or list(BENCHMARKS), args.repeat, n_teams=args.teams, n_players=args.players,
+                 n_gws=args.gws, n_seasons=args.seasons, n_trials=args.trials)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['meta']['commit'] or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
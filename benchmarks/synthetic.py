@@ -0,0 +1,308 @@
+"""Deterministic synthetic FPL payloads and historical season folders"""
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+POSITIONS = [
+    # id, singular_name, short, squad_select, share of the player pool
+    (1, "Goalkeeper", "GKP", 2, 0.10),
+    (2, "Defender", "DEF", 5, 0.33),
+    (3, "Midfielder", "MID", 5, 0.40),
+    (4, "Forward", "FWD", 3, 0.17),
+]
+GW_POSITIONS = {1: "GK", 2: "DEF", 3: "MID", 4: "FWD"}
+SEASON_START = datetime(2024, 8, 16, 19, 0)
+
+
+def make_teams(n_teams: int, rng: np.random.Generator) -> List[Dict[str, Any]]:
+    teams = []
+    for team_id in range(1, n_teams + 1):
+        strength = int(rng.integers(2, 6))
+        base = 1000 + 50 * strength
+        teams.append({
+            "id": team_id,
+            "code": 100 + team_id,
+            "name": f"Team {team_id:03d}",
+            "short_name": f"T{team_id:02d}"[:3],
+            "strength": strength,
+            "strength_overall_home": int(base + rng.integers(0, 120)),
+            "strength_overall_away": int(base + rng.integers(0, 120)),
+            "strength_attack_home": int(base + rng.integers(0, 120)),
+            "strength_attack_away": int(base + rng.integers(0, 120)),
+            "strength_defence_home": int(base + rng.integers(0, 120)),
+            "strength_defence_away": int(base + rng.integers(0, 120)),
+        })
+    return teams
+
+
+def make_fixtures(teams: List[Dict[str, Any]], n_gws: int, finished_gws: int,
+                  rng: np.random.Generator) -> List[Dict[str, Any]]:
+    """Round-robin schedule, with one blank and one double gameweek when the season is long enough"""
+    team_ids = [team["id"] for team in teams]
+    strength = {team["id"]: team["strength"] for team in teams}
+    if len(team_ids) % 2:
+        team_ids.append(None)
+    n = len(team_ids)
+    rounds = []
+    rotation = team_ids[:]
+    for gw in range(n_gws):
+        pairs = []
+        for i in range(n // 2):
+            home, away = rotation[i], rotation[n - 1 - i]
+            if home is None or away is None:
+                continue
+            if gw % 2:
+                home, away = away, home
+            pairs.append((home, away))
+        rounds.append(pairs)
+        rotation = [rotation[0]] + [rotation[-1]] + rotation[1:-1]
+
+    blank_gw = 3 * n_gws // 4 if n_gws >= 8 else None
+    fixtures = []
+    fixture_id = 1
+    for gw, pairs in enumerate(rounds, start=1):
+        for pair_no, (home, away) in enumerate(pairs):
+            event = gw
+            if blank_gw and gw == blank_gw and pair_no == 0:
+                # postponed into the next gameweek -> blank now, double later
+                event = gw + 1
+            kickoff = SEASON_START + timedelta(days=7 * (event - 1), hours=2 * pair_no)
+            finished = event <= finished_gws
+            fixtures.append({
+                "id": fixture_id,
+                "code": 10000 + fixture_id,
+                "event": event,
+                "finished": finished,
+                "finished_provisional": finished,
+                "kickoff_time": kickoff.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "minutes": 90 if finished else 0,
+                "started": finished,
+                "team_h": home,
+                "team_a": away,
+                "team_h_score": int(rng.integers(0, 4)) if finished else None,
+                "team_a_score": int(rng.integers(0, 3)) if finished else None,
+                "team_h_difficulty": int(min(5, max(2, strength[away]))),
+                "team_a_difficulty": int(min(5, max(2, strength[home] + 1))),
+            })
+            fixture_id += 1
+    fixtures.sort(key=lambda fixture: (fixture["event"], fixture["kickoff_time"], fixture["id"]))
+    return fixtures
+
+
+def make_players(teams: List[Dict[str, Any]], n_players: int, played_gws: int,
+                 rng: np.random.Generator) -> List[Dict[str, Any]]:
+    players = []
+    shares = np.array([share for *_, share in POSITIONS])
+    element_types = rng.choice([pos[0] for pos in POSITIONS], size=n_players, p=shares / shares.sum())
+    team_ids = [team["id"] for team in teams]
+    strength = {team["id"]: team["strength"] for team in teams}
+    for player_id in range(1, n_players + 1):
+        element_type = int(element_types[player_id - 1])
+        team_id = team_ids[(player_id - 1) % len(team_ids)]
+        quality = rng.gamma(2.0, 1.0) * (0.6 + 0.2 * strength[team_id])
+        starts = int(rng.integers(0, played_gws + 1))
+        minutes = int(starts * rng.integers(60, 91))
+        ppg = round(float(min(12.0, quality * (0.5 + element_type / 4))), 1) if starts else 0.0
+        total_points = int(round(ppg * starts))
+        now_cost = int(40 + 5 * round((0.4 if element_type == 1 else 0.8) * quality + rng.integers(0, 2)))
+        now_cost = min(now_cost, 150)
+        form = round(float(max(0.0, ppg + rng.normal(0, 1.5))), 1)
+        xgi = round(float(quality * starts * (0.05 + 0.1 * (element_type - 1))), 2)
+        xgc = round(float(starts * (1.6 - 0.2 * strength[team_id])), 2)
+        chance = rng.choice([None, None, None, None, 0, 25, 50, 75, 100])
+        players.append({
+            "id": player_id,
+            "code": 500000 + player_id,
+            "first_name": f"First{player_id}",
+            "second_name": f"Second{player_id}",
+            "web_name": f"Player{player_id}",
+            "element_type": element_type,
+            "team": team_id,
+            "team_code": 100 + team_id,
+            "status": "a" if chance is None else "d",
+            "now_cost": now_cost,
+            "cost_change_start": 0,
+            "total_points": total_points,
+            "event_points": int(rng.integers(0, 10)),
+            "points_per_game": f"{ppg:.1f}",
+            "form": f"{form:.1f}",
+            "value_form": f"{form / now_cost * 10:.1f}",
+            "value_season": f"{total_points / now_cost * 10:.1f}",
+            "selected_by_percent": f"{rng.uniform(0, 50):.1f}",
+            "ict_index": f"{quality * starts * 3:.1f}",
+            "ict_index_rank": player_id,
+            "influence": f"{quality * starts * 10:.1f}",
+            "creativity": f"{quality * starts * 8:.1f}",
+            "threat": f"{quality * starts * 9:.1f}",
+            "expected_goals": f"{xgi * 0.6:.2f}",
+            "expected_assists": f"{xgi * 0.4:.2f}",
+            "expected_goal_involvements": f"{xgi:.2f}",
+            "expected_goals_conceded": f"{xgc:.2f}",
+            "goals_scored": int(xgi * 0.6),
+            "assists": int(xgi * 0.4),
+            "clean_sheets": int(starts * 0.3),
+            "goals_conceded": int(xgc),
+            "bps": int(total_points * 3),
+            "bonus": int(total_points * 0.1),
+            "starts": starts,
+            "minutes": minutes,
+            "chance_of_playing_next_round": chance,
+            "chance_of_playing_this_round": chance,
+            "penalties_order": None,
+            "transfers_in": int(rng.integers(0, 100000)),
+            "transfers_out": int(rng.integers(0, 100000)),
+        })
+    return players
+
+
+def make_events(n_gws: int, finished_gws: int) -> List[Dict[str, Any]]:
+    return [{
+        "id": gw,
+        "name": f"Gameweek {gw}",
+        "deadline_time": (SEASON_START + timedelta(days=7 * (gw - 1))).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "finished": gw <= finished_gws,
+        "is_current": gw == finished_gws,
+        "is_next": gw == finished_gws + 1,
+    } for gw in range(1, n_gws + 1)]
+
+
+def make_payloads(n_teams: int = 20, n_players: int = 700, n_gws: int = 38, finished_gws: int = 10,
+                  seed: int = 0) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Return a (bootstrap-static, fixtures) pair shaped like the FPL API responses"""
+    rng = np.random.default_rng(seed)
+    teams = make_teams(n_teams, rng)
+    fixtures = make_fixtures(teams, n_gws, finished_gws, rng)
+    bootstrap = {
+        "events": make_events(n_gws, finished_gws),
+        "teams": teams,
+        "elements": make_players(teams, n_players, finished_gws, rng),
+        "element_types": [{
+            "id": pos_id, "singular_name": name, "singular_name_short": short,
+            "plural_name": f"{name}s", "squad_select": select,
+        } for pos_id, name, short, select, _ in POSITIONS],
+    }
+    return bootstrap, fixtures
+
+
+def write_snapshot(snapshot_dir: str, **kwargs) -> str:
+    """Write payloads in the on-disk snapshot layout the API client replays in offline mode"""
+    from data_processing.tools.fpl_api import FplApiClient
+
+    bootstrap, fixtures = make_payloads(**kwargs)
+    client = FplApiClient(cache_dir=snapshot_dir, offline=True)
+    client.save_snapshot("bootstrap-static", bootstrap)
+    client.save_snapshot("fixtures", fixtures)
+    return snapshot_dir
+
+
+def write_recorded_api(record_dir: str, n_teams: int = 20, n_players: int = 700, n_gws: int = 38,
+                       finished_gws: int = 10, seed: int = 0) -> str:
+    """
+    Write everything the stand-in server replays: bootstrap-static, fixtures, element-summary/<id>
+    and event/<gw>/live of the finished gameweeks
+    """
+    bootstrap, fixtures = make_payloads(n_teams, n_players, n_gws, finished_gws, seed)
+    history_df = make_gw_history(bootstrap["elements"], bootstrap["teams"],
+                                 [fixture for fixture in fixtures if fixture["finished"]],
+                                 np.random.default_rng(seed))
+    history_df = history_df.drop(columns=["name", "position", "team", "GW"]).assign(
+        bonus=0, bps=history_df["total_points"] * 3,
+        ict_index=history_df["ict_index"].map("{:.1f}".format),
+        expected_goal_involvements=history_df["expected_goal_involvements"].map("{:.2f}".format),
+        expected_goals_conceded=history_df["expected_goals_conceded"].map("{:.2f}".format))
+
+    def write(path: str, payload: Any) -> None:
+        path = os.path.join(record_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(payload, file)
+
+    write("bootstrap-static.json", bootstrap)
+    write("fixtures.json", fixtures)
+    histories = {player_id: rows.to_dict("records") for player_id, rows in history_df.groupby("element")}
+    for player in bootstrap["elements"]:
+        write(os.path.join("element-summary", f"{player['id']}.json"), {
+            "fixtures": [fixture for fixture in fixtures if not fixture["finished"]
+                         and player["team"] in (fixture["team_h"], fixture["team_a"])],
+            "history": histories.get(player["id"], []),
+            "history_past": [],
+        })
+    stat_cols = ["minutes", "starts", "total_points", "bonus", "bps", "ict_index",
+                 "expected_goal_involvements", "expected_goals_conceded"]
+    for event, rows in history_df.groupby("round"):
+        # the stats of a double gameweek are summed, like in the API
+        stats_df = rows.astype({col: float for col in stat_cols[5:]}).groupby("element")[stat_cols].sum()
+        write(os.path.join("event", str(event), "live.json"), {"elements": [{
+            "id": int(player_id),
+            "stats": {**{col: int(stats[col]) for col in stat_cols[:5]},
+                      **{col: f"{stats[col]:.2f}" for col in stat_cols[5:]}, "in_dreamteam": False},
+            "explain": [],
+        } for player_id, stats in stats_df.iterrows()]})
+    return record_dir
+
+
+def make_gw_history(players: List[Dict[str, Any]], teams: List[Dict[str, Any]],
+                    fixtures: List[Dict[str, Any]], rng: np.random.Generator) -> pd.DataFrame:
+    """Gameweek-level rows in the layout of vaastav's gws/merged_gw.csv"""
+    team_names = {team["id"]: team["name"] for team in teams}
+    players_df = pd.DataFrame(players)
+    fixtures_df = pd.DataFrame(fixtures)
+    home = fixtures_df.rename(columns={"team_h": "team", "team_a": "opponent_team"}).assign(was_home=True)
+    away = fixtures_df.rename(columns={"team_a": "team", "team_h": "opponent_team"}).assign(was_home=False)
+    team_fixtures = pd.concat([home, away]).rename(columns={"id": "fixture"})[
+        ["fixture", "event", "kickoff_time", "team", "opponent_team", "was_home"]]
+    rows = players_df[["id", "team", "element_type", "now_cost", "points_per_game"]].merge(team_fixtures, on="team")
+    n = len(rows)
+    ppg = rows["points_per_game"].astype(float).to_numpy()
+    plays = rng.random(n) < 0.8
+    minutes = np.where(plays, rng.integers(20, 91, n), 0)
+    total_points = np.where(plays, np.maximum(0, rng.poisson(np.maximum(ppg, 0.5))), 0)
+    xgi = np.where(plays, rng.gamma(1.0, 0.1 * rows["element_type"].to_numpy()), 0.0)
+    return pd.DataFrame({
+        "name": "Player " + rows["id"].astype(str),
+        "position": rows["element_type"].map(GW_POSITIONS),
+        "team": rows["team"].map(team_names),
+        "element": rows["id"],
+        "fixture": rows["fixture"],
+        "opponent_team": rows["opponent_team"],
+        "was_home": rows["was_home"],
+        "kickoff_time": rows["kickoff_time"],
+        "minutes": minutes,
+        "starts": (minutes >= 60).astype(int),
+        "total_points": total_points,
+        "expected_goal_involvements": xgi.round(2),
+        "expected_goals_conceded": np.where(plays, rng.gamma(1.5, 0.8, n), 0.0).round(2),
+        "ict_index": np.where(plays, rng.gamma(2.0, 2.0, n), 0.0).round(1),
+        "value": rows["now_cost"],
+        "selected": rng.integers(1000, 1000000, n),
+        "GW": rows["event"],
+        "round": rows["event"],
+    }).sort_values(["GW", "kickoff_time", "element"]).reset_index(drop=True)
+
+
+def write_historical_season(root_dir: str, season: str, n_teams: int = 20, n_players: int = 700,
+                            n_gws: int = 38, seed: int = 0, with_gws: bool = True) -> str:
+    """Write a finished season folder in vaastav's layout: players_raw.csv, teams.csv, fixtures.csv, gws/"""
+    rng = np.random.default_rng(seed)
+    teams = make_teams(n_teams, rng)
+    fixtures = make_fixtures(teams, n_gws, n_gws, rng)
+    players = make_players(teams, n_players, n_gws, rng)
+    season_dir = os.path.join(root_dir, season)
+    os.makedirs(season_dir, exist_ok=True)
+    pd.DataFrame(teams).to_csv(os.path.join(season_dir, "teams.csv"), index=False)
+    pd.DataFrame(players).to_csv(os.path.join(season_dir, "players_raw.csv"), index=False)
+    pd.DataFrame(fixtures).to_csv(os.path.join(season_dir, "fixtures.csv"), index=False)
+    if with_gws:
+        os.makedirs(os.path.join(season_dir, "gws"), exist_ok=True)
+        history_df = make_gw_history(players, teams, fixtures, rng)
+        history_df.to_csv(os.path.join(season_dir, "gws", "merged_gw.csv"), index=False)
+    return season_dir
+
+
+if __name__ == "__main__":
+    bootstrap, fixtures = make_payloads()
+    print(json.dumps({key: len(value) for key, value in bootstrap.items()}), len(fixtures))
@@ -1,9 +1,16 @@
-from typing import Optional, List
+import logging
+from typing import Any, Collection, Dict, Optional, List
 import pandas as pd
 
-from data_processing.constants import LIMITS, DEF, PLAYER_PROFILE
+from data_processing.constants import BUDGET, LIMITS, DEF, PLAYER_PROFILE
+from ..tools.optimizer import select_optimal_team
+from ..tools.logs import RejectionStats
+from ..tools.player_view import iter_players, players_to_frame
+from ..tools.profiling import profiled
 from ..tools.utils import check_total_limit_reached
 
+logger = logging.getLogger(__name__)
+
 # Mostly for human-readable purposes
 PLAYER_DETAIL_COLS = [
     'id','first_name','second_name', 'element_type', 'position', 'team', 'team_name', 'ict_index', 'ict_index_rank', 'total_points', 'now_cost', 'value_season',
@@ -14,14 +21,20 @@ PLAYER_DETAIL_COLS = [
 
 # Under what aspect should players be selected
 AVAILABLE_TARGETS = ["budget", "performance"]
+# Players with a lower chance of playing this round are skipped (unknown chance - kept)
+MIN_CHANCE_OF_PLAYING = 75
+# "Budget" candidates cost less than this share of the most expensive one among the best values
+BUDGET_COST_SHARE = 0.75
 
 def get_players_by_target(players_df: pd.DataFrame, criterium: str, limit: int = 100) -> pd.DataFrame:
-    found_players = players_df.sort_values(criterium, ascending=False)[PLAYER_DETAIL_COLS]
+    columns = PLAYER_DETAIL_COLS if criterium in PLAYER_DETAIL_COLS else PLAYER_DETAIL_COLS + [criterium]
+    found_players = players_df.sort_values(criterium, ascending=False)[columns]
     return found_players[:limit]
 
 
 def find_best_players(
-        players_df: pd.DataFrame, target: str, position: Optional[str] = None, limit: int = 100
+        players_df: pd.DataFrame, target: str, position: Optional[str] = None, limit: int = 100,
+        score_col: str = "form_ppg"
 ) -> pd.DataFrame:
     if position and position not in PLAYER_PROFILE:
         raise ValueError(f"Invalid position: '{position}'. Allowed values are: {PLAYER_PROFILE.keys()}")
@@ -33,27 +46,66 @@ def find_best_players(
 
     # Filter out players who may not play this round
     # NaN doesn't mean not playing - often the opposite (injuries are immediately provided as numerical values)
-    players_df['chance_of_playing_this_round'] = players_df['chance_of_playing_this_round'].fillna(75)
-    players_df = players_df[players_df['chance_of_playing_this_round'] >= 75]
+    # (on a copy - the caller's frame is shared by the pipeline stages)
+    players_df = players_df.assign(
+        chance_of_playing_this_round=players_df['chance_of_playing_this_round'].fillna(MIN_CHANCE_OF_PLAYING))
+    players_df = players_df[players_df['chance_of_playing_this_round'] >= MIN_CHANCE_OF_PLAYING]
 
     if target == "performance":
-        players_df["form"] = pd.to_numeric(players_df['form'])
-        players_df["points_per_game"] = pd.to_numeric(players_df['points_per_game'])
-        players_df["form_ppg"] = (players_df["form"] + players_df["points_per_game"]) / 2
-        found_players = get_players_by_target(players_df, criterium="form_ppg", limit=limit)
+        found_players = get_players_by_target(players_df, criterium=score_col, limit=limit)
 
     else:  # target ==  "budget"
         found_players = get_players_by_target(players_df, criterium="value_season", limit=limit)
-        threshold = 0.75 * found_players['now_cost'].max()
+        threshold = BUDGET_COST_SHARE * found_players['now_cost'].max()
         found_players = found_players[found_players['now_cost'] < threshold]
 
     return found_players
 
 
-def select_my_team(elements_df: pd.DataFrame, def_teams: List[str], off_teams: List[str]) -> pd.DataFrame:
+def select_optimal_my_team(elements_df: pd.DataFrame, def_teams: List[str], off_teams: List[str],
+                           budget: int = BUDGET, limits: Dict[str, Any] = LIMITS,
+                           locked: Collection[int] = (), excluded: Collection[int] = (),
+                           score_col: str = "form_ppg") -> pd.DataFrame:
+    """
+    Exact counterpart of select_my_team: the best `score_col` squad among players from the preferred teams.
+    Locked players are always in the squad (whatever their team or availability), excluded ones never.
+    """
+    overlap = set(locked) & set(excluded)
+    if overlap:
+        raise ValueError(f"Players both locked and excluded: {sorted(overlap)}")
+    elements_df = elements_df[~elements_df['id'].isin(excluded)]
+    players_df = elements_df[elements_df['id'].isin(locked)
+                             | (elements_df['chance_of_playing_this_round'].fillna(MIN_CHANCE_OF_PLAYING)
+                                >= MIN_CHANCE_OF_PLAYING)]
+    is_def = players_df['position'].map(PLAYER_PROFILE) == DEF
+    preferred = (is_def & players_df['team_name'].isin(def_teams)) | (~is_def & players_df['team_name'].isin(off_teams))
+    preferred |= players_df['id'].isin(locked)
+    columns = PLAYER_DETAIL_COLS if score_col in PLAYER_DETAIL_COLS else PLAYER_DETAIL_COLS + [score_col]
+    return select_optimal_team(players_df.loc[preferred, columns], score_col=score_col,
+                               budget=budget, limits=limits, locked=locked)
+
+
+@profiled()
+def select_my_team(elements_df: pd.DataFrame, def_teams: List[str], off_teams: List[str],
+                   exact: bool = False, score_col: str = "form_ppg") -> pd.DataFrame:
+    """:param score_col: performance of a player, e.g. 'form_ppg' or 'expected_points' (see expected_points.py)"""
+    if exact:
+        return select_optimal_my_team(elements_df, def_teams, off_teams, score_col=score_col)
+
+    logger.info("Greedy selection among %d players", len(elements_df))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    stats = RejectionStats(logger)
+    PERF_IDX = 0
+    VALUE_IDX = 1
+    # the candidates are the same in every pass - found and turned into player views once
+    suggested_candidates = {
+        PERF_IDX: list(iter_players(find_best_players(elements_df, target="performance", score_col=score_col))),
+        VALUE_IDX: list(iter_players(find_best_players(elements_df, target="budget"))),
+    }
     my_team = list()
     for bp_limit in range(LIMITS['all'] + 1):
-        wallet = 1000
+        wallet = BUDGET
+        stats.passes += 1
 
         selected_ids = set()
         prev_team = my_team
@@ -62,41 +114,36 @@ def select_my_team(elements_df: pd.DataFrame, def_teams: List[str], off_teams: L
         my_team = list()
         bp_counter = 0
 
-        PERF_IDX = 0
-        VALUE_IDX = 1
-        suggested_candidates = {
-            PERF_IDX: find_best_players(elements_df, target="performance"),
-            VALUE_IDX: find_best_players(elements_df, target="budget"),
-        }
         for condition, found_players in (suggested_candidates.items()):
-            for i, player_data in found_players.iterrows():
+            for player_data in found_players:
 
-                if player_data['id'] in selected_ids:
+                if player_data.id in selected_ids:
                     continue
                 if check_total_limit_reached(my_team):
                     break
 
-                position = player_data["position"]
-                team = player_data["team_name"]
+                position = player_data.position
+                team = player_data.team_name
 
                 # Check if profile in preferred team - optionally!
                 profile = PLAYER_PROFILE[position]
-                if profile == DEF:
-                    if team not in def_teams:
-                        print(
-                            f"Rejected: {player_data['first_name']} {player_data['second_name']} | {position}@{team} is not {profile} enough")
-                        continue
-                else:  # profile == OFF
-                    if team not in off_teams:
-                        print(
-                            f"Rejected: {player_data['first_name']} {player_data['second_name']} | {position}@{team} is not {profile} enough")
-                        continue
+                preferred_teams = def_teams if profile == DEF else off_teams
+                if team not in preferred_teams:
+                    stats.reject("profile")
+                    if debug:
+                        logger.debug("Rejected: %s %s | %s@%s is not %s enough",
+                                     player_data.first_name, player_data.second_name, position, team, profile,
+                                     extra={"player_id": player_data.id, "reason": "profile"})
+                    continue
 
                 # Check team limits
                 if clubs_usage.get(team):
                     if clubs_usage[team] >= LIMITS['one_team']:
-                        print(
-                            f"Rejected: {player_data['first_name']} {player_data['second_name']} | {position}@{team} exceeded the limit for same team players: {LIMITS['one_team']}")
+                        stats.reject("club limit")
+                        if debug:
+                            logger.debug("Rejected: %s %s | %s@%s exceeded the limit for same team players: %d",
+                                         player_data.first_name, player_data.second_name, position, team,
+                                         LIMITS['one_team'], extra={"player_id": player_data.id, "reason": "club limit"})
                         continue
                 else:
                     clubs_usage[team] = 0
@@ -104,10 +151,12 @@ def select_my_team(elements_df: pd.DataFrame, def_teams: List[str], off_teams: L
                 # Check position limits
                 if position_usage.get(position):
                     if position_usage[position] >= LIMITS['position'][position]:
-                        print(
-                            f"Rejected: {player_data['first_name']} {player_data['second_name']}'s position: {position} "
-                            f"exceeded the limit: {LIMITS['position'][position]}"
-                        )
+                        stats.reject("position limit")
+                        if debug:
+                            logger.debug("Rejected: %s %s's position: %s exceeded the limit: %d",
+                                         player_data.first_name, player_data.second_name, position,
+                                         LIMITS['position'][position],
+                                         extra={"player_id": player_data.id, "reason": "position limit"})
                         continue
                 else:
                     position_usage[position] = 0
@@ -115,21 +164,26 @@ def select_my_team(elements_df: pd.DataFrame, def_teams: List[str], off_teams: L
                 # Best performing players - check limit, update counter
                 if condition == PERF_IDX:
                     if bp_counter >= bp_limit:
-                        print("The best performing players limit reached")
+                        logger.debug("The best performing players limit reached")
                         break
                     bp_counter += 1
 
                 # Update wallet
-                print(
-                    f"Approved: {player_data['first_name']} {player_data['second_name']} ({position}@{team}) added to team")
                 my_team.append(player_data)
-                selected_ids.add(player_data['id'])
-                print(f"Collected players: {len(my_team)}")
+                selected_ids.add(player_data.id)
                 clubs_usage[team] += 1
                 position_usage[position] += 1
-                wallet -= player_data['now_cost']
-                print(f"Budget remained: {wallet}")
+                wallet -= player_data.now_cost
+                if debug:
+                    logger.debug("Approved: %s %s (%s@%s) added to team | collected players: %d, budget remained: %d",
+                                 player_data.first_name, player_data.second_name, position, team,
+                                 len(my_team), wallet, extra={"player_id": player_data.id, "wallet": wallet})
 
                 if wallet < 0:
+                    stats.reject("budget")
                     my_team = prev_team
-                    return pd.DataFrame(my_team)
+                    stats.log_summary(len(my_team))
+                    return players_to_frame(my_team)
+
+    stats.log_summary(len(my_team))
+    return players_to_frame(my_team)
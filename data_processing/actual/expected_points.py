@@ -0,0 +1,134 @@
+"""
+Expected FPL points of every player in each of the next gameweeks (players x GWs), computed at once with NumPy.
+Per fixture, a player's points come from their rate stats of the season, scaled by the opponent:
+- appearance: 1 point when playing, 1 more for 60+ minutes (the share of starts),
+- attack: expected goal involvements per 90 minutes x the expected minutes x attack strength vs the opponent's defence,
+- defence: clean sheet chance (Poisson of the expected goals conceded per 90) and goals conceded,
+  both scaled by the opponent's attack vs the team's defence,
+all multiplied by the chance of playing. A double gameweek sums its fixtures, a blank one is worth 0.
+"""
+import logging
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from ..tools.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
+# How many next GWs are projected by default
+XP_GW_LIMIT = 5
+# Name of the column with the total over the horizon, an alternative score of the squad selection
+EXPECTED_POINTS = "expected_points"
+
+# FPL scoring by element_type (1 - GK, 2 - DEF, 3 - MID, 4 - FWD)
+GOAL_POINTS = np.array([0, 10, 6, 5, 4])
+ASSIST_POINTS = 3
+CLEAN_SHEET_POINTS = np.array([0, 4, 4, 1, 0])
+# -1 for every 2 goals conceded
+CONCEDED_POINTS = np.array([0, -0.5, -0.5, 0, 0])
+# Share of goals (the rest are assists) in the expected goal involvements of a position
+GOAL_SHARE = np.array([0, 0.5, 0.35, 0.45, 0.65])
+
+
+def get_fixture_factors(matchups_df: pd.DataFrame, num_of_gws: int) -> Tuple[pd.Index, pd.Index, np.ndarray,
+                                                                              np.ndarray]:
+    """
+    Opponent scaling of every team's fixtures in the next `num_of_gws` gameweeks, as team x GW x fixture arrays
+    (NaN where a team has fewer fixtures in a GW, e.g. all of them in a blank one).
+    attack - own attack vs the opponent's defence, conceded - the opponent's attack vs own defence,
+    both at the fixture's venue and relative to the average fixture (1.0).
+
+    :return: (teams, events, attack, conceded)
+    """
+    first_event = int(matchups_df['event'].min())
+    last_event = min(first_event + num_of_gws - 1, int(matchups_df['event'].max()))
+    events = pd.RangeIndex(first_event, last_event + 1, name="event")
+    matchups_df = matchups_df[matchups_df['event'] <= last_event]
+
+    # One row per team per fixture, from the team's perspective
+    team = np.concatenate([matchups_df['team_h'].to_numpy(), matchups_df['team_a'].to_numpy()])
+    event = np.concatenate([matchups_df['event'].to_numpy(dtype=int)] * 2)
+    attack = np.concatenate([
+        matchups_df['team_h_strength_att_home'].to_numpy() / matchups_df['team_a_strength_def_away'].to_numpy(),
+        matchups_df['team_a_strength_att_away'].to_numpy() / matchups_df['team_h_strength_def_home'].to_numpy(),
+    ])
+    conceded = np.concatenate([
+        matchups_df['team_a_strength_att_away'].to_numpy() / matchups_df['team_h_strength_def_home'].to_numpy(),
+        matchups_df['team_h_strength_att_home'].to_numpy() / matchups_df['team_a_strength_def_away'].to_numpy(),
+    ])
+    if len(team):
+        attack, conceded = attack / attack.mean(), conceded / conceded.mean()
+
+    teams = pd.Index(np.unique(team), name="team")
+    team_pos = teams.get_indexer(team)
+    event_pos = event - first_event
+    # n-th fixture of the team in the GW
+    order = np.lexsort((event_pos, team_pos))
+    key = team_pos[order] * len(events) + event_pos[order]
+    group_start = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    slot = np.empty(len(key), dtype=int)
+    slot[order] = np.arange(len(key)) - np.repeat(group_start, np.diff(np.r_[group_start, len(key)]))
+
+    shape = (len(teams), len(events), slot.max() + 1 if len(slot) else 1)
+    attack_arr = np.full(shape, np.nan)
+    conceded_arr = np.full(shape, np.nan)
+    attack_arr[team_pos, event_pos, slot] = attack
+    conceded_arr[team_pos, event_pos, slot] = conceded
+    return teams, events, attack_arr, conceded_arr
+
+
+@profiled()
+def get_expected_points_matrix(elements_df: pd.DataFrame, matchups_df: pd.DataFrame,
+                               num_of_gws: int = XP_GW_LIMIT) -> pd.DataFrame:
+    """
+    :param elements_df: players with 'id', 'team', 'element_type', 'minutes', 'starts', 'expected_goal_involvements',
+                        'expected_goals_conceded' and 'chance_of_playing_next_round'
+    :param matchups_df: future fixtures with the teams' strengths, see get_matchups()
+    :return: expected points, indexed by player ID, one column per gameweek
+    """
+    if matchups_df.empty:
+        # the season is over
+        return pd.DataFrame(index=pd.Index(elements_df['id'].to_numpy(), name="id"))
+    teams, events, attack, conceded = get_fixture_factors(matchups_df, num_of_gws)
+    # GWs already played by the teams - the stats are season totals
+    played_gws = max(events[0] - 1, 1)
+
+    element_type = elements_df['element_type'].to_numpy(dtype=int)
+    minutes = elements_df['minutes'].to_numpy(dtype=float)
+    starts = elements_df['starts'].to_numpy(dtype=float)
+    per_90 = np.divide(90, minutes, out=np.zeros_like(minutes), where=minutes > 0)
+    xgi_90 = elements_df['expected_goal_involvements'].to_numpy(dtype=float) * per_90
+    xgc_90 = elements_df['expected_goals_conceded'].to_numpy(dtype=float) * per_90
+    availability = elements_df['chance_of_playing_next_round'].fillna(100).to_numpy(dtype=float) / 100
+
+    start_rate = np.clip(starts / played_gws, 0, 1)
+    expected_minutes = np.minimum(minutes / played_gws, 90)
+    play_rate = np.clip(expected_minutes / 60, start_rate, 1)
+    appearance = play_rate + start_rate
+    goal_share = GOAL_SHARE[element_type]
+    points_per_xgi = goal_share * GOAL_POINTS[element_type] + (1 - goal_share) * ASSIST_POINTS
+    attack_points = xgi_90 * expected_minutes / 90 * points_per_xgi
+    conceded_points = CONCEDED_POINTS[element_type] * xgc_90 * expected_minutes / 90
+    clean_sheet_points = CLEAN_SHEET_POINTS[element_type] * start_rate
+
+    # players x GWs x fixtures, by the player's team; players of teams without fixtures get NaN -> 0 points
+    team_pos = teams.get_indexer(elements_df['team'])
+    player_attack = np.where((team_pos >= 0)[:, None, None], attack[team_pos], np.nan)
+    player_conceded = np.where((team_pos >= 0)[:, None, None], conceded[team_pos], np.nan)
+    fixture_points = (appearance[:, None, None]
+                      + attack_points[:, None, None] * player_attack
+                      + conceded_points[:, None, None] * player_conceded
+                      + clean_sheet_points[:, None, None] * np.exp(-xgc_90[:, None, None] * player_conceded))
+    expected_points = availability[:, None] * np.nansum(fixture_points, axis=2)
+
+    return pd.DataFrame(expected_points, index=pd.Index(elements_df['id'].to_numpy(), name="id"), columns=events)
+
+
+def add_expected_points(players_df: pd.DataFrame, xp_matrix_df: pd.DataFrame) -> pd.DataFrame:
+    """The players with their expected points of every GW ('xP_GW<n>') and the total ('expected_points')"""
+    player_xp = xp_matrix_df.reindex(players_df['id'].to_numpy()).round(2)
+    columns = {f"xP_GW{event}": player_xp[event].to_numpy() for event in xp_matrix_df.columns}
+    columns[EXPECTED_POINTS] = player_xp.sum(axis=1, min_count=1).round(2).to_numpy()
+    return players_df.assign(**columns)
@@ -0,0 +1,255 @@
+"""
+In-season pipeline updated incrementally.
+The derived state of the last run (augmented elements, matchups, team DEF/OFF indices, fixtures difficulty matrix,
+selected squad) is saved in [DATA_DIR]/cache/. The next run compares the fresh API snapshot with it by player
+and fixture ID and recomputes only the changed players and the teams whose fixtures changed - so polling
+on a deadline day (price changes, injury news) costs a fraction of a full run.
+"""
+import logging
+import os
+import pickle
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .expected_points import EXPECTED_POINTS, XP_GW_LIMIT
+from .process_actual_data import (ActualDataProcessor, FUTURE_GW_LIMIT, TEAMS_LIMIT, augment_elements_df,
+                                  get_matchups, get_team_off_def_idx)
+from ..constants import CACHE_DIR, ROLLING_SCORE
+from ..tools.fixtures import FIXTURES_GW_LIMIT, get_difficulty_matrix, get_fixture_difficulty
+from ..tools.pipeline import is_same
+
+logger = logging.getLogger(__name__)
+
+STATE_PATH = os.path.join(CACHE_DIR, "in_season_state.pkl")
+# Bumped whenever the layout of the saved state changes - an older state is then ignored
+STATE_VERSION = 2
+# Fixture columns the matchups and the difficulty matrix depend on
+FIXTURE_COLS = ['event', 'finished', 'team_h', 'team_a', 'team_h_difficulty', 'team_a_difficulty']
+
+
+def diff_by_id(old_df: pd.DataFrame, new_df: pd.DataFrame, columns: List[str],
+               key: str = 'id') -> Tuple[pd.Index, pd.Index, pd.Index]:
+    """Return IDs of the (changed, added, removed) rows, comparing only `columns`"""
+    old_ids, new_ids = old_df[key].to_numpy(), new_df[key].to_numpy()
+    if np.array_equal(old_ids, new_ids):
+        # usual case - the same rows in the same order: compare the columns as arrays, without any alignment
+        differs = np.zeros(len(new_ids), dtype=bool)
+        for col in columns:
+            old_values, new_values = old_df[col].to_numpy(), new_df[col].to_numpy()
+            col_differs = old_values != new_values
+            if col_differs.any():
+                differs |= col_differs & ~(pd.isna(old_values) & pd.isna(new_values))
+        empty = pd.Index([], dtype=new_df[key].dtype)
+        return pd.Index(new_ids[differs]), empty, empty
+
+    old_df = old_df.set_index(key)[columns]
+    new_df = new_df.set_index(key)[columns]
+    common = new_df.index.intersection(old_df.index)
+    old_common, new_common = old_df.loc[common], new_df.loc[common]
+    differs = (old_common != new_common) & ~(old_common.isna() & new_common.isna())
+    changed = common[differs.any(axis=1).to_numpy()]
+    return changed, new_df.index.difference(old_df.index), old_df.index.difference(new_df.index)
+
+
+def update_rows(old_df: pd.DataFrame, updated_df: pd.DataFrame, order: pd.Series, key: str = 'id') -> pd.DataFrame:
+    """
+    Merge the recomputed rows into the previous result: rows are taken from `updated_df` if they are there,
+    otherwise from `old_df`, in the order (and with the index) of `order` - the key column of the fresh data.
+    """
+    old_pos = pd.Index(old_df[key]).get_indexer(order)
+    updated_pos = pd.Index(updated_df[key]).get_indexer(order)
+    positions = np.where(updated_pos >= 0, len(old_df) + updated_pos, old_pos)
+    if (positions < 0).any():
+        raise KeyError(f"Rows missing in both frames: {order[positions < 0].tolist()}")
+    merged_df = pd.concat([old_df, updated_df[old_df.columns]], ignore_index=True).take(positions)
+    merged_df.index = order.index
+    # e.g. an int column of the previous result which is float in a few recomputed rows
+    changed_dtypes = {col: dtype for col, dtype in old_df.dtypes.items() if merged_df[col].dtype != dtype}
+    return merged_df.astype(changed_dtypes) if changed_dtypes else merged_df
+
+
+def load_state(path: str = STATE_PATH) -> Dict[str, Any]:
+    try:
+        state = pd.read_pickle(path)
+    except FileNotFoundError:
+        return dict()
+    # a corrupt or partial file, or one pickled from classes which have changed since
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as err:
+        logger.warning("Ignoring the unreadable in-season state %s (%s), running the full pipeline", path, err)
+        return dict()
+    if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+        logger.info("Ignoring the saved in-season state of another version: %s", path)
+        return dict()
+    return state
+
+
+def save_state(state: Dict[str, Any], path: str = STATE_PATH) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    pd.to_pickle({**state, "version": STATE_VERSION, "saved_at": time.time()}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class IncrementalDataProcessor(ActualDataProcessor):
+    """
+    ActualDataProcessor reusing the results of the previous run (or of the previous launch_pipeline() call,
+    when polling with refresh()). Every stage falls back to the full computation when there is nothing to compare
+    with, or when something it can't update row by row has changed (e.g. the teams' strengths).
+    """
+
+    def __init__(self, exact: bool = False, future_gw_limit: int = FUTURE_GW_LIMIT, teams_limit: int = TEAMS_LIMIT,
+                 fixtures_gw_limit: int = FIXTURES_GW_LIMIT, score_col: str = "form_ppg",
+                 xp_gw_limit: int = XP_GW_LIMIT, state_path: str = STATE_PATH):
+        self.state_path = state_path
+        self.state = load_state(state_path)
+        # Fixtures already compared with the state, and the teams whose fixtures changed (None - all of them)
+        self._fixture_changes: Optional[Tuple[pd.DataFrame, Optional[Set[int]]]] = None
+        # IDs of the players changed since the state (None - all of them)
+        self._changed_players: Optional[pd.Index] = None
+        super().__init__(exact, future_gw_limit, teams_limit, fixtures_gw_limit, score_col, xp_gw_limit)
+
+    def launch_pipeline(self) -> pd.DataFrame:
+        selected_team = super().launch_pipeline()
+        self.state = {
+            "api_elements": self.pipeline["api_elements"],
+            "api_element_types": self.pipeline["api_element_types"],
+            "api_teams": self.pipeline["api_teams"],
+            "api_fixtures": self.pipeline["api_fixtures"],
+            "elements": self.pipeline["elements"],
+            "matchups": self.pipeline["matchups"],
+            "teams_idx": self.pipeline["teams_idx"],
+            "future_gw_limit": self.pipeline["future_gw_limit"],
+            "difficulty_matrix": self.pipeline["difficulty_matrix"],
+            "fixtures_gw_limit": self.pipeline["fixtures_gw_limit"],
+            "best_teams": self.pipeline["best_teams"],
+            "exact": self.pipeline["exact"],
+            "score_col": self.pipeline["score_col"],
+            "expected_points": self.pipeline["expected_points"],
+            "rolling_features": self.pipeline["rolling_features"],
+            "selected_team": selected_team,
+        }
+        self._fixture_changes = None
+        save_state(self.state, self.state_path)
+        return selected_team
+
+    def _same_as_state(self, **values: Any) -> bool:
+        return all(name in self.state and is_same(self.state[name], value) for name, value in values.items())
+
+    def compute_elements(self, elements_df: pd.DataFrame, element_types_df: pd.DataFrame,
+                         teams_df: pd.DataFrame) -> pd.DataFrame:
+        old_elements_df = self.state.get("api_elements")
+        if (old_elements_df is None or list(old_elements_df.columns) != list(elements_df.columns)
+                or not self._same_as_state(api_element_types=element_types_df, api_teams=teams_df)):
+            self._changed_players = None
+            return super().compute_elements(elements_df, element_types_df, teams_df)
+
+        changed, added, removed = diff_by_id(old_elements_df, elements_df, list(elements_df.columns.drop('id')))
+        self._changed_players = changed.append(added).append(removed)
+        logger.info("Players since the last run: %d changed, %d added, %d removed",
+                    len(changed), len(added), len(removed))
+        if self._changed_players.empty:
+            return self.state["elements"]
+        updated_df = augment_elements_df(elements_df[elements_df['id'].isin(changed.append(added))],
+                                         element_types_df, teams_df)
+        return update_rows(self.state["elements"], updated_df, elements_df['id'])
+
+    def get_fixture_changes(self, fixtures_df: pd.DataFrame) -> Optional[Set[int]]:
+        """IDs of the teams whose fixtures changed since the state, None if all of them have to be recomputed"""
+        if self._fixture_changes is not None and self._fixture_changes[0] is fixtures_df:
+            return self._fixture_changes[1]
+
+        old_fixtures_df = self.state.get("api_fixtures")
+        teams = None
+        if old_fixtures_df is not None:
+            changed, added, removed = diff_by_id(old_fixtures_df, fixtures_df, FIXTURE_COLS)
+            old_ids, new_ids = changed.append(removed), changed.append(added)
+            teams = set()
+            for df, ids in ((old_fixtures_df, old_ids), (fixtures_df, new_ids)):
+                changed_df = df[df['id'].isin(ids)]
+                teams.update(changed_df['team_h'].astype(int))
+                teams.update(changed_df['team_a'].astype(int))
+            logger.info("Fixtures since the last run: %d changed, %d added, %d removed (%d teams affected)",
+                        len(changed), len(added), len(removed), len(teams))
+        self._fixture_changes = (fixtures_df, teams)
+        return teams
+
+    def compute_matchups(self, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame) -> pd.DataFrame:
+        teams = self.get_fixture_changes(fixtures_df)
+        if teams is None or not self._same_as_state(api_teams=teams_df):
+            return super().compute_matchups(fixtures_df, teams_df)
+        if not teams:
+            return self.state["matchups"]
+
+        # matchups are indexed like the fixtures - identify them by the fixture ID
+        old_fixtures_df = self.state["api_fixtures"]
+        old_matchups_df = self.state["matchups"].assign(id=old_fixtures_df.loc[self.state["matchups"].index, 'id'])
+        is_affected = fixtures_df['team_h'].isin(teams) | fixtures_df['team_a'].isin(teams)
+        updated_df = get_matchups(fixtures_df[is_affected], teams_df)
+        updated_df['id'] = fixtures_df.loc[updated_df.index, 'id']
+        # only the fixtures which are still to be played
+        future_ids = get_matchups_ids(fixtures_df)
+        old_matchups_df = old_matchups_df[~old_matchups_df['id'].isin(fixtures_df.loc[is_affected, 'id'])]
+        matchups_df = update_rows(old_matchups_df, updated_df, future_ids)
+        return matchups_df.drop(columns='id')
+
+    def compute_teams_idx(self, teams_df: pd.DataFrame, matchups_df: pd.DataFrame,
+                          future_gw_limit: int) -> pd.DataFrame:
+        teams = self.get_fixture_changes(self.pipeline["api_fixtures"])
+        if teams is None or not self._same_as_state(api_teams=teams_df, future_gw_limit=future_gw_limit):
+            return super().compute_teams_idx(teams_df, matchups_df, future_gw_limit)
+        if not teams:
+            return self.state["teams_idx"]
+
+        # a team's index depends only on its own next matchups
+        team_matchups_df = matchups_df[matchups_df['team_h'].isin(teams) | matchups_df['team_a'].isin(teams)]
+        updated_idx = get_team_off_def_idx(teams_df[teams_df['id'].isin(teams)], team_matchups_df, future_gw_limit)
+        teams_idx = self.state["teams_idx"].copy()
+        teams_idx.loc[updated_idx.index] = updated_idx
+        return teams_idx
+
+    def compute_difficulty_matrix(self, fixtures_df: pd.DataFrame, fixtures_gw_limit: int) -> pd.DataFrame:
+        teams = self.get_fixture_changes(fixtures_df)
+        old_matrix_df = self.state.get("difficulty_matrix")
+        if teams is None or old_matrix_df is None or not self._same_as_state(fixtures_gw_limit=fixtures_gw_limit):
+            return super().compute_difficulty_matrix(fixtures_df, fixtures_gw_limit)
+        if not teams:
+            return old_matrix_df
+
+        difficulty_df = get_fixture_difficulty(fixtures_df[fixtures_df["finished"] == False])
+        if difficulty_df.empty:
+            # the season is over
+            return super().compute_difficulty_matrix(fixtures_df, fixtures_gw_limit)
+        start_event = int(difficulty_df['event'].min())
+        last_event = min(start_event + fixtures_gw_limit - 1, int(difficulty_df['event'].max()))
+        if list(old_matrix_df.columns) != list(range(start_event, last_event + 1)):
+            # the horizon moved (a gameweek was finished) - every row changes
+            return super().compute_difficulty_matrix(fixtures_df, fixtures_gw_limit)
+
+        affected = old_matrix_df.index[old_matrix_df.index.isin(teams)]
+        updated_df = get_difficulty_matrix(difficulty_df[difficulty_df['team'].isin(affected)], fixtures_gw_limit,
+                                           start_event=start_event, teams=affected)
+        matrix_df = old_matrix_df.copy()
+        matrix_df.loc[affected] = updated_df
+        return matrix_df
+
+    def compute_selected_team(self, elements_df: pd.DataFrame, best_teams: Tuple[List[str], List[str]],
+                              exact: bool, score_col: str, expected_points_df: pd.DataFrame,
+                              rolling_features_df: pd.DataFrame) -> pd.DataFrame:
+        # the squad depends on all players - it is either reused as a whole or selected again
+        if (self._changed_players is not None and self._changed_players.empty
+                and self._same_as_state(best_teams=best_teams, exact=exact, score_col=score_col)
+                and (score_col != EXPECTED_POINTS or self._same_as_state(expected_points=expected_points_df))
+                and (score_col != ROLLING_SCORE or self._same_as_state(rolling_features=rolling_features_df))):
+            logger.info("Nothing relevant changed since the last run, reusing the selected squad")
+            return self.state["selected_team"]
+        return super().compute_selected_team(elements_df, best_teams, exact, score_col, expected_points_df,
+                                             rolling_features_df)
+
+
+def get_matchups_ids(fixtures_df: pd.DataFrame) -> pd.Series:
+    """IDs of the fixtures get_matchups() keeps, with their index"""
+    is_future = (fixtures_df["finished"] == False) & fixtures_df['event'].notna()
+    return fixtures_df.loc[is_future, 'id']
@@ -0,0 +1,219 @@
+"""
+Transfer plans for many managers at once, e.g. every manager of a few mini-leagues.
+The league-wide state - expected points, prices, clubs and positions of all the players - is computed once
+by an ActualDataProcessor and copied into shared memory. The squads are planned (see transfer_planner.py)
+in a pool of processes mapping that memory, so a task only carries the manager's squad.
+
+Managers come from a JSON file: [{"manager": "...", "squad": [15 IDs], "bank": 5, "free_transfers": 1}, ...],
+a CSV file with the same columns (the squad as space separated IDs), or the API: the picks of the given managers
+or of all the managers of classic leagues (also served by the stand-in server from recorded payloads).
+
+    managers = load_managers("league.json")
+    plans_df = plan_league(processor, managers)   # one row per planned GW per manager
+    summarize_league(plans_df)                    # one row per manager
+
+Usage: python -m data_processing.actual.mini_league (--squads FILE | --managers ID [ID ...] | --leagues ID [ID ...])
+                                                   [--horizon 5] [--workers N] [--output FILE] [--offline]
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import shared_memory
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+
+from .expected_points import XP_GW_LIMIT
+from .process_actual_data import ActualDataProcessor
+from .transfer_planner import BEAM_WIDTH, PlanningData, TransferPlan, get_planning_data, plan_squad, plan_to_frame
+from ..constants import ENTRY_PICKS_ENDPOINT, LEAGUE_STANDINGS_ENDPOINT
+from ..tools.async_fetch import BulkFetcher
+from ..tools.fpl_api import FplApiClient, get_base_api_data, set_client
+from ..tools.logs import setup_logging
+from ..tools.report import write_workbook
+from ..tools.shared_arrays import SharedArrays, SharedSpec, attach_arrays
+
+logger = logging.getLogger(__name__)
+
+# Columns of the result: the manager and the plan's totals, then the planned GW (see plan_to_frame, its bank and
+# free transfers prefixed with 'gw_')
+MANAGER_COLS = ['manager', 'status', 'bank', 'free_transfers', 'hold_points', 'plan_points', 'gain']
+# Free transfers assumed when the source doesn't tell (the picks of the API don't)
+FREE_TRANSFERS = 1
+
+
+class Manager(NamedTuple):
+    manager: str
+    squad: Tuple[int, ...]
+    bank: int = 0
+    free_transfers: int = FREE_TRANSFERS
+
+
+def load_managers(path: str) -> List[Manager]:
+    """Managers of a JSON or CSV file"""
+    if path.endswith(".csv"):
+        records = pd.read_csv(path, dtype={'manager': str, 'squad': str}).to_dict("records")
+        for record in records:
+            record['squad'] = [int(pid) for pid in record['squad'].split()]
+    else:
+        with open(path, encoding="utf-8") as file:
+            records = json.load(file)
+    managers = list()
+    for record in records:
+        managers.append(Manager(str(record['manager']), tuple(int(pid) for pid in record['squad']),
+                                int(record.get('bank', 0)), int(record.get('free_transfers', FREE_TRANSFERS))))
+    return managers
+
+
+def current_event() -> int:
+    """The GW of the managers' current picks: the ongoing one, else the last finished"""
+    events_df = get_base_api_data("events")
+    current = events_df.loc[events_df['is_current'] == True, 'id']
+    if len(current):
+        return int(current.iloc[0])
+    return int(events_df.loc[events_df['finished'] == True, 'id'].max())
+
+
+def fetch_managers(manager_ids: Iterable[int], event: Optional[int] = None,
+                   fetcher: Optional[BulkFetcher] = None) -> List[Manager]:
+    """Squads and banks of the managers in the GW (default: the current one), downloaded concurrently"""
+    fetcher = fetcher or BulkFetcher()
+    event = event or current_event()
+    picks = fetcher.fetch_all({manager_id: ENTRY_PICKS_ENDPOINT.format(manager_id=manager_id, event=event)
+                               for manager_id in manager_ids})
+    return [Manager(str(manager_id), tuple(pick['element'] for pick in payload['picks']),
+                    int(payload.get('entry_history', dict()).get('bank', 0)))
+            for manager_id, payload in picks.items()]
+
+
+def fetch_league_managers(league_ids: Iterable[int], fetcher: Optional[BulkFetcher] = None) -> List[int]:
+    """IDs of all the managers of the classic leagues, page by page"""
+    fetcher = fetcher or BulkFetcher()
+    manager_ids = dict()
+    pages = {league_id: 1 for league_id in league_ids}
+    while pages:
+        standings = fetcher.fetch_all({league_id: LEAGUE_STANDINGS_ENDPOINT.format(league_id=league_id, page=page)
+                                       for league_id, page in pages.items()})
+        next_pages = dict()
+        for league_id, payload in standings.items():
+            results = payload['standings']
+            manager_ids.update((row['entry'], None) for row in results['results'])
+            if results.get('has_next'):
+                next_pages[league_id] = pages[league_id] + 1
+        pages = next_pages
+    return list(manager_ids)
+
+
+def plan_league(processor: ActualDataProcessor, managers: Sequence[Manager], horizon: int = XP_GW_LIMIT,
+                beam_width: int = BEAM_WIDTH, max_workers: Optional[int] = None) -> pd.DataFrame:
+    """
+    Plan the transfers of every manager's squad over the next `horizon` GWs.
+
+    :return: one row per planned GW per manager (its transfers, hits, captain and points) with the manager's
+             totals; a squad that cannot be planned has a single row with the reason in 'status'
+    """
+    if not managers:
+        raise ValueError("No managers to plan the transfers of")
+    data = get_planning_data(processor, horizon)
+    tasks = [(manager, beam_width) for manager in managers]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    logger.info("Planning %d squads over GWs %s in %d process(es)", len(tasks), list(data.events), max_workers)
+    if max_workers <= 1:
+        _use_data(data)
+        plans = [_plan(task) for task in tasks]
+    else:
+        # the league-wide arrays are mapped by every worker, only the squads are sent
+        with SharedArrays(_get_arrays(data)) as shared, \
+                ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(shared.spec, data.events)) \
+                as executor:
+            plans = list(executor.map(_plan, tasks, chunksize=max(1, len(tasks) // (4 * max_workers))))
+
+    frames = list()
+    for manager, plan in zip(managers, plans):
+        info = {'manager': manager.manager, 'bank': manager.bank, 'free_transfers': manager.free_transfers}
+        if isinstance(plan, str):
+            frames.append(pd.DataFrame([{**info, 'status': plan}], columns=MANAGER_COLS))
+            continue
+        info.update(status="planned", hold_points=plan.hold_points, plan_points=plan.total_points,
+                    gain=round(plan.total_points - plan.hold_points, 2))
+        steps_df = plan_to_frame(plan, processor.elements_df).rename(
+            columns={'bank': 'gw_bank', 'free_transfers': 'gw_free_transfers'})
+        manager_df = pd.DataFrame({col: [info[col]] * len(steps_df) for col in MANAGER_COLS})
+        frames.append(pd.concat([manager_df, steps_df], axis=1))
+    # squads without a plan have no GW - keep the integer columns integer
+    return pd.concat(frames, ignore_index=True).astype(
+        {'event': 'Int64', 'hits': 'Int64', 'gw_free_transfers': 'Int64', 'gw_bank': 'Int64'})
+
+
+def summarize_league(plans_df: pd.DataFrame) -> pd.DataFrame:
+    """One row per manager: the totals and the transfers of the next GW, the biggest gains first"""
+    first_gw = plans_df.groupby('manager', sort=False).head(1).set_index('manager')
+    return first_gw.drop(columns=["points"], errors="ignore").sort_values('gain', ascending=False)
+
+
+# Planning data mapped from the shared memory, set once in every worker process
+_data: Optional[PlanningData] = None
+_block: Optional[shared_memory.SharedMemory] = None
+
+
+def _get_arrays(data: PlanningData) -> Dict[str, Any]:
+    return {field: getattr(data, field) for field in PlanningData._fields if field != 'events'}
+
+
+def _use_data(data: PlanningData) -> None:
+    global _data
+    _data = data
+
+
+def _init_worker(spec: SharedSpec, events: Tuple[int, ...]) -> None:
+    global _block
+    _block, arrays = attach_arrays(spec)
+    _use_data(PlanningData(events=events, **arrays))
+
+
+def _plan(task: Tuple[Manager, int]) -> Union[TransferPlan, str]:
+    """The manager's TransferPlan, or the reason why the squad cannot be planned"""
+    manager, beam_width = task
+    try:
+        return plan_squad(_data, manager.squad, manager.bank, manager.free_transfers, beam_width)
+    except ValueError as err:
+        return str(err)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan the transfers of many managers at once")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--squads", help="JSON or CSV file with the managers' squads, banks and free transfers")
+    source.add_argument("--managers", type=int, nargs="+", help="IDs of the managers, their picks are downloaded")
+    source.add_argument("--leagues", type=int, nargs="+", help="IDs of classic leagues, all their managers")
+    parser.add_argument("--event", type=int, help="GW of the downloaded picks (default: the current one)")
+    parser.add_argument("--horizon", type=int, default=XP_GW_LIMIT, help="how many next GWs to plan")
+    parser.add_argument("--beam-width", type=int, default=BEAM_WIDTH, help="states kept after every GW")
+    parser.add_argument("--workers", type=int, help="processes planning the squads (default: all CPUs)")
+    parser.add_argument("--output", help="XLSX (managers and plans) or CSV (plans) file, "
+                                         "default: results/<date>-FPL-League.xlsx")
+    parser.add_argument("--offline", action="store_true", help="replay the API snapshots saved in data/cache")
+    args = parser.parse_args()
+    setup_logging()
+    set_client(FplApiClient(offline=args.offline or None))
+
+    if args.squads:
+        league_managers = load_managers(args.squads)
+    else:
+        manager_ids = args.managers or fetch_league_managers(args.leagues)
+        league_managers = fetch_managers(manager_ids, args.event)
+    if not league_managers:
+        parser.error("No managers found - the squads file or the leagues are empty")
+    league_plans_df = plan_league(ActualDataProcessor(), league_managers, args.horizon, args.beam_width,
+                                  args.workers)
+    output = args.output or os.path.join("results", f"{datetime.today().strftime('%Y-%m-%d')}-FPL-League.xlsx")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    if output.endswith(".csv"):
+        league_plans_df.to_csv(output, index=False)
+    else:
+        write_workbook({"managers": summarize_league(league_plans_df).reset_index(), "plans": league_plans_df},
+                       output)
+    logger.info("Plans of %d managers saved: %s", len(league_managers), output)
@@ -1,11 +1,20 @@
-from typing import Dict, Any, List
+import logging
+from functools import partial
+from typing import List, Tuple
 
 import pandas as pd
 import numpy as np
 
 from .act_team_selection import select_my_team
-from ..constants import DEF, OFF
-from ..tools.fpl_api import get_base_api_data, load_fixtures
+from .expected_points import EXPECTED_POINTS, XP_GW_LIMIT, get_expected_points_matrix
+from ..constants import DEF, OFF, ROLLING_SCORE
+from ..tools.fixtures import FIXTURES_GW_LIMIT, get_future_difficulty_matrix
+from ..tools.fpl_api import get_base_api_data, get_client, load_fixtures
+from ..tools.pipeline import Pipeline
+from ..tools.profiling import profiled
+from ..tools.schema import as_category
+
+logger = logging.getLogger(__name__)
 
 # How many next/future GameWeeks should be considered in selecting teams
 FUTURE_GW_LIMIT = 5
@@ -14,125 +23,248 @@ TEAMS_LIMIT = 7
 
 
 class ActualDataProcessor:
-    def __init__(self):
-        self.elements_df = get_base_api_data("elements")
-        self.element_types_df = get_base_api_data("element_types")
-        self.teams_df = get_base_api_data("teams")
-        self.events_df = get_base_api_data("events")
-        self.fixtures_df = load_fixtures()
-        self.selected_team = None
-        self.matchups_df = None
-        self.launch_pipeline()
-
-    def launch_pipeline(self):
-        # Add human-readable info and augment the data
-        self.augment_elements_df()
+    """
+    In-season pipeline: API tables -> augmented elements / matchups -> team index -> best teams -> selected squad,
+    plus the expected points of every player in the next GWs. Every stage is computed lazily and only once,
+    see `Pipeline`.
+    """
+
+    # API tables read by the pipeline
+    API_TABLES = ["elements", "element_types", "teams"]
 
-        # Collect fixtures for next GWs
-        fixtures_future_df = self.fixtures_df[self.fixtures_df["finished"] == False]
-        fixtures_future_df = fixtures_future_df[~np.isnan(fixtures_future_df['event'])]  # Filter out some garbage
+    def __init__(self, exact: bool = False, future_gw_limit: int = FUTURE_GW_LIMIT, teams_limit: int = TEAMS_LIMIT,
+                 fixtures_gw_limit: int = FIXTURES_GW_LIMIT, score_col: str = "form_ppg",
+                 xp_gw_limit: int = XP_GW_LIMIT):
+        self.pipeline = Pipeline()
+        # Use the exact optimizer instead of the greedy selection
+        self.pipeline.add_input("exact", exact)
+        self.pipeline.add_input("future_gw_limit", future_gw_limit)
+        self.pipeline.add_input("teams_limit", teams_limit)
+        self.pipeline.add_input("fixtures_gw_limit", fixtures_gw_limit)
+        # Performance of a player in the selection: 'form_ppg', EXPECTED_POINTS over the next `xp_gw_limit` GWs
+        # or ROLLING_SCORE (points in the last GWs weighted by the strength of the opponents, see feature_store.py)
+        self.pipeline.add_input("score_col", score_col)
+        self.pipeline.add_input("xp_gw_limit", xp_gw_limit)
+        for data_type in self.API_TABLES:
+            self.pipeline.add_stage(f"api_{data_type}", partial(get_base_api_data, data_type))
+        self.pipeline.add_stage("api_fixtures", load_fixtures)
+
+        # Add human-readable info and augment the data
+        self.pipeline.add_stage("elements", self.compute_elements, ["api_elements", "api_element_types", "api_teams"])
         # Add info about home/away performance for next GWs
-        self.collect_matchups(fixtures_future_df)
-        self.augment_matchups()
-        self.calc_relative_strength()
-
-        teams_idx = self.get_team_off_def_idx()
-        def_teams = self.get_best_teams(teams_idx, profile=DEF)
-        off_teams = self.get_best_teams(teams_idx, profile=OFF)
-
-        self.selected_team = select_my_team(self.elements_df, def_teams, off_teams)
-        print(f"Collected {len(self.selected_team)}")
-
-
-    def augment_elements_df(self) -> None:
-        # elements_df - mostly players' data
-        self.elements_df['position'] = self.elements_df.element_type.map(
-        self.element_types_df.set_index('id').singular_name)
-        self.elements_df['team_name'] = self.elements_df.team.map(self.teams_df.set_index('id').name)
-        self.elements_df["form"] = pd.to_numeric(self.elements_df['form'])
-        self.elements_df["points_per_game"] = pd.to_numeric(self.elements_df['points_per_game'])
-        self.elements_df["form_ppg"] = (self.elements_df["form"] + self.elements_df["points_per_game"]) / 2
-        self.elements_df["value_season"] = pd.to_numeric(self.elements_df['value_season'])
-
-
-    def collect_matchups(self, fixtures_future_df: pd.DataFrame) -> None:
-        matchup_info = ['event', 'team_a', 'team_h']
-        self.matchups_df = fixtures_future_df[matchup_info]
-
-    def augment_matchups(self) -> None:
-        self.matchups_df.loc[:, 'team_a_name'] = self.matchups_df.team_a.map(self.teams_df.set_index('id').name)
-        self.matchups_df.loc[:, 'team_h_name'] = self.matchups_df.team_h.map(self.teams_df.set_index('id').name)
-        self.matchups_df.loc[:, 'team_a_strength'] = self.matchups_df.team_a.map(self.teams_df.set_index('id').strength)
-        self.matchups_df.loc[:, 'team_h_strength'] = self.matchups_df.team_h.map(self.teams_df.set_index('id').strength)
-        self.matchups_df.loc[:, 'team_a_strength_away'] = self.matchups_df.team_a.map(
-            self.teams_df.set_index('id').strength_overall_away)
-        self.matchups_df.loc[:, 'team_h_strength_home'] = self.matchups_df.team_h.map(
-            self.teams_df.set_index('id').strength_overall_home)
-        self.matchups_df.loc[:, 'team_a_strength_att_away'] = self.matchups_df.team_a.map(
-            self.teams_df.set_index('id').strength_attack_away)
-        self.matchups_df.loc[:, 'team_h_strength_def_home'] = self.matchups_df.team_h.map(
-            self.teams_df.set_index('id').strength_defence_home)
-        self.matchups_df.loc[:, 'team_a_strength_def_away'] = self.matchups_df.team_a.map(
-            self.teams_df.set_index('id').strength_defence_away)
-        self.matchups_df.loc[:, 'team_h_strength_att_home'] = self.matchups_df.team_h.map(
-            self.teams_df.set_index('id').strength_attack_home)
-
-    def calc_relative_strength(self) -> None:
-        # score showing teams strength diff
-        self.matchups_df.loc[:, "team_h_strength_diff"] = (
-                self.matchups_df["team_h_strength"] - self.matchups_df["team_a_strength"]
-        )
-        # as above, but take into account home/away performance
-        self.matchups_df.loc[:, "team_h_str_ovr_diff"] = (
-                self.matchups_df["team_h_strength_home"] - self.matchups_df["team_a_strength_away"]
-        )
-        # score for forwards/midfielders
-        self.matchups_df.loc[:, "team_h_str_att_diff"] = (
-                self.matchups_df["team_h_strength_att_home"] - self.matchups_df["team_a_strength_def_away"]
-        )
-        # score for defenders/goalkeepers
-        self.matchups_df.loc[:, "team_h_str_def_diff"] = (
-                self.matchups_df["team_h_strength_def_home"] - self.matchups_df["team_a_strength_att_away"]
-        )
-
-    def get_team_off_def_idx(self) -> Dict[Any, Dict[str, Any]]:
-        teams_idx = dict()  # "id": {"name": str, "DEF_IDX": (int), "OFF_IDX": (int)}
-
-        for i in range(len(self.teams_df)):
-            team_id = self.teams_df.iloc[i, self.teams_df.columns.get_loc("id")]
-            teams_idx[team_id] = dict()
-
-            team_name = self.teams_df.iloc[i, self.teams_df.columns.get_loc("name")]
-            teams_idx[team_id]["name"] = team_name
-            # print(f"{team_code}: {team}")
-
-            team_matchups_df = self.matchups_df[(self.matchups_df['team_a'] == team_id) | (self.matchups_df['team_h'] == team_id)]
-            teams_idx[team_id]["DEF_IDX"] = 0
-            teams_idx[team_id]["OFF_IDX"] = 0
-
-            for _, row in team_matchups_df.head(FUTURE_GW_LIMIT).iterrows():
-                if team_id == row["team_h"]:
-                    # DEFENSIVE += team_h_str_def_diff
-                    # OFFENSIVE += team_h_str_att_diff
-                    teams_idx[team_id]["DEF_IDX"] += row['team_h_str_def_diff']
-                    teams_idx[team_id]["OFF_IDX"] += row['team_h_str_att_diff']
-                else:  # team_a
-                    # DEFENSIVE -= team_h_str_att_diff (att_h = -def_a)
-                    # OFFENSIVE -= team_h_str_def_diff (def_h = -att_a)
-                    teams_idx[team_id]["DEF_IDX"] -= row['team_h_str_att_diff']
-                    teams_idx[team_id]["OFF_IDX"] -= row['team_h_str_def_diff']
-        return teams_idx
+        self.pipeline.add_stage("matchups", self.compute_matchups, ["api_fixtures", "api_teams"])
+        self.pipeline.add_stage("teams_idx", self.compute_teams_idx, ["api_teams", "matchups", "future_gw_limit"])
+        self.pipeline.add_stage("best_teams", get_best_teams_by_profile, ["teams_idx", "teams_limit"])
+        self.pipeline.add_stage("difficulty_matrix", self.compute_difficulty_matrix,
+                                ["api_fixtures", "fixtures_gw_limit"])
+        self.pipeline.add_stage("expected_points", self.compute_expected_points,
+                                ["elements", "matchups", "xp_gw_limit"])
+        # Rolling features of the players from the feature store (empty until the season is backfilled)
+        self.pipeline.add_stage("rolling_features", self.compute_rolling_features, ["api_fixtures"])
+        self.pipeline.add_stage("selected_team", self.compute_selected_team,
+                                ["elements", "best_teams", "exact", "score_col", "expected_points",
+                                 "rolling_features"])
+
+    def launch_pipeline(self) -> pd.DataFrame:
+        selected_team = self.pipeline["selected_team"]
+        logger.info("Collected %d", len(selected_team))
+        return selected_team
+
+    def refresh(self) -> None:
+        """Read the API tables again, only the stages depending on the changed ones will be recomputed"""
+        get_client().refresh()
+        self.pipeline.invalidate(*[f"api_{data_type}" for data_type in self.API_TABLES], "api_fixtures")
+
+    @property
+    def elements_df(self) -> pd.DataFrame:
+        return self.pipeline["elements"]
+
+    @property
+    def teams_df(self) -> pd.DataFrame:
+        return self.pipeline["api_teams"]
+
+    @property
+    def fixtures_df(self) -> pd.DataFrame:
+        return self.pipeline["api_fixtures"]
+
+    @property
+    def matchups_df(self) -> pd.DataFrame:
+        return self.pipeline["matchups"]
+
+    @property
+    def selected_team(self) -> pd.DataFrame:
+        return self.pipeline["selected_team"]
+
+    @property
+    def difficulty_matrix_df(self) -> pd.DataFrame:
+        return self.pipeline["difficulty_matrix"]
+
+    @property
+    def expected_points_df(self) -> pd.DataFrame:
+        """Players (by ID) x next GWs"""
+        return self.pipeline["expected_points"]
+
+    @property
+    def rolling_features_df(self) -> pd.DataFrame:
+        """Players (by ID) x rolling features after the last finished GW"""
+        return self.pipeline["rolling_features"]
+
+    # Stage functions, see IncrementalDataProcessor for the ones reusing the results of the previous run
+    def compute_elements(self, elements_df: pd.DataFrame, element_types_df: pd.DataFrame,
+                         teams_df: pd.DataFrame) -> pd.DataFrame:
+        return augment_elements_df(elements_df, element_types_df, teams_df)
+
+    def compute_matchups(self, fixtures_df: pd.DataFrame, teams_df: pd.DataFrame) -> pd.DataFrame:
+        return get_matchups(fixtures_df, teams_df)
+
+    def compute_teams_idx(self, teams_df: pd.DataFrame, matchups_df: pd.DataFrame,
+                          future_gw_limit: int) -> pd.DataFrame:
+        return get_team_off_def_idx(teams_df, matchups_df, future_gw_limit)
+
+    def compute_difficulty_matrix(self, fixtures_df: pd.DataFrame, fixtures_gw_limit: int) -> pd.DataFrame:
+        return get_future_difficulty_matrix(fixtures_df, fixtures_gw_limit)
+
+    def compute_expected_points(self, elements_df: pd.DataFrame, matchups_df: pd.DataFrame,
+                                xp_gw_limit: int) -> pd.DataFrame:
+        return get_expected_points_matrix(elements_df, matchups_df, xp_gw_limit)
 
     @staticmethod
-    def get_best_teams(teams_idx, profile: str, teams_limit: int = TEAMS_LIMIT) -> List[str]:
+    def compute_rolling_features(fixtures_df: pd.DataFrame) -> pd.DataFrame:
+        # the feature store reads Parquet (pyarrow) - imported only by the runs which get this far
+        from ..historical.feature_store import get_current_features
+        return get_current_features(fixtures_df)
+
+    def compute_selected_team(self, elements_df: pd.DataFrame, best_teams: Tuple[List[str], List[str]],
+                              exact: bool, score_col: str, expected_points_df: pd.DataFrame,
+                              rolling_features_df: pd.DataFrame) -> pd.DataFrame:
+        def_teams, off_teams = best_teams
+        if score_col == EXPECTED_POINTS:
+            total = expected_points_df.sum(axis=1)
+            elements_df = elements_df.assign(**{EXPECTED_POINTS: total.reindex(elements_df['id']).to_numpy()})
+            # the opponents are already priced in - players of every team are candidates
+            def_teams = off_teams = elements_df['team_name'].unique().tolist()
+        elif score_col == ROLLING_SCORE:
+            if rolling_features_df.empty:
+                raise ValueError("No rolling features of the current season, collect its GWs first: "
+                                 "python -m data_processing.historical.backfill")
+            from ..historical.feature_store import join_features
+            elements_df = join_features(elements_df, rolling_features_df)
+            # players without a GW in the season haven't scored anything
+            elements_df[ROLLING_SCORE] = elements_df[ROLLING_SCORE].fillna(0)
+        return select_my_team(elements_df, def_teams, off_teams, exact=exact, score_col=score_col)
+
+    def get_team_off_def_idx(self) -> pd.DataFrame:
+        return self.pipeline["teams_idx"]
+
+    @staticmethod
+    def get_best_teams(teams_idx: pd.DataFrame, profile: str, teams_limit: int = TEAMS_LIMIT) -> List[str]:
         if profile == DEF:
             # The best matchups for defence
-            def_teams = sorted(teams_idx.keys(), key=lambda x: (teams_idx[x]['DEF_IDX']), reverse=True)[:teams_limit]
-            teams = [teams_idx[x]['name'] for x in def_teams]
+            teams = teams_idx.nlargest(teams_limit, 'DEF_IDX')['name'].tolist()
         elif profile == OFF:
             # The best matchups for offence
-            off_teams = sorted(teams_idx.keys(), key=lambda x: (teams_idx[x]['OFF_IDX']), reverse=True)[:teams_limit]
-            teams = [teams_idx[x]['name'] for x in off_teams]
+            teams = teams_idx.nlargest(teams_limit, 'OFF_IDX')['name'].tolist()
         else:
             raise ValueError(f"Invalid team profile, choose one from [{DEF}, {OFF}]")
         return teams
+
+
+@profiled()
+def augment_elements_df(elements_df: pd.DataFrame, element_types_df: pd.DataFrame,
+                        teams_df: pd.DataFrame) -> pd.DataFrame:
+    # elements_df - mostly players' data
+    elements_df = elements_df.copy()
+    # numbers are already parsed by the API client (see tools.schema)
+    elements_df['position'] = as_category(elements_df.element_type.map(element_types_df.set_index('id').singular_name),
+                                          element_types_df.singular_name)
+    elements_df['team_name'] = as_category(elements_df.team.map(teams_df.set_index('id').name), teams_df.name)
+    elements_df["form_ppg"] = (elements_df["form"] + elements_df["points_per_game"]) / 2
+    return elements_df
+
+
+def get_matchups(fixtures_df: pd.DataFrame, teams_df: pd.DataFrame) -> pd.DataFrame:
+    """Matchups of the next GWs with the strengths of both teams and their differences"""
+    fixtures_future_df = fixtures_df[fixtures_df["finished"] == False]
+    fixtures_future_df = fixtures_future_df[~np.isnan(fixtures_future_df['event'])]  # Filter out some garbage
+    matchups_df = collect_matchups(fixtures_future_df)
+    matchups_df = augment_matchups(matchups_df, teams_df)
+    return calc_relative_strength(matchups_df)
+
+
+@profiled()
+def collect_matchups(fixtures_future_df: pd.DataFrame) -> pd.DataFrame:
+    matchup_info = ['event', 'team_a', 'team_h']
+    return fixtures_future_df[matchup_info].copy()
+
+
+@profiled()
+def augment_matchups(matchups_df: pd.DataFrame, teams_df: pd.DataFrame) -> pd.DataFrame:
+    teams_df = teams_df.set_index('id')
+    team_a_df = teams_df.loc[matchups_df.team_a]
+    team_h_df = teams_df.loc[matchups_df.team_h]
+    matchups_df['team_a_name'] = team_a_df['name'].to_numpy()
+    matchups_df['team_h_name'] = team_h_df['name'].to_numpy()
+    matchups_df['team_a_strength'] = team_a_df['strength'].to_numpy()
+    matchups_df['team_h_strength'] = team_h_df['strength'].to_numpy()
+    matchups_df['team_a_strength_away'] = team_a_df['strength_overall_away'].to_numpy()
+    matchups_df['team_h_strength_home'] = team_h_df['strength_overall_home'].to_numpy()
+    matchups_df['team_a_strength_att_away'] = team_a_df['strength_attack_away'].to_numpy()
+    matchups_df['team_h_strength_def_home'] = team_h_df['strength_defence_home'].to_numpy()
+    matchups_df['team_a_strength_def_away'] = team_a_df['strength_defence_away'].to_numpy()
+    matchups_df['team_h_strength_att_home'] = team_h_df['strength_attack_home'].to_numpy()
+    return matchups_df
+
+
+def calc_relative_strength(matchups_df: pd.DataFrame) -> pd.DataFrame:
+    # score showing teams strength diff
+    matchups_df.loc[:, "team_h_strength_diff"] = (
+            matchups_df["team_h_strength"] - matchups_df["team_a_strength"]
+    )
+    # as above, but take into account home/away performance
+    matchups_df.loc[:, "team_h_str_ovr_diff"] = (
+            matchups_df["team_h_strength_home"] - matchups_df["team_a_strength_away"]
+    )
+    # score for forwards/midfielders
+    matchups_df.loc[:, "team_h_str_att_diff"] = (
+            matchups_df["team_h_strength_att_home"] - matchups_df["team_a_strength_def_away"]
+    )
+    # score for defenders/goalkeepers
+    matchups_df.loc[:, "team_h_str_def_diff"] = (
+            matchups_df["team_h_strength_def_home"] - matchups_df["team_a_strength_att_away"]
+    )
+    return matchups_df
+
+
+@profiled()
+def get_team_off_def_idx(teams_df: pd.DataFrame, matchups_df: pd.DataFrame,
+                         future_gw_limit: int = FUTURE_GW_LIMIT) -> pd.DataFrame:
+    """
+    Sum the strength differences of each team's next `future_gw_limit` matchups.
+
+    :return: DataFrame indexed by team ID, with 'name', 'DEF_IDX' and 'OFF_IDX' columns
+    """
+    order = np.arange(len(matchups_df))
+    att_diff = matchups_df['team_h_str_att_diff'].to_numpy()
+    def_diff = matchups_df['team_h_str_def_diff'].to_numpy()
+    # One row per team per matchup, seen from this team's perspective
+    team_matchups_df = pd.DataFrame({
+        "team": np.concatenate([matchups_df['team_h'].to_numpy(), matchups_df['team_a'].to_numpy()]),
+        "order": np.concatenate([order, order]),
+        # home: DEFENSIVE += team_h_str_def_diff, OFFENSIVE += team_h_str_att_diff
+        # away: DEFENSIVE -= team_h_str_att_diff (att_h = -def_a), OFFENSIVE -= team_h_str_def_diff (def_h = -att_a)
+        "DEF_IDX": np.concatenate([def_diff, -att_diff]),
+        "OFF_IDX": np.concatenate([att_diff, -def_diff]),
+    }).sort_values("order", kind="stable")
+
+    next_matchups_df = team_matchups_df.groupby("team", sort=False).head(future_gw_limit)
+    sums_df = next_matchups_df.groupby("team")[["DEF_IDX", "OFF_IDX"]].sum()
+
+    teams_idx = teams_df.set_index('id')[['name']].join(sums_df)
+    teams_idx[["DEF_IDX", "OFF_IDX"]] = teams_idx[["DEF_IDX", "OFF_IDX"]].fillna(0).astype(sums_df.dtypes)
+    return teams_idx
+
+
+def get_best_teams_by_profile(teams_idx: pd.DataFrame, teams_limit: int = TEAMS_LIMIT) -> Tuple[List[str], List[str]]:
+    """Names of the teams with the best defensive and offensive matchups"""
+    return (ActualDataProcessor.get_best_teams(teams_idx, DEF, teams_limit),
+            ActualDataProcessor.get_best_teams(teams_idx, OFF, teams_limit))
@@ -0,0 +1,135 @@
+"""
+"What-if" squads: many budgets, horizons, team limits, locked/excluded players and squad LIMITS evaluated at once,
+on the data already loaded by an ActualDataProcessor (nothing is downloaded again).
+
+    scenarios = scenario_grid(budgets=[950, 1000, 1050], horizons=[3, 5, 8], locked=[[], [328]])
+    squads_df = evaluate_scenarios(processor, scenarios)
+"""
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from .act_team_selection import PLAYER_DETAIL_COLS, select_optimal_my_team
+from .process_actual_data import (ActualDataProcessor, FUTURE_GW_LIMIT, TEAMS_LIMIT, get_best_teams_by_profile,
+                                  get_team_off_def_idx)
+from ..constants import BUDGET, LIMITS
+from ..tools.fixtures import get_difficulty_matrix, get_fixture_difficulty, get_players_difficulty
+
+logger = logging.getLogger(__name__)
+
+# Columns of the result: the scenario and its squad totals, then the selected player
+SCENARIO_COLS = ['scenario', 'budget', 'horizon', 'teams_limit', 'locked', 'excluded', 'limits',
+                 'status', 'squad_cost', 'squad_score']
+SQUAD_COLS = ['id', 'first_name', 'second_name', 'position', 'team_name', 'now_cost', 'form_ppg']
+
+
+class Scenario(NamedTuple):
+    budget: int = BUDGET
+    # How many next GWs are considered in the team index and the fixtures difficulty
+    horizon: int = FUTURE_GW_LIMIT
+    teams_limit: int = TEAMS_LIMIT
+    locked: Tuple[int, ...] = ()
+    excluded: Tuple[int, ...] = ()
+    # None - the default LIMITS
+    limits: Optional[Dict[str, Any]] = None
+
+
+def scenario_grid(budgets: Iterable[int] = (BUDGET,), horizons: Iterable[int] = (FUTURE_GW_LIMIT,),
+                  teams_limits: Iterable[int] = (TEAMS_LIMIT,), locked: Iterable[Sequence[int]] = ((),),
+                  excluded: Iterable[Sequence[int]] = ((),),
+                  limits: Iterable[Optional[Dict[str, Any]]] = (None,)) -> List[Scenario]:
+    """Every combination of the given values"""
+    return [Scenario(budget, horizon, teams_limit, tuple(locked_ids), tuple(excluded_ids), scenario_limits)
+            for budget, horizon, teams_limit, locked_ids, excluded_ids, scenario_limits
+            in itertools.product(budgets, horizons, teams_limits, locked, excluded, limits)]
+
+
+def describe_limits(limits: Dict[str, Any]) -> str:
+    """e.g. '2-5-5-3, 3 per club'"""
+    positions = "-".join(str(count) for count in limits['position'].values())
+    return f"{positions}, {limits['one_team']} per club"
+
+
+def evaluate_scenarios(processor: ActualDataProcessor, scenarios: Sequence[Scenario],
+                       max_workers: Optional[int] = None) -> pd.DataFrame:
+    """
+    Select the best squad of every scenario (with the exact optimizer).
+    The team index, the best teams and the fixtures difficulty are computed once per distinct horizon/teams limit,
+    the squads are solved in a pool of processes.
+
+    :return: one row per selected player per scenario, with the scenario parameters and the squad totals;
+             a scenario without any valid squad has a single row with the reason in 'status'
+    """
+    players_df = processor.elements_df[PLAYER_DETAIL_COLS]
+    teams_df = processor.teams_df
+    matchups_df = processor.matchups_df
+    future_fixtures_df = processor.fixtures_df[processor.fixtures_df["finished"] == False]
+    fixture_difficulty_df = get_fixture_difficulty(future_fixtures_df)
+
+    teams_idx = {horizon: get_team_off_def_idx(teams_df, matchups_df, horizon)
+                 for horizon in {scenario.horizon for scenario in scenarios}}
+    best_teams = {(horizon, teams_limit): get_best_teams_by_profile(teams_idx[horizon], teams_limit)
+                  for horizon, teams_limit in {(scenario.horizon, scenario.teams_limit) for scenario in scenarios}}
+    difficulty = dict()
+    for horizon in teams_idx:
+        matrix_df = get_difficulty_matrix(fixture_difficulty_df, horizon)
+        difficulty[horizon] = pd.Series(get_players_difficulty(players_df, matrix_df).to_numpy(),
+                                        index=players_df['id'])
+
+    tasks = [(number, scenario, best_teams[(scenario.horizon, scenario.teams_limit)], difficulty[scenario.horizon])
+             for number, scenario in enumerate(scenarios)]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    logger.info("Evaluating %d scenarios in %d process(es)", len(tasks), max_workers)
+    if max_workers <= 1:
+        _init_worker(players_df)
+        results = [_evaluate(task) for task in tasks]
+    else:
+        # the players are sent once per worker, not once per scenario
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(players_df,)) as executor:
+            results = list(executor.map(_evaluate, tasks, chunksize=max(1, len(tasks) // (4 * max_workers))))
+    # infeasible scenarios have no player - keep the integer columns integer
+    return pd.concat(results, ignore_index=True).astype({'id': 'Int64', 'now_cost': 'Int64', 'squad_cost': 'Int64'})
+
+
+def summarize_scenarios(squads_df: pd.DataFrame) -> pd.DataFrame:
+    """One row per scenario: its parameters, status and squad totals"""
+    return squads_df.groupby('scenario', sort=True)[SCENARIO_COLS[1:]].first()
+
+
+# Players of the processor, set once in every worker process
+_players_df: Optional[pd.DataFrame] = None
+
+
+def _init_worker(players_df: pd.DataFrame) -> None:
+    global _players_df
+    _players_df = players_df
+
+
+def _evaluate(task: Tuple[int, Scenario, Tuple[List[str], List[str]], pd.Series]) -> pd.DataFrame:
+    number, scenario, (def_teams, off_teams), difficulty = task
+    limits = scenario.limits or LIMITS
+    info = {
+        'scenario': number,
+        'budget': scenario.budget,
+        'horizon': scenario.horizon,
+        'teams_limit': scenario.teams_limit,
+        'locked': scenario.locked,
+        'excluded': scenario.excluded,
+        'limits': describe_limits(limits),
+    }
+    try:
+        squad_df = select_optimal_my_team(_players_df, def_teams, off_teams, budget=scenario.budget, limits=limits,
+                                          locked=scenario.locked, excluded=scenario.excluded)
+    except ValueError as err:
+        return pd.DataFrame([{**info, 'status': str(err)}], columns=SCENARIO_COLS)
+
+    squad_df = squad_df[SQUAD_COLS].reset_index(drop=True)
+    squad_df['fixtures_difficulty'] = squad_df['id'].map(difficulty)
+    squad_df['locked_player'] = squad_df['id'].isin(scenario.locked)
+    info.update(status="optimal", squad_cost=squad_df['now_cost'].sum(), squad_score=squad_df['form_ppg'].sum())
+    scenario_df = pd.DataFrame({col: [info[col]] * len(squad_df) for col in SCENARIO_COLS})
+    return pd.concat([scenario_df, squad_df], axis=1)
@@ -0,0 +1,333 @@
+"""
+Monte Carlo simulation of the next gameweek, for the variance the expected points don't show.
+Per player and fixture: playing (chance of playing x share of GWs played), 60+ minutes (share of starts),
+goals and assists (Poisson of the expected goal involvements per 90) and the goals conceded by the team (Poisson,
+shared by its players - clean sheets of a defence come together), both scaled by the fixture difficulty
+(`team_h/a_difficulty`) with factors fitted on the historical fixtures in data/historical.
+
+The squad scores its XI (picked by expected points before the deadline) with automatic substitutions of players
+who didn't play (formation not checked) and the captain's points doubled (the vice-captain's if the captain
+didn't play). Bonus points and cards are not simulated.
+
+Simulations run in chunks of vectorized NumPy draws, spread over a pool of processes; every chunk has its own
+seed spawned from one SeedSequence, so the results only depend on `seed`, not on the number of processes.
+
+    squads_df, players_df = simulate_squads(processor, {"selected": my_team_df}, n_sims=100_000)
+"""
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .expected_points import ASSIST_POINTS, CLEAN_SHEET_POINTS, CONCEDED_POINTS, EXPECTED_POINTS, GOAL_POINTS, \
+    GOAL_SHARE
+from .process_actual_data import ActualDataProcessor
+from ..constants import HISTORICAL_DIR
+from ..tools.profiling import profiled
+from ..tools.report import write_workbook
+
+logger = logging.getLogger(__name__)
+
+# Simulated gameweeks of every squad, drawn in chunks of CHUNK_SIZE
+SIMULATIONS = 100_000
+CHUNK_SIZE = 10_000
+PERCENTILES = [5, 10, 25, 50, 75, 90, 95]
+# The worst share of the simulations averaged as the downside risk (expected shortfall)
+DOWNSIDE_SHARE = 0.1
+# A player's GW of at most 2 points is a blank
+BLANK_POINTS = 2
+# Minutes of an appearance of 60+ minutes and of a shorter one
+FULL_MINUTES = 85
+CAMEO_MINUTES = 25
+DIFFICULTIES = pd.RangeIndex(1, 6, name="difficulty")
+# -1 for every 2 goals conceded, by element_type
+CONCEDED_PENALTY = (CONCEDED_POINTS * 2).astype(int)
+STARTING_MINIMUM = {"Goalkeeper": 1, "Defender": 3, "Midfielder": 2, "Forward": 1}
+STARTING_XI = 11
+
+
+class SimulationInputs(NamedTuple):
+    """Parameters of the players (P) and of the teams in the GW's fixtures (F), as arrays"""
+    element_type: np.ndarray
+    # chance of playing at all and of 60+ minutes when playing
+    play_prob: np.ndarray
+    full_prob: np.ndarray
+    goals_90: np.ndarray
+    assists_90: np.ndarray
+    # P x fixtures of the GW: index of the team's fixture (F), -1 for none
+    fixture_idx: np.ndarray
+    # F: attack factor of the team and its expected goals conceded in the fixture
+    attack: np.ndarray
+    conceded: np.ndarray
+
+
+class Lineup(NamedTuple):
+    starters: List[int]
+    # in the order of the substitutions, the goalkeeper first
+    bench: List[int]
+    captain: int
+    vice_captain: int
+
+
+def fit_difficulty_factors(historical_dir: str = HISTORICAL_DIR) -> pd.DataFrame:
+    """
+    Goals scored and conceded by a team facing each fixture difficulty (FDR 1-5), relative to the average,
+    from the finished fixtures of the historical seasons (1.0 where there is no data)
+    """
+    columns = ['finished', 'team_h_score', 'team_a_score', 'team_h_difficulty', 'team_a_difficulty']
+    paths = sorted(glob.glob(os.path.join(historical_dir, "*", "fixtures.csv")))
+    fixtures_df = pd.concat([pd.read_csv(path, usecols=columns) for path in paths]) if paths else pd.DataFrame()
+    if fixtures_df.empty:
+        logger.warning("No historical fixtures in %s, the fixture difficulty is ignored", historical_dir)
+        return pd.DataFrame(1.0, index=DIFFICULTIES, columns=['scored', 'conceded'])
+    fixtures_df = fixtures_df[fixtures_df['finished'].astype(str) == "True"].dropna()
+
+    # one row per team per fixture: the difficulty it faced, goals scored and conceded
+    difficulty = pd.concat([fixtures_df['team_h_difficulty'], fixtures_df['team_a_difficulty']], ignore_index=True)
+    scored = pd.concat([fixtures_df['team_h_score'], fixtures_df['team_a_score']], ignore_index=True)
+    conceded = pd.concat([fixtures_df['team_a_score'], fixtures_df['team_h_score']], ignore_index=True)
+    goals_df = pd.DataFrame({'scored': scored, 'conceded': conceded})
+    factors_df = goals_df.groupby(difficulty.astype(int)).mean() / goals_df.mean()
+    logger.debug("Fixture difficulty factors from %d fixtures:\n%s", len(fixtures_df), factors_df)
+    return factors_df.reindex(DIFFICULTIES).fillna(1.0)
+
+
+def get_simulation_inputs(players_df: pd.DataFrame, elements_df: pd.DataFrame, fixtures_df: pd.DataFrame,
+                          event: int, factors_df: pd.DataFrame) -> SimulationInputs:
+    """
+    :param players_df: the simulated players, in the order of the result
+    :param elements_df: all players (the teams' expected goals conceded come from all of them)
+    :param fixtures_df: API fixtures with 'team_h/a_difficulty'
+    """
+    played_gws = max(event - 1, 1)
+    minutes = players_df['minutes'].to_numpy(dtype=float)
+    starts = players_df['starts'].to_numpy(dtype=float)
+    per_90 = np.divide(90, minutes, out=np.zeros_like(minutes), where=minutes > 0)
+    xgi_90 = players_df['expected_goal_involvements'].to_numpy(dtype=float) * per_90
+    element_type = players_df['element_type'].to_numpy(dtype=int)
+    availability = (players_df['chance_of_playing_next_round']
+                    .fillna(players_df['chance_of_playing_this_round'])
+                    .fillna(100).to_numpy(dtype=float) / 100)
+    start_rate = np.clip(starts / played_gws, 0, 1)
+    play_rate = np.clip(np.minimum(minutes / played_gws, 90) / 60, start_rate, 1)
+    full_prob = np.divide(start_rate, play_rate, out=np.zeros_like(play_rate), where=play_rate > 0)
+
+    # expected goals conceded per 90 minutes of every team: the minutes-weighted average of its players
+    team_minutes = elements_df.groupby('team')['minutes'].sum()
+    team_xgc_90 = (90 * elements_df.groupby('team')['expected_goals_conceded'].sum()
+                   / team_minutes.where(team_minutes > 0))
+    team_xgc_90 = team_xgc_90.fillna(team_xgc_90.mean())
+
+    # one row per team per fixture of the GW
+    gw_fixtures_df = fixtures_df[(fixtures_df['event'] == event) & (fixtures_df['finished'] == False)]
+    team = np.concatenate([gw_fixtures_df['team_h'].to_numpy(), gw_fixtures_df['team_a'].to_numpy()])
+    difficulty = np.concatenate([gw_fixtures_df['team_h_difficulty'].to_numpy(),
+                                 gw_fixtures_df['team_a_difficulty'].to_numpy()]).astype(int)
+    attack = factors_df['scored'].reindex(difficulty).to_numpy()
+    conceded = (team_xgc_90.reindex(team).to_numpy()
+                * factors_df['conceded'].reindex(difficulty).to_numpy())
+
+    # fixtures of each player's team (two in a double GW, none in a blank one)
+    team_fixtures = pd.Series(np.arange(len(team))).groupby(team).agg(list)
+    player_fixtures = players_df['team'].map(team_fixtures)
+    max_fixtures = max([len(fixtures) for fixtures in team_fixtures] + [1])
+    fixture_idx = np.full((len(players_df), max_fixtures), -1)
+    for row, fixtures in enumerate(player_fixtures):
+        if isinstance(fixtures, list):
+            fixture_idx[row, :len(fixtures)] = fixtures
+
+    return SimulationInputs(element_type, availability * play_rate, full_prob, xgi_90 * GOAL_SHARE[element_type],
+                            xgi_90 * (1 - GOAL_SHARE[element_type]), fixture_idx, attack, conceded)
+
+
+def simulate_players(inputs: SimulationInputs, n_sims: int,
+                     rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """:return: (points, played) of every player (rows) in every simulation (columns)"""
+    n_players = len(inputs.element_type)
+    points = np.zeros((n_sims, n_players), dtype=np.int16)
+    played = np.zeros((n_sims, n_players), dtype=bool)
+    if not len(inputs.conceded):
+        # a blank GW for everyone
+        return points.T, played.T
+    team_conceded = rng.poisson(inputs.conceded, size=(n_sims, len(inputs.conceded)))
+    element_type = inputs.element_type
+    for k in range(inputs.fixture_idx.shape[1]):
+        fixture = inputs.fixture_idx[:, k]
+        has_fixture = fixture >= 0
+        plays = rng.random((n_sims, n_players)) < inputs.play_prob * has_fixture
+        full = plays & (rng.random((n_sims, n_players)) < inputs.full_prob)
+        minutes = np.where(full, FULL_MINUTES, np.where(plays, CAMEO_MINUTES, 0))
+        attack = np.where(has_fixture, inputs.attack[fixture], 0)
+        goals = rng.poisson(inputs.goals_90 * attack * minutes / 90)
+        assists = rng.poisson(inputs.assists_90 * attack * minutes / 90)
+        conceded = np.where(has_fixture, team_conceded[:, fixture], 0)
+        points += (plays.astype(np.int16) + full
+                   + goals * GOAL_POINTS[element_type] + assists * ASSIST_POINTS
+                   + full * (conceded == 0) * CLEAN_SHEET_POINTS[element_type]
+                   + full * (conceded // 2) * CONCEDED_PENALTY[element_type]).astype(np.int16)
+        played |= plays
+    return points.T, played.T
+
+
+def pick_lineup(squad_df: pd.DataFrame, xp: pd.Series) -> Lineup:
+    """The XI with the most expected points in a valid formation, the bench and the captains"""
+    squad_df = squad_df.assign(xp=xp.reindex(squad_df['id']).fillna(0).to_numpy())
+    squad_df = squad_df.sort_values('xp', ascending=False, kind="stable")
+    position = squad_df['position'].astype(str)
+    starters = list()
+    for pos, minimum in STARTING_MINIMUM.items():
+        starters += squad_df.loc[position == pos, 'id'].head(minimum).tolist()
+    outfield = squad_df.loc[(position != "Goalkeeper") & ~squad_df['id'].isin(starters), 'id'].tolist()
+    starters += outfield[:STARTING_XI - len(starters)]
+    bench = (squad_df.loc[(position == "Goalkeeper") & ~squad_df['id'].isin(starters), 'id'].tolist()
+             + [player for player in outfield if player not in starters])
+    by_xp = [player for player in squad_df['id'] if player in starters]
+    return Lineup(starters, bench, by_xp[0], by_xp[1])
+
+
+def get_squad_points(points: np.ndarray, played: np.ndarray, rows: Dict[int, int], lineup: Lineup,
+                     positions: Dict[int, str]) -> np.ndarray:
+    """Points of the squad in every simulation"""
+    starters = [rows[player] for player in lineup.starters]
+    total = points[starters].sum(axis=0, dtype=np.int32)
+
+    # automatic substitutions: the goalkeeper for the goalkeeper, outfield players in the bench order
+    goalkeepers = [rows[player] for player in lineup.starters if positions[player] == "Goalkeeper"]
+    bench_goalkeepers = [rows[player] for player in lineup.bench if positions[player] == "Goalkeeper"]
+    if goalkeepers and bench_goalkeepers:
+        total += np.where(played[goalkeepers[0]], 0, points[bench_goalkeepers[0]])
+    outfield = [rows[player] for player in lineup.starters if positions[player] != "Goalkeeper"]
+    bench_outfield = [rows[player] for player in lineup.bench if positions[player] != "Goalkeeper"]
+    if outfield and bench_outfield:
+        missing = (~played[outfield]).sum(axis=0)
+        bench_played = played[bench_outfield]
+        coming_on = bench_played & (np.cumsum(bench_played, axis=0) <= missing)
+        total += (points[bench_outfield] * coming_on).sum(axis=0)
+
+    captain, vice_captain = rows[lineup.captain], rows[lineup.vice_captain]
+    total += np.where(played[captain], points[captain], np.where(played[vice_captain], points[vice_captain], 0))
+    return total
+
+
+# Inputs of the simulation, set once in every worker process
+_inputs: Optional[SimulationInputs] = None
+
+
+def _init_worker(inputs: SimulationInputs) -> None:
+    global _inputs
+    _inputs = inputs
+
+
+def _simulate_chunk(task: Tuple[int, np.random.SeedSequence]) -> Tuple[np.ndarray, np.ndarray]:
+    n_sims, seed_seq = task
+    return simulate_players(_inputs, n_sims, np.random.default_rng(seed_seq))
+
+
+def run_simulations(inputs: SimulationInputs, n_sims: int = SIMULATIONS, seed: int = 0,
+                    chunk_size: int = CHUNK_SIZE, max_workers: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """(points, played) of every player in `n_sims` simulations, drawn in chunks in a pool of processes"""
+    sizes = [chunk_size] * (n_sims // chunk_size) + ([n_sims % chunk_size] if n_sims % chunk_size else [])
+    tasks = list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    logger.info("Simulating %d gameweeks of %d players in %d chunk(s), %d process(es)", n_sims,
+                len(inputs.element_type), len(tasks), max_workers)
+    if max_workers <= 1:
+        _init_worker(inputs)
+        results = [_simulate_chunk(task) for task in tasks]
+    else:
+        # the inputs are sent once per worker, not once per chunk
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(inputs,)) as executor:
+            results = list(executor.map(_simulate_chunk, tasks))
+    return np.hstack([points for points, _ in results]), np.hstack([played for _, played in results])
+
+
+@profiled()
+def simulate_squads(processor: ActualDataProcessor, squads: Dict[str, pd.DataFrame], n_sims: int = SIMULATIONS,
+                    seed: int = 0, max_workers: Optional[int] = None,
+                    historical_dir: str = HISTORICAL_DIR) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Simulate the next GW of every squad; all of them share the same simulated GWs of their players.
+
+    :param squads: name -> squad (with 'id')
+    :return: (one row per squad: points percentiles, mean, downside risk;
+              one row per player of every squad: role, points percentiles, blank chance and captaincy value)
+    """
+    elements_df = processor.elements_df
+    xp_df = processor.expected_points_df
+    if xp_df.columns.empty:
+        raise ValueError("No future fixtures to simulate")
+    event = int(xp_df.columns[0])
+    xp = xp_df[event]
+    player_ids = list(dict.fromkeys(pid for squad_df in squads.values() for pid in squad_df['id']))
+    players_df = elements_df.set_index('id', drop=False).loc[player_ids]
+    rows = {pid: row for row, pid in enumerate(player_ids)}
+    positions = players_df['position'].astype(str).to_dict()
+
+    inputs = get_simulation_inputs(players_df, elements_df, processor.fixtures_df, event,
+                                   fit_difficulty_factors(historical_dir))
+    points, played = run_simulations(inputs, n_sims, seed, max_workers=max_workers)
+
+    squad_rows = list()
+    player_rows = list()
+    for name, squad_df in squads.items():
+        lineup = pick_lineup(squad_df, xp)
+        total = get_squad_points(points, played, rows, lineup, positions)
+        worst = np.sort(total)[:max(int(len(total) * DOWNSIDE_SHARE), 1)]
+        squad_rows.append({
+            'squad': name,
+            'event': event,
+            'captain': players_df.at[lineup.captain, 'web_name'],
+            EXPECTED_POINTS: round(float(xp.reindex(lineup.starters).sum() + xp.get(lineup.captain, 0)), 2),
+            'mean': total.mean().round(2),
+            'std': total.std().round(2),
+            **{f"p{q}": value for q, value in zip(PERCENTILES, np.percentile(total, PERCENTILES))},
+            f"mean_worst_{int(DOWNSIDE_SHARE * 100)}%": worst.mean().round(2),
+        })
+        for player in lineup.starters + lineup.bench:
+            player_points = points[rows[player]]
+            role = ("captain" if player == lineup.captain else "vice-captain" if player == lineup.vice_captain
+                    else "starter" if player in lineup.starters else "bench")
+            player_rows.append({
+                'squad': name,
+                'id': player,
+                'web_name': players_df.at[player, 'web_name'],
+                'position': positions[player],
+                'role': role,
+                EXPECTED_POINTS: round(float(xp.get(player, 0)), 2),
+                'mean': player_points.mean().round(2),
+                'p10': np.percentile(player_points, 10),
+                'p90': np.percentile(player_points, 90),
+                'play_chance': played[rows[player]].mean().round(3),
+                'blank_chance': (player_points <= BLANK_POINTS).mean().round(3),
+                # points added by the armband: the player's points, or the vice-captain's when they don't play
+                'captaincy_ev': np.where(played[rows[player]], player_points,
+                                         points[rows[lineup.vice_captain if player != lineup.vice_captain
+                                                     else lineup.captain]]).mean().round(2),
+            })
+    return pd.DataFrame(squad_rows), pd.DataFrame(player_rows)
+
+
+def get_alternative_squads(processor: ActualDataProcessor, exact: bool, score_col: str) -> Dict[str, pd.DataFrame]:
+    """The squads of the other selection modes (greedy/exact x form_ppg/expected points), on the loaded data"""
+    squads = dict()
+    for alt_exact in (False, True):
+        for alt_score in ("form_ppg", EXPECTED_POINTS):
+            if (alt_exact, alt_score) == (exact, score_col):
+                continue
+            processor.pipeline.set_input("exact", alt_exact)
+            processor.pipeline.set_input("score_col", alt_score)
+            squad_df = processor.selected_team
+            if len(squad_df):
+                squads[f"{'exact' if alt_exact else 'greedy'} {alt_score}"] = squad_df
+    processor.pipeline.set_input("exact", exact)
+    processor.pipeline.set_input("score_col", score_col)
+    return squads
+
+
+def save_simulation_report(squads_df: pd.DataFrame, players_df: pd.DataFrame, path: str) -> None:
+    write_workbook({"squads": squads_df, "players": players_df}, path)
+    logger.info("Simulation report saved: %s", path)
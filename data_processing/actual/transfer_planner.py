@@ -0,0 +1,359 @@
+"""
+Transfers of an existing squad over the next gameweeks: which players to sell and buy, in which GW, and when
+a -4 hit pays off - maximizing the projected points of the starting XI (captain counted twice).
+
+The search goes GW by GW over states (squad, bank, free transfers). States reached by different transfer
+sequences are merged (only the best one is kept), the squad values are memoized, and only the `beam_width`
+most promising states survive each GW - ranked by the points so far plus the points of keeping the squad
+until the end of the horizon. Moves are single transfers to the best `pool_size` players of each position,
+and pairs of the most valuable single transfers.
+
+    plan = plan_transfers(processor, squad_ids=[...], bank=15, free_transfers=2)
+    plan_to_frame(plan)
+
+Usage: python -m data_processing.actual.transfer_planner --squad ID [ID ...] [--bank 15] [--free-transfers 1]
+                                                          [--horizon 5] [--offline]
+"""
+import argparse
+import itertools
+import logging
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .expected_points import XP_GW_LIMIT, get_expected_points_matrix
+from .process_actual_data import ActualDataProcessor
+from ..constants import LIMITS
+from ..tools.fpl_api import FplApiClient, set_client
+from ..tools.logs import setup_logging
+from ..tools.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
+# Points deducted for every transfer above the free ones
+HIT_COST = 4
+# Free transfers are rolled over up to this number
+MAX_FREE_TRANSFERS = 5
+# States kept after every GW
+BEAM_WIDTH = 40
+# Best players of each position considered as transfer targets
+POOL_SIZE = 12
+# Most transfers in one GW
+MAX_TRANSFERS = 2
+# Single transfers combined into pairs
+PAIR_CANDIDATES = 20
+# Positions in the order of the squad slots, with the least players of each one in the starting XI
+POSITIONS = ["Goalkeeper", "Defender", "Midfielder", "Forward"]
+MIN_STARTING = {"Goalkeeper": 1, "Defender": 3, "Midfielder": 2, "Forward": 1}
+STARTING_XI = 11
+
+
+class PlanStep(NamedTuple):
+    event: int
+    transfers_out: Tuple[int, ...]
+    transfers_in: Tuple[int, ...]
+    hits: int
+    bank: int
+    free_transfers: int
+    points: float
+    captain: int
+
+
+class TransferPlan(NamedTuple):
+    # projected points over the horizon, hits already deducted
+    total_points: float
+    # points of the same horizon without any transfer
+    hold_points: float
+    steps: List[PlanStep]
+
+
+class PlanningData(NamedTuple):
+    """Everything the search needs about the players - plain arrays, one row per player (see get_planning_data)"""
+    ids: np.ndarray
+    # index in POSITIONS
+    positions: np.ndarray
+    teams: np.ndarray
+    cost: np.ndarray
+    # not ruled out of the next GW
+    available: np.ndarray
+    # players x GWs of the horizon
+    xp: np.ndarray
+    events: Tuple[int, ...]
+
+
+class _State(NamedTuple):
+    squad: Tuple[int, ...]
+    bank: int
+    free_transfers: int
+    points: float
+    # the state of the previous GW and the transfers made from it (squad slots sold, players bought);
+    # the plan's steps are only built for the best final state
+    parent: Optional["_State"] = None
+    outs: Tuple[int, ...] = ()
+    ins: Tuple[int, ...] = ()
+
+
+class SquadEvaluator:
+    """Points of squads in every GW of the horizon; a squad is a tuple of player indices ordered by the slots"""
+
+    def __init__(self, xp: np.ndarray, slots: Dict[str, slice]):
+        self.xp = xp
+        self.slots = slots
+        self._cache: Dict[Tuple[int, ...], np.ndarray] = dict()
+
+    def __call__(self, squad: Tuple[int, ...]) -> np.ndarray:
+        if squad not in self._cache:
+            self.evaluate_many([squad])
+        return self._cache[squad]
+
+    def evaluate_many(self, squads: List[Tuple[int, ...]]) -> None:
+        """Evaluates the squads not seen yet in one go"""
+        new_squads = [squad for squad in dict.fromkeys(squads) if squad not in self._cache]
+        if not new_squads:
+            return
+        squads_xp = self.xp[np.asarray(new_squads)]
+        starting = 0
+        bench = list()
+        best = list()
+        for position in POSITIONS:
+            # squads x players of the position x GWs, best first
+            sorted_xp = -np.sort(-squads_xp[:, self.slots[position]], axis=1)
+            starting = starting + sorted_xp[:, :MIN_STARTING[position]].sum(axis=1)
+            if position != POSITIONS[0]:
+                # a 2nd goalkeeper never plays - the XI has exactly one
+                bench.append(sorted_xp[:, MIN_STARTING[position]:])
+            best.append(sorted_xp[:, 0])
+        # the rest of the XI: the best of the outfield players above the minimum of their position
+        free_places = STARTING_XI - sum(MIN_STARTING.values())
+        outfield_bench = -np.sort(-np.concatenate(bench, axis=1), axis=1)
+        # the captain is the best player of the XI - always the best one of some position
+        points = starting + outfield_bench[:, :free_places].sum(axis=1) + np.max(best, axis=0)
+        self._cache.update(zip(new_squads, points))
+
+    def captain(self, squad: Tuple[int, ...], t: int) -> int:
+        """Index of the squad's best player of the XI in the t-th GW"""
+        goalkeepers = list(squad[self.slots[POSITIONS[0]]])
+        candidates = [max(goalkeepers, key=lambda player: self.xp[player, t])] + list(
+            squad[self.slots[POSITIONS[0]].stop:])
+        return max(candidates, key=lambda player: self.xp[player, t])
+
+    @property
+    def evaluated(self) -> int:
+        return len(self._cache)
+
+
+def get_planning_data(processor: ActualDataProcessor, horizon: int = XP_GW_LIMIT) -> PlanningData:
+    """The players of the processor and their expected points in the next `horizon` GWs"""
+    elements_df = processor.elements_df
+    xp_df = get_expected_points_matrix(elements_df, processor.matchups_df, horizon)
+    return PlanningData(
+        ids=elements_df['id'].to_numpy(dtype=np.int32),
+        positions=elements_df['position'].astype(str).map({pos: n for n, pos in enumerate(POSITIONS)})
+        .fillna(-1).to_numpy(dtype=np.int8),
+        teams=elements_df['team'].to_numpy(dtype=np.int32),
+        cost=elements_df['now_cost'].to_numpy(dtype=np.int32),
+        available=(elements_df['chance_of_playing_next_round'].fillna(100) > 0).to_numpy(),
+        xp=xp_df.reindex(elements_df['id'].to_numpy()).fillna(0).to_numpy(dtype=np.float64),
+        events=tuple(int(event) for event in xp_df.columns))
+
+
+@profiled()
+def plan_transfers(processor: ActualDataProcessor, squad_ids: Sequence[int], bank: int = 0,
+                   free_transfers: int = 1, horizon: int = XP_GW_LIMIT, beam_width: int = BEAM_WIDTH,
+                   max_transfers: int = MAX_TRANSFERS, pool_size: int = POOL_SIZE,
+                   limits: Dict = LIMITS) -> TransferPlan:
+    """
+    :param squad_ids: the 15 players of the current squad
+    :param bank: money in the bank, in the API units (10 == 1.0M); players are sold at their current price
+    :param free_transfers: free transfers available for the next GW
+    :param horizon: number of next GWs planned
+    :param max_transfers: most transfers in one GW, up to 2
+    """
+    plan = plan_squad(get_planning_data(processor, horizon), squad_ids, bank, free_transfers, beam_width,
+                      max_transfers, pool_size, limits)
+    logger.info("Transfer plan for GWs %d-%d: %.1f projected points (%.1f without transfers)",
+                plan.steps[0].event, plan.steps[-1].event, plan.total_points, plan.hold_points)
+    return plan
+
+
+def plan_squad(data: PlanningData, squad_ids: Sequence[int], bank: int = 0, free_transfers: int = 1,
+               beam_width: int = BEAM_WIDTH, max_transfers: int = MAX_TRANSFERS, pool_size: int = POOL_SIZE,
+               limits: Dict = LIMITS) -> TransferPlan:
+    """plan_transfers() on the players prepared once by get_planning_data(), e.g. for many squads"""
+    events = data.events
+    if not events:
+        raise ValueError("No future fixtures to plan the transfers for")
+    squad_rows = check_squad(data, squad_ids, limits)
+
+    # Universe: the squad and the best transfer targets of every position
+    horizon_xp = data.xp.sum(axis=1)
+    targets = list()
+    for code in range(len(POSITIONS)):
+        rows = np.flatnonzero(data.available & (data.positions == code))
+        # best first, ties in the order of the players
+        targets.append(rows[np.argsort(-horizon_xp[rows], kind="stable")[:pool_size]])
+    universe = np.asarray(list(dict.fromkeys(squad_rows.tolist() + [row for top in targets for row in top.tolist()])))
+    universe_pos = {row: n for n, row in enumerate(universe.tolist())}
+    xp = data.xp[universe]
+    ids = data.ids[universe]
+    cost = data.cost[universe]
+    prices = cost.tolist()
+    team_codes = data.teams[universe]
+    target_idx = {position: np.asarray([universe_pos[row] for row in top.tolist()], dtype=int)
+                  for position, top in zip(POSITIONS, targets)}
+
+    slots = dict()
+    start = 0
+    for position in POSITIONS:
+        slots[position] = slice(start, start + limits['position'][position])
+        start += limits['position'][position]
+    evaluate = SquadEvaluator(xp, slots)
+    # squad players grouped by position, in the order of the slots
+    by_position = sorted(squad_rows.tolist(), key=lambda row: data.positions[row])
+    squad = canonical([universe_pos[row] for row in by_position], slots)
+
+    hold_points = float(evaluate(squad).sum())
+    beam = [_State(squad, bank, free_transfers, 0.0)]
+    for t, event in enumerate(events):
+        # merged by (squad, bank, free transfers) - the best way to reach a state is enough
+        reached: Dict[Tuple[Tuple[int, ...], int, int], _State] = dict()
+        for state in beam:
+            moves = list()
+            for outs, ins in get_moves(state, t, xp, cost, team_codes, target_idx, slots, max_transfers, limits):
+                new_squad = list(state.squad)
+                for slot, player in zip(outs, ins):
+                    new_squad[slot] = player
+                moves.append((outs, ins, canonical(new_squad, slots)))
+            evaluate.evaluate_many([new_squad for _, _, new_squad in moves])
+            for outs, ins, new_squad in moves:
+                new_bank = state.bank + sum(prices[state.squad[slot]] for slot in outs) - sum(prices[p] for p in ins)
+                hits = max(len(outs) - state.free_transfers, 0)
+                free_left = min(max(state.free_transfers - len(outs), 0) + 1, MAX_FREE_TRANSFERS)
+                points = state.points + evaluate(new_squad)[t] - HIT_COST * hits
+                key = (new_squad, new_bank, free_left)
+                if key not in reached or reached[key].points < points:
+                    reached[key] = _State(new_squad, new_bank, free_left, points, state, outs, ins)
+        # ranked by the points so far plus keeping the squad till the end
+        beam = sorted(reached.values(), key=lambda s: s.points + float(evaluate(s.squad)[t + 1:].sum()),
+                      reverse=True)[:beam_width]
+        logger.debug("GW %d: %d states reached, %d kept", event, len(reached), len(beam))
+
+    best = max(beam, key=lambda s: s.points)
+    path = [best]
+    while path[-1].parent is not None:
+        path.append(path[-1].parent)
+    path = path[::-1]
+    steps = list()
+    for t, (previous, state) in enumerate(zip(path, path[1:])):
+        gw_points = evaluate(state.squad)[t]
+        steps.append(PlanStep(events[t], tuple(int(ids[previous.squad[slot]]) for slot in state.outs),
+                              tuple(int(ids[player]) for player in state.ins),
+                              max(len(state.outs) - previous.free_transfers, 0), state.bank,
+                              previous.free_transfers, round(float(gw_points), 2),
+                              int(ids[evaluate.captain(state.squad, t)])))
+    logger.debug("Transfer plan for GWs %d-%d: %.1f projected points (%.1f without transfers), %d squads evaluated",
+                 events[0], events[-1], best.points, hold_points, evaluate.evaluated)
+    return TransferPlan(round(float(best.points), 2), round(hold_points, 2), steps)
+
+
+def get_moves(state: _State, t: int, xp: np.ndarray, cost: np.ndarray, team_codes: np.ndarray,
+              target_idx: Dict[str, np.ndarray], slots: Dict[str, slice], max_transfers: int,
+              limits: Dict) -> List[Tuple[Tuple[int, ...], Tuple[int, ...]]]:
+    """(squad slots sold, players bought) of every move considered from the state, including no transfer"""
+    squad = np.asarray(state.squad)
+    remaining_xp = xp[:, t:].sum(axis=1)
+    clubs = np.bincount(team_codes[squad], minlength=team_codes.max() + 1)
+    in_squad = set(state.squad)
+
+    singles = list()
+    for position in POSITIONS:
+        candidates = [player for player in target_idx[position] if player not in in_squad]
+        if not candidates:
+            continue
+        candidates = np.asarray(candidates)
+        for slot in range(slots[position].start, slots[position].stop):
+            sold = squad[slot]
+            club_ok = clubs[team_codes[candidates]] - (team_codes[candidates] == team_codes[sold]) < limits['one_team']
+            budget_ok = cost[candidates] <= state.bank + cost[sold]
+            for player in candidates[club_ok & budget_ok]:
+                singles.append((remaining_xp[player] - remaining_xp[sold], slot, int(player)))
+    singles.sort(reverse=True)
+
+    moves = [((), ())]
+    if max_transfers >= 1:
+        moves += [((slot,), (player,)) for _, slot, player in singles]
+    if max_transfers >= 2:
+        for (_, slot_a, player_a), (_, slot_b, player_b) in itertools.combinations(singles[:PAIR_CANDIDATES], 2):
+            if slot_a == slot_b or player_a == player_b:
+                continue
+            if cost[player_a] + cost[player_b] > state.bank + cost[squad[slot_a]] + cost[squad[slot_b]]:
+                continue
+            new_clubs = clubs.copy()
+            np.subtract.at(new_clubs, team_codes[[squad[slot_a], squad[slot_b]]], 1)
+            np.add.at(new_clubs, team_codes[[player_a, player_b]], 1)
+            if new_clubs.max() > limits['one_team']:
+                continue
+            moves.append(((slot_a, slot_b), (player_a, player_b)))
+    return moves
+
+
+def canonical(squad: List[int], slots: Dict[str, slice]) -> Tuple[int, ...]:
+    """Players sorted within every position - the same squad always has the same key"""
+    return tuple(player for position in POSITIONS for player in sorted(squad[slots[position]]))
+
+
+def check_squad(data: PlanningData, squad_ids: Sequence[int], limits: Dict) -> np.ndarray:
+    """Rows of the squad's players in `data`, in the order of `squad_ids`"""
+    rows = pd.Index(data.ids).get_indexer(list(squad_ids))
+    missing = [pid for pid, row in zip(squad_ids, rows) if row < 0]
+    if missing:
+        raise ValueError(f"Unknown players: {sorted(missing)}")
+    if len(set(squad_ids)) != limits['all']:
+        raise ValueError(f"A squad has {limits['all']} different players, got {len(set(squad_ids))}")
+    if (data.positions[rows] < 0).any():
+        raise ValueError(f"Players of unknown positions: {sorted(data.ids[rows[data.positions[rows] < 0]])}")
+    counts = np.bincount(data.positions[rows], minlength=len(POSITIONS))
+    if any(counts[n] != limits['position'][position] for n, position in enumerate(POSITIONS)):
+        raise ValueError(f"Invalid squad positions: {dict(zip(POSITIONS, counts.tolist()))}, "
+                         f"expected: {limits['position']}")
+    if np.bincount(data.teams[rows]).max() > limits['one_team']:
+        raise ValueError(f"More than {limits['one_team']} players of one club in the squad")
+    return rows
+
+
+def plan_to_frame(plan: TransferPlan, elements_df: pd.DataFrame) -> pd.DataFrame:
+    """One row per GW of the plan, with the names of the players"""
+    names = elements_df.set_index('id')['web_name']
+
+    def describe(ids: Tuple[int, ...]) -> str:
+        return ", ".join(names.get(pid, str(pid)) for pid in ids)
+
+    return pd.DataFrame([{
+        'event': step.event,
+        'transfers_out': describe(step.transfers_out),
+        'transfers_in': describe(step.transfers_in),
+        'hits': step.hits,
+        'free_transfers': step.free_transfers,
+        'bank': step.bank,
+        'captain': describe((step.captain,)),
+        'points': step.points,
+    } for step in plan.steps])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan the transfers of an existing squad over the next GWs")
+    parser.add_argument("--squad", type=int, nargs=LIMITS['all'], required=True, help="IDs of the 15 players")
+    parser.add_argument("--bank", type=int, default=0, help="money in the bank, in the API units (10 == 1.0M)")
+    parser.add_argument("--free-transfers", type=int, default=1)
+    parser.add_argument("--horizon", type=int, default=XP_GW_LIMIT, help="how many next GWs to plan")
+    parser.add_argument("--beam-width", type=int, default=BEAM_WIDTH, help="states kept after every GW")
+    parser.add_argument("--offline", action="store_true", help="replay the API snapshots saved in data/cache")
+    args = parser.parse_args()
+    setup_logging()
+    set_client(FplApiClient(offline=args.offline or None))
+    processor = ActualDataProcessor()
+    transfer_plan = plan_transfers(processor, args.squad, args.bank, args.free_transfers, args.horizon,
+                                   args.beam_width)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(plan_to_frame(transfer_plan, processor.elements_df).to_string(index=False))
@@ -1,11 +1,38 @@
+import os
+
 # Historical data
 DATA_DIR = 'data'
+# vaastav's dump of the past seasons, one folder per season
+HISTORICAL_DIR = os.path.join(DATA_DIR, "historical")
+# How many past seasons should be used: the last one validates the model, the older ones train it
+HIST_SEASONS = 2
+
+# On-disk snapshots of the API responses
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+# How long (in seconds) a snapshot is used without asking the API whether it changed
+SNAPSHOT_TTL = 60 * 60
+
+# Root of the FPL API - can point to a local stand-in server (python -m data_processing.tools.stand_in_server)
+API_URL = os.environ.get("FPL_API_URL", "https://fantasy.premierleague.com/api/").rstrip("/") + "/"
 
 # Main endpoint
-BASE_URL = 'https://fantasy.premierleague.com/api/bootstrap-static/'
+BASE_URL = f"{API_URL}bootstrap-static/"
 
 # Matchups
-FIXTURES_ENDPOINT = "https://fantasy.premierleague.com/api/fixtures/"
+FIXTURES_ENDPOINT = f"{API_URL}fixtures/"
+
+# Per-player history of the current season and per-gameweek live stats of all the players
+ELEMENT_SUMMARY_ENDPOINT = API_URL + "element-summary/{player_id}/"
+EVENT_LIVE_ENDPOINT = API_URL + "event/{event}/live/"
+
+# Squad of a manager in a gameweek and the managers of a classic mini-league (paged)
+ENTRY_PICKS_ENDPOINT = API_URL + "entry/{manager_id}/event/{event}/picks/"
+LEAGUE_STANDINGS_ENDPOINT = API_URL + "leagues-classic/{league_id}/standings/?page_standings={page}"
+
+# Columns used by the model predicting points per game
+PLAYER_FEATURES = [
+    'id', 'team', 'now_cost', 'expected_goal_involvements', 'expected_goals_conceded', 'ict_index',
+    'element_type', 'team_strength', 'points_per_game', 'starts', 'minutes']  # 'transfers_in', 'transfers_out'
 
 # Player profiles for each position
 DEF = "defensive"
@@ -17,6 +44,16 @@ PLAYER_PROFILE = {
         "Forward": OFF,
 }
 
+# Rolling feature the in-season squad can be selected by: points in the last 5 GWs weighted by the strength
+# of the opponents (see historical/feature_store.py)
+ROLLING_SCORE = "opp_adj_points_last5"
+
+# How many GWs should pass to consider data from ongoing season relatable
+MIN_RELATABLE_GWS = 5
+
+# Budget for the whole squad (in the API units: 1000 == 100M)
+BUDGET = 1000
+
 # Limits in the selected team
 LIMITS = {
     "position": {
@@ -0,0 +1,169 @@
+"""
+Gameweek-level data of the current season, collected from the API into the columnar store
+(the seasons of vaastav's dump only cover finished seasons):
+element-summary/<id>/ of every player -> [STORE_DIR]/<season>/gws.parquet, in the layout of merged_gw.csv,
+event/<gw>/live/ of every finished gameweek -> [STORE_DIR]/<season>/live.parquet,
+plus the players and teams tables of bootstrap-static - so prepare_gw_dataset reads the season like a past one.
+Only the rows of the fetched players and GWs are replaced, the other stored ones (also of failed requests) stay.
+The rolling features of the newly finished GWs are added to the feature store (see feature_store.py).
+
+Usage: python -m data_processing.historical.backfill [--players ID ...] [--events GW ...] [--concurrency 8]
+                                                     [--record DIR]
+"""
+import argparse
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+
+from .feature_store import update_features
+from .season_store import GWS_SCHEMA, PLAYERS_SCHEMA, STORE_DIR, TEAMS_SCHEMA, read_manifest, read_table, write_table
+from ..constants import BASE_URL, ELEMENT_SUMMARY_ENDPOINT, EVENT_LIVE_ENDPOINT
+from ..tools.async_fetch import CONCURRENCY, BulkFetcher
+from ..tools.fpl_api import get_base_api_data, load_fixtures
+from ..tools.logs import setup_logging
+from ..tools.utils import get_actual_season
+
+logger = logging.getLogger(__name__)
+
+LIVE_SCHEMA = {
+    'element': 'Int32',
+    'GW': 'Int8',
+    'minutes': 'Int16',
+    'starts': 'Int8',
+    'total_points': 'Int16',
+    'bonus': 'Int8',
+    'bps': 'Int16',
+    'ict_index': 'float32',
+    'expected_goal_involvements': 'float32',
+    'expected_goals_conceded': 'float32',
+    'in_dreamteam': 'boolean',
+}
+
+
+def current_season() -> str:
+    """e.g. '2024-25'"""
+    return get_actual_season(load_fixtures())
+
+
+def finished_events() -> list:
+    events_df = get_base_api_data("events")
+    return events_df.loc[events_df["finished"] == True, "id"].tolist()
+
+
+def element_histories_df(summaries: Dict[int, Any], elements_df: pd.DataFrame, element_types_df: pd.DataFrame,
+                         teams_df: pd.DataFrame) -> pd.DataFrame:
+    """The 'history' of every element-summary as merged_gw.csv rows (team and position names added)"""
+    history_df = pd.DataFrame([row for summary in summaries.values() for row in summary.get("history", [])])
+    if history_df.empty:
+        return pd.DataFrame(columns=list(GWS_SCHEMA))
+    players_df = elements_df.set_index("id")
+    history_df["GW"] = history_df["round"]
+    history_df["team"] = history_df["element"].map(players_df["team"]).map(teams_df.set_index("id")["name"])
+    history_df["position"] = history_df["element"].map(players_df["element_type"]).map(
+        element_types_df.set_index("id")["singular_name_short"])
+    for col in ['ict_index', 'expected_goal_involvements', 'expected_goals_conceded']:
+        history_df[col] = pd.to_numeric(history_df[col], errors="coerce")
+    return history_df.sort_values(["GW", "kickoff_time", "element"], ignore_index=True)
+
+
+def event_lives_df(lives: Dict[int, Any]) -> pd.DataFrame:
+    """The stats of every player in every event/<gw>/live/ payload, one row per player per GW"""
+    live_df = pd.DataFrame([{'element': element["id"], 'GW': event, **element["stats"]}
+                            for event, live in lives.items() for element in live.get("elements", [])])
+    if live_df.empty:
+        return pd.DataFrame(columns=list(LIVE_SCHEMA))
+    for col in ['ict_index', 'expected_goal_involvements', 'expected_goals_conceded']:
+        live_df[col] = pd.to_numeric(live_df[col], errors="coerce")
+    return live_df.sort_values(["GW", "element"], ignore_index=True)
+
+
+def merge_stored(season: str, name: str, fetched_df: pd.DataFrame, key: str, fetched_keys: Iterable[int],
+                 schema: Dict[str, str], sort_by: List[str], store_dir: str = STORE_DIR) -> pd.DataFrame:
+    """The stored rows of a table with the rows of every fetched key (player, GW) replaced by the fetched ones"""
+    fetched_df = fetched_df.reindex(columns=list(schema)).astype(schema)
+    manifest = read_manifest(season, store_dir)
+    if manifest is None or name not in manifest["tables"]:
+        return fetched_df
+    try:
+        stored_df = read_table(season, name, store_dir=store_dir)
+    except FileNotFoundError:
+        # a store of an older version, without the CSV files to convert it again from
+        logger.warning("Cannot read the stored %s of season %s, it is replaced", name, season)
+        return fetched_df
+    kept_df = stored_df[~stored_df[key].isin(list(fetched_keys))].reindex(columns=list(schema)).astype(schema)
+    return pd.concat([kept_df, fetched_df], ignore_index=True).sort_values(sort_by, ignore_index=True)
+
+
+def warn_failed(requested: Iterable[int], fetched: Dict[int, Any], what: str) -> None:
+    failed = sorted(set(requested) - set(fetched))
+    if failed:
+        logger.warning("%d %s failed, their stored rows are kept (run again with them): %s", len(failed), what,
+                       " ".join(map(str, failed)))
+
+
+def record_payloads(record_dir: str, payloads: Dict[int, Any], endpoint: str) -> None:
+    """Save raw payloads in the layout served by the stand-in server, e.g. <dir>/element-summary/12.json"""
+    for key, payload in payloads.items():
+        path = os.path.join(record_dir, endpoint.format(player_id=key, event=key).strip("/") + ".json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(payload, file)
+
+
+def backfill_season(player_ids: Optional[Iterable[int]] = None, events: Optional[Iterable[int]] = None,
+                    fetcher: Optional[BulkFetcher] = None, store_dir: str = STORE_DIR,
+                    record_dir: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Download the per-player histories and the live stats of the finished GWs and store them with the season.
+
+    :param player_ids: only these players (default: all of them)
+    :param events: only these gameweeks (default: all the finished ones)
+    :param record_dir: also keep the raw payloads there, e.g. to be replayed by the stand-in server
+    :return: manifest of the stored season
+    """
+    fetcher = fetcher or BulkFetcher()
+    elements_df = get_base_api_data("elements")
+    element_types_df = get_base_api_data("element_types")
+    teams_df = get_base_api_data("teams")
+    season = current_season()
+    player_ids = list(player_ids) if player_ids is not None else elements_df["id"].tolist()
+    events = list(events) if events is not None else finished_events()
+
+    logger.info("Backfilling season %s: %d players, %d gameweeks", season, len(player_ids), len(events))
+    summaries = fetcher.fetch_all({player_id: ELEMENT_SUMMARY_ENDPOINT.format(player_id=player_id)
+                                   for player_id in player_ids})
+    lives = fetcher.fetch_all({event: EVENT_LIVE_ENDPOINT.format(event=event) for event in events})
+    if record_dir:
+        record_payloads(record_dir, summaries, "element-summary/{player_id}/")
+        record_payloads(record_dir, lives, "event/{event}/live/")
+
+    write_table(season, "players", elements_df, PLAYERS_SCHEMA, BASE_URL, store_dir)
+    write_table(season, "teams", teams_df, TEAMS_SCHEMA, BASE_URL, store_dir)
+    warn_failed(player_ids, summaries, "players")
+    warn_failed(events, lives, "gameweeks")
+    # an element-summary has every GW of the player, a live payload every player of the GW
+    gws_df = merge_stored(season, "gws", element_histories_df(summaries, elements_df, element_types_df, teams_df),
+                          "element", summaries, GWS_SCHEMA, ["GW", "kickoff_time", "element"], store_dir)
+    live_df = merge_stored(season, "live", event_lives_df(lives), "GW", lives, LIVE_SCHEMA, ["GW", "element"],
+                           store_dir)
+    write_table(season, "gws", gws_df, GWS_SCHEMA, ELEMENT_SUMMARY_ENDPOINT, store_dir)
+    manifest = write_table(season, "live", live_df, LIVE_SCHEMA, EVENT_LIVE_ENDPOINT, store_dir)
+    logger.info("Season %s stored: %s", season,
+                ", ".join(f"{name} ({table['rows']} rows)" for name, table in manifest["tables"].items()))
+    # the rolling features of the newly finished GWs
+    update_features(season, store_dir)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect the gameweek-level data of the current season")
+    parser.add_argument("--players", type=int, nargs="+", help="only these player ids (default: all)")
+    parser.add_argument("--events", type=int, nargs="+", help="only these gameweeks (default: the finished ones)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="requests in flight at once")
+    parser.add_argument("--record", help="also save the raw payloads in this directory (stand-in server layout)")
+    args = parser.parse_args()
+    setup_logging()
+    backfill_season(args.players, args.events, BulkFetcher(args.concurrency), record_dir=args.record)
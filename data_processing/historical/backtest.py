@@ -0,0 +1,375 @@
+"""
+Walk-forward backtest of the selection strategies on past seasons from the columnar store.
+Before every GW of a season, the API state of that moment is rebuilt from the stored tables (season totals of the
+players so far, their form and price, the fixtures finished so far) and replayed through the API client; the squad
+is selected the way FantasyScout.select_team does it (the preseason model before `min_relatable_gws` GWs have passed,
+the in-season selection after) and scored with the points its players really scored in that GW.
+
+Every GW is a fresh selection (no transfers), scored by its XI: picked by the strategy's own score, with the
+substitutions of players who didn't play and the captain's points doubled. Squads short of 15 players (the greedy
+selection may end so) are scored too, and counted in the summary.
+
+The API states and the processors built on them (with their derived frames: elements, matchups, team index...) are
+cached per season and GW in every process, so the strategies share them - a strategy changing only the selection
+recomputes only the selection. Seasons and strategies are spread over a pool of processes.
+
+    strategies = strategy_grid(teams_limits=[3, 4, 5], future_gw_limits=[3, 5, 8])
+    results_df = backtest(["2022-23", "2023-24"], strategies)
+    summarize_backtest(results_df)
+
+Usage: python -m data_processing.historical.backtest --seasons 2022-23 2023-24 [--teams-limits 3 5] [--future-gws 3 5]
+                                                     [--min-relatable-gws 5] [--exact] [--output FILE]
+"""
+import argparse
+import itertools
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .process_historical_data import GW_POSITIONS, HistoricalDataProcessor
+from .season_store import STORE_DIR, ingest_season, read_table
+from ..actual import act_team_selection
+from ..actual.process_actual_data import ActualDataProcessor, FUTURE_GW_LIMIT, TEAMS_LIMIT
+from ..actual.simulation import STARTING_XI, get_squad_points, pick_lineup
+from ..constants import HIST_SEASONS, HISTORICAL_DIR, LIMITS, MIN_RELATABLE_GWS
+from ..tools.fpl_api import BOOTSTRAP, FIXTURES, FplApiClient, how_many_gws_passed, set_client
+from ..tools.logs import setup_logging
+from ..tools.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
+# FPL form: the average points of the last 30 days - about 4 GWs
+FORM_GWS = 4
+POSITION_NAMES = {1: ("Goalkeeper", "GKP"), 2: ("Defender", "DEF"), 3: ("Midfielder", "MID"), 4: ("Forward", "FWD")}
+RESULT_COLS = ['season', 'strategy', 'event', 'phase', 'status', 'players', 'squad_cost', 'points', 'squad_points']
+
+
+class Strategy(NamedTuple):
+    exact: bool = False
+    score_col: str = "form_ppg"
+    teams_limit: int = TEAMS_LIMIT
+    future_gw_limit: int = FUTURE_GW_LIMIT
+    min_relatable_gws: int = MIN_RELATABLE_GWS
+    # thresholds of find_best_players
+    min_chance_of_playing: int = act_team_selection.MIN_CHANCE_OF_PLAYING
+    budget_cost_share: float = act_team_selection.BUDGET_COST_SHARE
+    n_seasons: int = HIST_SEASONS
+
+
+def strategy_grid(exact: Iterable[bool] = (False,), score_cols: Iterable[str] = ("form_ppg",),
+                  teams_limits: Iterable[int] = (TEAMS_LIMIT,), future_gw_limits: Iterable[int] = (FUTURE_GW_LIMIT,),
+                  min_relatable_gws: Iterable[int] = (MIN_RELATABLE_GWS,),
+                  min_chances_of_playing: Iterable[int] = (act_team_selection.MIN_CHANCE_OF_PLAYING,),
+                  budget_cost_shares: Iterable[float] = (act_team_selection.BUDGET_COST_SHARE,)) -> List[Strategy]:
+    """Every combination of the given values"""
+    return [Strategy(*values) for values in itertools.product(exact, score_cols, teams_limits, future_gw_limits,
+                                                             min_relatable_gws, min_chances_of_playing,
+                                                             budget_cost_shares)]
+
+
+def describe_strategy(strategy: Strategy) -> str:
+    """Only the values different from the defaults, e.g. 'teams_limit=5, exact=True'"""
+    changed = [f"{name}={value}" for name, value, default in zip(Strategy._fields, strategy, Strategy())
+               if value != default]
+    return ", ".join(changed) or "default"
+
+
+class SeasonData(NamedTuple):
+    players: pd.DataFrame
+    teams: pd.DataFrame
+    gws: pd.DataFrame
+    fixtures: pd.DataFrame
+
+
+@lru_cache(maxsize=None)
+def load_season(season: str, historical_dir: str = HISTORICAL_DIR, store_dir: str = STORE_DIR) -> SeasonData:
+    """The stored tables of a season, with the goals conceded and the team ID of every player's match"""
+    players_df = read_table(season, "players", historical_dir=historical_dir, store_dir=store_dir)
+    teams_df = read_table(season, "teams", historical_dir=historical_dir, store_dir=store_dir)
+    fixtures_df = read_table(season, "fixtures", historical_dir=historical_dir, store_dir=store_dir)
+    gws_df = read_table(season, "gws", historical_dir=historical_dir, store_dir=store_dir)
+
+    gws_df['team_id'] = gws_df['team'].astype(object).map(teams_df.set_index('name')['id'])
+    scores = fixtures_df.set_index('id')[['team_h_score', 'team_a_score']]
+    home = gws_df['was_home'].fillna(False).to_numpy(dtype=bool)
+    gws_df['conceded'] = np.where(home, gws_df['fixture'].map(scores['team_a_score']),
+                                  gws_df['fixture'].map(scores['team_h_score']))
+    return SeasonData(players_df, teams_df, gws_df, fixtures_df)
+
+
+def get_api_state(data: SeasonData, event: int) -> Dict[str, Any]:
+    """The bootstrap-static and fixtures payloads as the API showed them before the deadline of `event`"""
+    gws_df = data.gws
+    past_df = gws_df[gws_df['GW'] < event]
+    played = past_df['minutes'] > 0
+    totals_df = past_df.assign(
+        appearances=played,
+        clean_sheets=(past_df['minutes'] >= 60) & (past_df['conceded'] == 0),
+    ).groupby('element').agg(
+        total_points=('total_points', 'sum'),
+        minutes=('minutes', 'sum'),
+        starts=('starts', 'sum'),
+        ict_index=('ict_index', 'sum'),
+        expected_goal_involvements=('expected_goal_involvements', 'sum'),
+        expected_goals_conceded=('expected_goals_conceded', 'sum'),
+        appearances=('appearances', 'sum'),
+        clean_sheets=('clean_sheets', 'sum'),
+    )
+    form = past_df[past_df['GW'] >= event - FORM_GWS].groupby('element')['total_points'].sum() / FORM_GWS
+
+    # players listed at the deadline: those with a match so far or in this GW; price and club as of this GW
+    known_df = gws_df[gws_df['GW'] <= event].sort_values(['GW', 'kickoff_time'], kind="stable")
+    latest_df = known_df.groupby('element').last()
+    players_df = data.players.set_index('id').reindex(latest_df.index)
+    ids = latest_df.index
+    now_cost = latest_df['value'].fillna(players_df['now_cost']).astype(int)
+    totals_df = totals_df.reindex(ids).fillna(0)
+    form = form.reindex(ids).fillna(0)
+    selected = latest_df['selected'].fillna(0)
+    # every manager selects 15 players
+    managers = max(selected.sum() / LIMITS['all'], 1)
+
+    elements_df = pd.DataFrame({
+        'id': ids,
+        'first_name': players_df['first_name'].fillna(""),
+        'second_name': players_df['second_name'].fillna(""),
+        'web_name': players_df['web_name'].fillna(""),
+        'element_type': latest_df['position'].astype(object).map(GW_POSITIONS).fillna(players_df['element_type']),
+        'team': latest_df['team_id'].fillna(players_df['team']),
+        'status': "a",
+        'now_cost': now_cost,
+        'total_points': totals_df['total_points'],
+        'points_per_game': (totals_df['total_points'] / totals_df['appearances'].where(totals_df['appearances'] > 0))
+                           .fillna(0).round(1),
+        'form': form.round(1),
+        'value_form': (form / (now_cost / 10)).round(1),
+        'value_season': (totals_df['total_points'] / (now_cost / 10)).round(1),
+        'selected_by_percent': (100 * selected / managers).round(1),
+        'ict_index': totals_df['ict_index'].round(1),
+        'ict_index_rank': totals_df['ict_index'].rank(ascending=False, method="min"),
+        'expected_goal_involvements': totals_df['expected_goal_involvements'].round(2),
+        'expected_goals_conceded': totals_df['expected_goals_conceded'].round(2),
+        'clean_sheets': totals_df['clean_sheets'],
+        'bps': 0,
+        'starts': totals_df['starts'],
+        'minutes': totals_df['minutes'],
+        'chance_of_playing_next_round': None,
+        'chance_of_playing_this_round': None,
+        'penalties_order': None,
+    }).dropna(subset=['element_type', 'team'])
+
+    fixtures_df = data.fixtures.copy()
+    finished = fixtures_df['event'] < event
+    fixtures_df['finished'] = finished
+    fixtures_df['finished_provisional'] = finished
+    fixtures_df['started'] = finished
+    for col in ['team_h_score', 'team_a_score']:
+        fixtures_df[col] = fixtures_df[col].astype(object).where(finished, None)
+    fixtures_df = fixtures_df.sort_values(['event', 'kickoff_time', 'id'], kind="stable")
+
+    element_types = [{'id': element_type, 'singular_name': name, 'singular_name_short': short,
+                      'plural_name': f"{name}s", 'squad_select': LIMITS['position'][name]}
+                     for element_type, (name, short) in POSITION_NAMES.items()]
+    events = [{'id': gw, 'finished': gw < event, 'is_current': gw == event - 1, 'is_next': gw == event}
+              for gw in sorted(data.fixtures['event'].dropna().unique().astype(int))]
+    return {
+        BOOTSTRAP: {
+            'elements': to_records(elements_df),
+            'teams': to_records(data.teams),
+            'element_types': element_types,
+            'events': events,
+        },
+        FIXTURES: to_records(fixtures_df),
+    }
+
+
+def to_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Rows as the API sends them: plain Python values, None for missing ones"""
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+def get_actual_points(data: SeasonData, event: int) -> pd.DataFrame:
+    """Points and minutes of every player in the GW (a double GW summed)"""
+    return data.gws[data.gws['GW'] == event].groupby('element')[['total_points', 'minutes']].sum()
+
+
+@lru_cache(maxsize=None)
+def get_gw_processors(season: str, event: int) -> Tuple[FplApiClient, Dict[str, Any]]:
+    """Client replaying the API state of the GW and the processors built on it, shared by the strategies"""
+    client = FplApiClient(offline=True)
+    client.preload(get_api_state(load_season(season), event))
+    return client, dict()
+
+
+@contextmanager
+def selection_thresholds(strategy: Strategy) -> Iterator[None]:
+    """The thresholds of find_best_players set to the strategy's for the duration of a selection"""
+    saved = act_team_selection.MIN_CHANCE_OF_PLAYING, act_team_selection.BUDGET_COST_SHARE
+    act_team_selection.MIN_CHANCE_OF_PLAYING = strategy.min_chance_of_playing
+    act_team_selection.BUDGET_COST_SHARE = strategy.budget_cost_share
+    try:
+        yield
+    finally:
+        act_team_selection.MIN_CHANCE_OF_PLAYING, act_team_selection.BUDGET_COST_SHARE = saved
+
+
+def select_for_gw(season: str, event: int, strategy: Strategy) -> Tuple[str, pd.DataFrame, str]:
+    """
+    The squad the strategy selects before the GW, like FantasyScout.select_team
+    :return: (phase: 'preseason'/'in-season', squad, the column with the players' score)
+    """
+    client, processors = get_gw_processors(season, event)
+    set_client(client)
+    fixtures_df = client.fixtures()
+    past_gws_count = how_many_gws_passed(fixtures_df) if fixtures_df['finished'].any() else 0
+    if past_gws_count >= strategy.min_relatable_gws:
+        key = ("in-season", strategy.exact)
+        if key not in processors:
+            processors[key] = ActualDataProcessor(strategy.exact)
+        processor = processors[key]
+        processor.pipeline.set_input("score_col", strategy.score_col)
+        processor.pipeline.set_input("teams_limit", strategy.teams_limit)
+        processor.pipeline.set_input("future_gw_limit", strategy.future_gw_limit)
+        # the thresholds are not inputs of the pipeline
+        processor.pipeline.invalidate("selected_team")
+        with selection_thresholds(strategy):
+            return "in-season", processor.launch_pipeline(), strategy.score_col
+
+    key = ("preseason", strategy.exact, strategy.n_seasons)
+    if key not in processors:
+        processors[key] = HistoricalDataProcessor(strategy.exact, n_seasons=strategy.n_seasons)
+    return "preseason", processors[key].launch_pipeline(), "predicted_ppg"
+
+
+def score_squad(squad_df: pd.DataFrame, score_col: str, actual_df: pd.DataFrame) -> float:
+    """Actual points of the XI picked by the score, with the substitutions and the captain"""
+    lineup = pick_lineup(squad_df, squad_df.set_index('id')[score_col])
+    ids = squad_df['id'].tolist()
+    actual_df = actual_df.reindex(ids).fillna(0)
+    points = actual_df['total_points'].to_numpy()[:, None]
+    played = (actual_df['minutes'] > 0).to_numpy()[:, None]
+    positions = squad_df.set_index('id')['position'].astype(str).to_dict()
+    return float(get_squad_points(points, played, {pid: row for row, pid in enumerate(ids)}, lineup, positions)[0])
+
+
+def backtest_season(season: str, strategy: Strategy, events: Optional[Sequence[int]] = None) -> pd.DataFrame:
+    """One row per GW of the season: the squad the strategy selected and the points it scored"""
+    data = load_season(season)
+    events = events or sorted(data.fixtures['event'].dropna().unique().astype(int))
+    rows = list()
+    for event in events:
+        row = {'season': season, 'strategy': describe_strategy(strategy), 'event': event}
+        try:
+            phase, squad_df, score_col = select_for_gw(season, event, strategy)
+        except Exception as err:
+            logger.warning("%s GW %d (%s): selection failed: %r", season, event, row['strategy'], err)
+            rows.append({**row, 'status': f"failed: {err!r}"})
+            continue
+        actual_df = get_actual_points(data, event)
+        row.update(phase=phase, players=len(squad_df),
+                   squad_cost=int(squad_df['now_cost'].sum()) if len(squad_df) else 0,
+                   status="ok" if len(squad_df) == LIMITS['all'] else "incomplete squad")
+        if len(squad_df) >= STARTING_XI:
+            # an incomplete squad is still scored - the greedy selection may end short of players
+            row.update(points=score_squad(squad_df, score_col, actual_df),
+                       squad_points=float(actual_df['total_points'].reindex(squad_df['id']).fillna(0).sum()))
+        rows.append(row)
+    return pd.DataFrame(rows, columns=RESULT_COLS)
+
+
+def _backtest_task(task: Tuple[str, Strategy, Optional[Sequence[int]]]) -> pd.DataFrame:
+    season, strategy, events = task
+    return backtest_season(season, strategy, events)
+
+
+@profiled()
+def backtest(seasons: Sequence[str], strategies: Sequence[Strategy], events: Optional[Sequence[int]] = None,
+             max_workers: Optional[int] = None, historical_dir: str = HISTORICAL_DIR,
+             store_dir: str = STORE_DIR) -> pd.DataFrame:
+    """
+    Every strategy on every season, in a pool of processes (a task per season and strategy).
+    :param events: GWs to replay, all of them by default
+    :return: one row per season, strategy and GW
+    """
+    # converted once, before the workers read the store at the same time
+    for season in seasons:
+        ingest_season(season, historical_dir, store_dir)
+    # tasks of one season next to each other, so a worker reuses its cached API states and processors
+    tasks = [(season, strategy, events) for season in seasons for strategy in strategies]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    if max_workers > 1:
+        load_preseason_models(seasons, strategies)
+    logger.info("Backtesting %d strateg(ies) on %d season(s) in %d process(es)", len(strategies), len(seasons),
+                max_workers)
+    if max_workers <= 1:
+        results = [_backtest_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers) as executor:
+            results = list(executor.map(_backtest_task, tasks, chunksize=max(1, len(tasks) // (2 * max_workers))))
+    return pd.concat(results, ignore_index=True)
+
+
+def load_preseason_models(seasons: Sequence[str], strategies: Sequence[Strategy]) -> None:
+    """Load (or train and save) the preseason models once, so the workers don't train the same one at a time"""
+    for season in seasons:
+        for n_seasons in {strategy.n_seasons for strategy in strategies if strategy.min_relatable_gws > 0}:
+            client, _ = get_gw_processors(season, 1)
+            set_client(client)
+            try:
+                HistoricalDataProcessor(n_seasons=n_seasons).model
+            except Exception as err:
+                logger.warning("%s: no preseason model (%r), its preseason GWs will fail", season, err)
+
+
+def summarize_backtest(results_df: pd.DataFrame) -> pd.DataFrame:
+    """One row per strategy and season: total and average points of the scored GWs, GWs with an incomplete squad"""
+    summary_df = results_df.groupby(['strategy', 'season']).agg(
+        gws=('points', 'count'),
+        points=('points', 'sum'),
+        points_per_gw=('points', 'mean'),
+        squad_points=('squad_points', 'sum'),
+        incomplete_gws=('status', lambda status: (status == "incomplete squad").sum()),
+        failed_gws=('status', lambda status: status.str.startswith("failed").sum()),
+    ).round(2)
+    return summary_df.sort_values('points', ascending=False)
+
+
+def parse_values(values: Optional[List[str]], cast: type, default: Any) -> List[Union[int, float, bool, str]]:
+    return [cast(value) for value in values] if values else [default]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay past seasons GW by GW and score the selected squads")
+    parser.add_argument("--seasons", nargs="+", required=True, help="e.g. 2022-23 2023-24")
+    parser.add_argument("--gws", type=int, nargs="+", help="only these GWs")
+    parser.add_argument("--exact", action="store_true", help="use the exact optimizer")
+    parser.add_argument("--score", nargs="+", help="score columns to compare, e.g. form_ppg expected_points")
+    parser.add_argument("--teams-limits", nargs="+")
+    parser.add_argument("--future-gws", nargs="+", help="values of FUTURE_GW_LIMIT")
+    parser.add_argument("--min-relatable-gws", nargs="+")
+    parser.add_argument("--min-chances", nargs="+", help="values of MIN_CHANCE_OF_PLAYING")
+    parser.add_argument("--budget-shares", nargs="+", help="values of BUDGET_COST_SHARE")
+    parser.add_argument("--workers", type=int, help="processes, all CPUs by default")
+    parser.add_argument("--output", help="save the GW results as CSV")
+    args = parser.parse_args()
+    setup_logging()
+    grid = strategy_grid(
+        exact=[args.exact],
+        score_cols=parse_values(args.score, str, "form_ppg"),
+        teams_limits=parse_values(args.teams_limits, int, TEAMS_LIMIT),
+        future_gw_limits=parse_values(args.future_gws, int, FUTURE_GW_LIMIT),
+        min_relatable_gws=parse_values(args.min_relatable_gws, int, MIN_RELATABLE_GWS),
+        min_chances_of_playing=parse_values(args.min_chances, int, act_team_selection.MIN_CHANCE_OF_PLAYING),
+        budget_cost_shares=parse_values(args.budget_shares, float, act_team_selection.BUDGET_COST_SHARE),
+    )
+    gw_results_df = backtest(args.seasons, grid, args.gws, args.workers)
+    if args.output:
+        gw_results_df.to_csv(args.output, index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summarize_backtest(gw_results_df).to_string())
@@ -0,0 +1,312 @@
+"""
+Rolling features of every player, computed from the gameweek history of a season in the columnar store
+([STORE_DIR]/<season>/gws.parquet - a past season, or the current one collected by backfill.py):
+the points of the last 3/5/10 GWs, the share of the possible minutes played, expected goal involvements per 90,
+points per game at home and away, and points weighted by the strength of the opponents.
+
+One row per player per GW: the state after that GW. The running sums of the player are stored with the features,
+so the features of a new GW are one step from the last rows of every player - the older GWs are never computed again.
+Every GW is its own Parquet file: [STORE_DIR]/<season>/features/gw_<NN>.parquet, listed in features/manifest.json
+with a fingerprint of its source rows. A GW whose source has changed gets the season computed again.
+
+    features_df = get_latest_features("2023-24", gw=20)   # one row per player (element), ROLLING_FEATURES
+
+Usage: python -m data_processing.historical.feature_store [--seasons SEASON ...] [--rebuild]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .season_store import STORE_DIR, TABLES, read_table
+from ..constants import HISTORICAL_DIR
+from ..tools.logs import setup_logging
+from ..tools.utils import get_actual_season
+
+logger = logging.getLogger(__name__)
+
+FEATURES_DIR = "features"
+MANIFEST_FILE = "manifest.json"
+# Bumped whenever the features change - stored features of an older version are computed again
+FEATURES_VERSION = 1
+# GWs of the rolling points; the other rolling features cover the last FORM_GWS
+POINTS_WINDOWS = (3, 5, 10)
+FORM_GWS = 5
+# Stored rows of a player needed to compute the next GW
+HISTORY_GWS = max(POINTS_WINDOWS + (FORM_GWS,))
+FULL_MATCH = 90
+
+# What every player's running sums are made of (the GWs with a fixture, fixtures, points...)
+SUM_COLS = ['gws', 'fixtures', 'points', 'minutes', 'xgi', 'home_fixtures', 'home_points', 'away_fixtures',
+            'away_points', 'adj_points']
+STORED_SUM_COLS = [f"sum_{col}" for col in SUM_COLS]
+# The sums are integers - exact, whatever GWs they were added in: expected goal involvements in hundredths,
+# adjusted points in thousandths
+XGI_SCALE = 100
+ADJ_POINTS_SCALE = 1000
+ROLLING_FEATURES = [f"points_last{gws}" for gws in POINTS_WINDOWS] + [
+    'minutes_share', f'minutes_share_last{FORM_GWS}', 'xgi_per90', f'xgi_per90_last{FORM_GWS}',
+    'home_ppg', 'away_ppg', 'opp_adj_ppg', f'opp_adj_points_last{FORM_GWS}']
+GWS_COLS = ['element', 'GW', 'opponent_team', 'was_home', 'minutes', 'total_points', 'expected_goal_involvements']
+
+
+def get_opponent_factors(teams_df: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
+    """
+    How much stronger than the average every team is when it plays at home and away (1 - average).
+    Seasons without the venue strengths use the overall 'strength'.
+    """
+    factors = list()
+    for col in ('strength_overall_home', 'strength_overall_away'):
+        strength = teams_df[col] if teams_df[col].notna().all() else teams_df['strength']
+        strength = strength.astype(float)
+        factors.append(pd.Series((strength / strength.mean()).to_numpy(), index=teams_df['id'].astype(int)))
+    return factors[0], factors[1]
+
+
+def get_gw_steps(gws_df: pd.DataFrame, teams_df: pd.DataFrame) -> pd.DataFrame:
+    """One row per player per GW (the fixtures of a double GW added up): how much the running sums grow"""
+    home_factor, away_factor = get_opponent_factors(teams_df)
+    home = gws_df['was_home'].fillna(False).to_numpy(dtype=bool)
+    opponents = gws_df['opponent_team'].astype(float)
+    # the opponent of a player at home plays away
+    opponent_factor = np.where(home, opponents.map(away_factor), opponents.map(home_factor))
+    points = gws_df['total_points'].fillna(0).to_numpy(dtype=np.int64)
+    xgi = gws_df['expected_goal_involvements'].fillna(0).to_numpy(dtype=float)
+    steps_df = pd.DataFrame({
+        'element': gws_df['element'].astype(int).to_numpy(),
+        'GW': gws_df['GW'].astype(int).to_numpy(),
+        'fixtures': 1,
+        'points': points,
+        'minutes': gws_df['minutes'].fillna(0).to_numpy(dtype=np.int64),
+        'xgi': np.round(xgi * XGI_SCALE).astype(np.int64),
+        'home_fixtures': home.astype(np.int64),
+        'home_points': np.where(home, points, 0),
+        'away_fixtures': (~home).astype(np.int64),
+        'away_points': np.where(home, 0, points),
+        'adj_points': np.round(points * np.nan_to_num(opponent_factor, nan=1.0) * ADJ_POINTS_SCALE).astype(np.int64),
+    })
+    steps_df = steps_df.groupby(['element', 'GW'], sort=True).sum().reset_index()
+    steps_df['gws'] = 1
+    return steps_df[['element', 'GW'] + SUM_COLS]
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    ratio = np.full(len(numerator), np.nan)
+    np.divide(numerator, denominator, out=ratio, where=denominator > 0)
+    return ratio.round(4)
+
+
+def compute_features(steps_df: pd.DataFrame, history_df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    The running sums and the features after every GW of `steps_df`.
+
+    :param steps_df: see get_gw_steps - GWs after the stored ones
+    :param history_df: stored rows (element, GW, STORED_SUM_COLS) of the GWs before, in the order of the GWs -
+                       at least the last HISTORY_GWS of every player
+    :return: element, GW, STORED_SUM_COLS and ROLLING_FEATURES, one row per row of `steps_df`
+    """
+    steps_df = steps_df.assign(new=True)
+    if history_df is not None and len(history_df):
+        history_df = (history_df[['element', 'GW'] + STORED_SUM_COLS]
+                      .set_axis(['element', 'GW'] + SUM_COLS, axis=1)
+                      .groupby('element').tail(HISTORY_GWS).assign(new=False))
+        # the running sums go on from the last stored ones
+        steps_df = pd.concat([history_df.groupby('element').tail(1), steps_df], ignore_index=True)
+    sums_df = steps_df.sort_values(['element', 'GW'], ignore_index=True)
+    sums_df[SUM_COLS] = sums_df.groupby('element')[SUM_COLS].cumsum()
+    frame_df = sums_df[sums_df['new']]
+    if history_df is not None and len(history_df):
+        frame_df = pd.concat([history_df, frame_df])
+    frame_df = frame_df.sort_values(['element', 'GW'], ignore_index=True)
+
+    # rolling windows of the new rows: their sums minus the sums k rows (GWs of the player) before
+    values = frame_df[SUM_COLS].to_numpy()
+    position = frame_df.groupby('element').cumcount().to_numpy()
+    rows = np.flatnonzero(frame_df['new'].to_numpy())
+    sums = dict(zip(SUM_COLS, values[rows].T))
+    windows = dict()
+    for gws in set(POINTS_WINDOWS + (FORM_GWS,)):
+        before = np.where((position[rows] >= gws)[:, None], values[rows - gws], 0)
+        windows[gws] = dict(zip(SUM_COLS, (values[rows] - before).T))
+    form = windows[FORM_GWS]
+    features = {f"points_last{gws}": _ratio(windows[gws]['points'], windows[gws]['gws']) for gws in POINTS_WINDOWS}
+    features.update({
+        'minutes_share': _ratio(sums['minutes'], FULL_MATCH * sums['fixtures']),
+        f'minutes_share_last{FORM_GWS}': _ratio(form['minutes'], FULL_MATCH * form['fixtures']),
+        'xgi_per90': _ratio(FULL_MATCH / XGI_SCALE * sums['xgi'], sums['minutes']),
+        f'xgi_per90_last{FORM_GWS}': _ratio(FULL_MATCH / XGI_SCALE * form['xgi'], form['minutes']),
+        'home_ppg': _ratio(sums['home_points'], sums['home_fixtures']),
+        'away_ppg': _ratio(sums['away_points'], sums['away_fixtures']),
+        'opp_adj_ppg': _ratio(sums['adj_points'] / ADJ_POINTS_SCALE, sums['fixtures']),
+        f'opp_adj_points_last{FORM_GWS}': _ratio(form['adj_points'] / ADJ_POINTS_SCALE, form['gws']),
+    })
+    return pd.concat([frame_df[['element', 'GW']].iloc[rows].reset_index(drop=True),
+                      pd.DataFrame(values[rows], columns=STORED_SUM_COLS), pd.DataFrame(features)], axis=1)
+
+
+def get_fingerprints(gws_df: pd.DataFrame) -> Dict[str, str]:
+    """GW -> rows and points of its source rows, to notice a GW changed after its features were stored"""
+    per_gw = gws_df.groupby(gws_df['GW'].astype(int))['total_points'].agg(['size', 'sum'])
+    return {str(gw): f"{rows}:{points}" for gw, (rows, points) in per_gw.iterrows()}
+
+
+def read_features_manifest(season: str, store_dir: str = STORE_DIR) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(store_dir, season, FEATURES_DIR, MANIFEST_FILE), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _gw_path(season: str, gw: int, store_dir: str) -> str:
+    return os.path.join(store_dir, season, FEATURES_DIR, f"gw_{gw:02d}.parquet")
+
+
+def _replace(path: str, write) -> None:
+    # written next to the target first - the processes of a backtest may update the same season at once
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def has_history(season: str, store_dir: str = STORE_DIR, historical_dir: str = HISTORICAL_DIR) -> bool:
+    """Whether the gameweek history of the season is in the store or can be converted into it"""
+    return (os.path.exists(os.path.join(store_dir, season, "gws.parquet"))
+            or os.path.exists(os.path.join(historical_dir, season, TABLES["gws"][0])))
+
+
+def update_features(season: str, store_dir: str = STORE_DIR, historical_dir: str = HISTORICAL_DIR,
+                    rebuild: bool = False) -> Dict[str, Any]:
+    """
+    Store the features of the GWs that are not stored yet. Everything is computed again after a change of
+    an already stored GW (or of FEATURES_VERSION), or with `rebuild`. Return the manifest.
+    """
+    gws_df = read_table(season, "gws", columns=GWS_COLS, historical_dir=historical_dir, store_dir=store_dir)
+    gws_df = gws_df[gws_df['element'].notna() & gws_df['GW'].notna()]
+    fingerprints = get_fingerprints(gws_df)
+    manifest = read_features_manifest(season, store_dir)
+    stored = dict() if rebuild or not manifest or manifest.get("version") != FEATURES_VERSION else manifest["gws"]
+    new_gws = sorted(int(gw) for gw in fingerprints if gw not in stored)
+    if stored and (any(fingerprints.get(gw) != fingerprint for gw, fingerprint in stored.items())
+                   or (new_gws and new_gws[0] < max(int(gw) for gw in stored))):
+        logger.info("The stored GWs of %s have changed, computing all the features again", season)
+        stored = dict()
+        new_gws = sorted(int(gw) for gw in fingerprints)
+    if not new_gws:
+        return manifest or {"season": season, "version": FEATURES_VERSION, "gws": dict()}
+
+    features_dir = os.path.join(store_dir, season, FEATURES_DIR)
+    if not stored:
+        shutil.rmtree(features_dir, ignore_errors=True)
+    os.makedirs(features_dir, exist_ok=True)
+    # only the sums - the last rows of a player may be older than the last stored GWs (e.g. after an injury)
+    history_df = read_features(season, columns=['element', 'GW'] + STORED_SUM_COLS,
+                               store_dir=store_dir) if stored else None
+    teams_df = read_table(season, "teams", historical_dir=historical_dir, store_dir=store_dir)
+    features_df = compute_features(get_gw_steps(gws_df[gws_df['GW'].isin(new_gws)], teams_df), history_df)
+
+    for gw, gw_df in features_df.groupby('GW'):
+        table = pa.Table.from_pandas(gw_df, preserve_index=False)
+        _replace(_gw_path(season, int(gw), store_dir), lambda path: pq.write_table(table, path))
+    manifest = {"season": season, "version": FEATURES_VERSION,
+                "gws": {**stored, **{str(gw): fingerprints[str(gw)] for gw in new_gws}}}
+
+    def write_manifest(path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=2)
+    _replace(os.path.join(features_dir, MANIFEST_FILE), write_manifest)
+    logger.info("Features of %s: GW(s) %s stored (%d rows)", season,
+                f"{new_gws[0]}-{new_gws[-1]}" if len(new_gws) > 1 else new_gws[0], len(features_df))
+    return manifest
+
+
+def read_features(season: str, gws: Optional[List[int]] = None, columns: Optional[List[str]] = None,
+                  store_dir: str = STORE_DIR) -> pd.DataFrame:
+    """Stored rows of the given GWs (default: all of them), as they are - see update_features"""
+    manifest = read_features_manifest(season, store_dir) or {"gws": dict()}
+    gws = sorted(int(gw) for gw in manifest["gws"]) if gws is None else gws
+    if not gws:
+        return pd.DataFrame(columns=columns or ['element', 'GW'] + STORED_SUM_COLS + ROLLING_FEATURES)
+    return pq.read_table([_gw_path(season, gw, store_dir) for gw in gws], columns=columns).to_pandas()
+
+
+def latest_features(features_df: pd.DataFrame, gw: Optional[int] = None) -> pd.DataFrame:
+    """The last state of every player after GW `gw` (default: the last one), indexed by element"""
+    if gw is not None:
+        features_df = features_df[features_df['GW'] <= gw]
+    latest_df = features_df.sort_values(['element', 'GW']).groupby('element').tail(1)
+    return latest_df.set_index('element')[ROLLING_FEATURES]
+
+
+def _no_features() -> pd.DataFrame:
+    return pd.DataFrame(columns=ROLLING_FEATURES, index=pd.Index([], name='element'), dtype=float)
+
+
+def get_latest_features(season: str, gw: Optional[int] = None, store_dir: str = STORE_DIR,
+                        historical_dir: str = HISTORICAL_DIR) -> pd.DataFrame:
+    """
+    The features of every player after GW `gw` (default: the last stored one), the store updated first.
+    Empty if the season has no gameweek history, e.g. before the current one is collected by backfill.py.
+    """
+    if not has_history(season, store_dir, historical_dir):
+        return _no_features()
+    manifest = update_features(season, store_dir, historical_dir)
+    gws = sorted(int(stored_gw) for stored_gw in manifest["gws"] if gw is None or int(stored_gw) <= gw)
+    return latest_features(read_features(season, gws, store_dir=store_dir))
+
+
+def get_current_features(fixtures_df: pd.DataFrame, store_dir: str = STORE_DIR,
+                         historical_dir: str = HISTORICAL_DIR) -> pd.DataFrame:
+    """
+    The features of the players of the fixtures' season after its last finished GW, so a replayed moment of a past
+    season (see backtest.py) doesn't see the GWs after it. The IDs of the players change between seasons -
+    nothing is carried over from the previous one, before the first GW the frame is empty.
+    """
+    finished = fixtures_df.loc[fixtures_df['finished'] == True, 'event']
+    if finished.empty:
+        return _no_features()
+    return get_latest_features(get_actual_season(fixtures_df), int(finished.max()), store_dir, historical_dir)
+
+
+def get_features_before(season: str, elements: pd.Series, gws: pd.Series, store_dir: str = STORE_DIR,
+                        historical_dir: str = HISTORICAL_DIR) -> pd.DataFrame:
+    """The features of the players before the GWs (after the last GW of the player before), aligned with `elements`"""
+    keys_df = pd.DataFrame({'element': elements.fillna(-1).astype('int64').to_numpy(),
+                            'GW': gws.fillna(0).astype('int64').to_numpy(), 'row': np.arange(len(elements))})
+    if has_history(season, store_dir, historical_dir):
+        update_features(season, store_dir, historical_dir)
+    features_df = read_features(season, columns=['element', 'GW'] + ROLLING_FEATURES, store_dir=store_dir)
+    features_df = features_df.astype({'element': 'int64', 'GW': 'int64', **dict.fromkeys(ROLLING_FEATURES, float)})
+    before_df = pd.merge_asof(keys_df.sort_values('GW'), features_df.sort_values('GW'), on='GW', by='element',
+                              allow_exact_matches=False)
+    return before_df.sort_values('row')[ROLLING_FEATURES].set_axis(elements.index)
+
+
+def join_features(players_df: pd.DataFrame, features_df: pd.DataFrame, id_col: str = 'id') -> pd.DataFrame:
+    """`players_df` with the ROLLING_FEATURES of its players (NaN for players without a history)"""
+    features = features_df.reindex(players_df[id_col].astype(int).to_numpy())
+    return players_df.assign(**{col: features[col].to_numpy(dtype=float) for col in ROLLING_FEATURES})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the rolling player features of the stored seasons")
+    parser.add_argument("--seasons", nargs="+", help="only these seasons (default: every season in the store "
+                                                     "or in the historical folder)")
+    parser.add_argument("--rebuild", action="store_true", help="compute every GW again, even if it is stored")
+    args = parser.parse_args()
+    setup_logging()
+    seasons = args.seasons or sorted({os.path.basename(path) for pattern in (STORE_DIR, HISTORICAL_DIR)
+                                      for path in glob.glob(os.path.join(pattern, "*-*")) if os.path.isdir(path)})
+    for features_season in seasons:
+        if has_history(features_season):
+            update_features(features_season, rebuild=args.rebuild)
+        else:
+            logger.warning("No gameweek history of %s, skipped", features_season)
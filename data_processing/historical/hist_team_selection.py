@@ -1,17 +1,26 @@
+import logging
 from typing import Dict
 
 import pandas as pd
 
-from ..constants import LIMITS
+from ..constants import BUDGET, LIMITS
+from ..tools.optimizer import select_optimal_team
+from ..tools.logs import RejectionStats
+from ..tools.player_view import PlayerView, iter_players, players_to_frame
+from ..tools.profiling import profiled
 from ..tools.utils import check_total_limit_reached
 
+logger = logging.getLogger(__name__)
+
 # Check team limits
-def check_one_team_limit_reached(clubs_usage: Dict[str, int], team: str, player_data: pd.Series):
+def check_one_team_limit_reached(clubs_usage: Dict[str, int], team: str, player_data: PlayerView):
     check = False
     if clubs_usage.get(team):
         if clubs_usage[team] >= LIMITS['one_team']:
-            print(
-                f"Rejected: {player_data['first_name']} {player_data['second_name']} from {team} exceeded the limit for same team players")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Rejected: %s %s from %s exceeded the limit for same team players",
+                             player_data.first_name, player_data.second_name, team,
+                             extra={"player_id": player_data.id, "reason": "club limit"})
             check = True
     else:
         clubs_usage[team] = 0
@@ -19,12 +28,15 @@ def check_one_team_limit_reached(clubs_usage: Dict[str, int], team: str, player_
 
 
 # Check position limits
-def check_position_limit_reached(position_usage: Dict[str, int], position: str, player_data: pd.Series):
+def check_position_limit_reached(position_usage: Dict[str, int], position: str, player_data: PlayerView):
     check = False
     if position_usage.get(position):
         if position_usage[position] >= LIMITS['position'][position]:
-            print(f"Rejected: {player_data['first_name']} {player_data['second_name']}'s position: {position} "
-                  f"exceeded the limit: {LIMITS['position'][position]}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Rejected: %s %s's position: %s exceeded the limit: %d",
+                             player_data.first_name, player_data.second_name, position,
+                             LIMITS['position'][position],
+                             extra={"player_id": player_data.id, "reason": "position limit"})
             check = True
     else:
         position_usage[position] = 0
@@ -45,15 +57,30 @@ def get_best_players(players_df: pd.DataFrame, condition: str, position=None, n=
     if position:
         players_df = players_df[players_df['position'] == position]
 
-    print(f"Found best {condition} player(s) | Target position? {position}")
+    logger.debug("Found best %s player(s) | Target position? %s", condition, position)
     best_player = players_df.head(n)
     return best_player
 
 
-def select_my_team(candidates_df: pd.DataFrame) -> pd.DataFrame:
+@profiled()
+def select_my_team(candidates_df: pd.DataFrame, exact: bool = False) -> pd.DataFrame:
+    if exact:
+        # The best predicted squad within the budget
+        return select_optimal_team(candidates_df, score_col="predicted_ppg")
+
+    logger.info("Greedy selection among %d candidates", len(candidates_df))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    stats = RejectionStats(logger)
+    PERF_IDX = 0
+    VALUE_IDX = 1
+    # found and turned into player views once - every pass takes the first 10 * bp_limit best performers
+    best_performers = list(iter_players(get_best_players(candidates_df, condition='performance',
+                                                         n=10 * LIMITS['all'])))
+    best_value = list(iter_players(get_best_players(candidates_df, condition='value', n=20 * LIMITS['all'])))
     my_team = list()
     for bp_limit in range(LIMITS['all'] + 1):
-        wallet = 1000
+        wallet = BUDGET
+        stats.passes += 1
 
         selected_ids = set()
         prev_team = my_team
@@ -62,50 +89,55 @@ def select_my_team(candidates_df: pd.DataFrame) -> pd.DataFrame:
         my_team = list()
         bp_counter = 0
 
-        PERF_IDX = 0
-        VALUE_IDX = 1
         suggested_candidates = {
-            PERF_IDX: get_best_players(candidates_df, condition='performance', n=10 * bp_limit),
-            VALUE_IDX: get_best_players(candidates_df, condition='value', n=20 * LIMITS['all']),
+            PERF_IDX: best_performers[:10 * bp_limit],
+            VALUE_IDX: best_value,
         }
 
         for condition, found_players in (suggested_candidates.items()):
-            for i, player_data in found_players.iterrows():
+            for player_data in found_players:
 
-                if player_data['id'] in selected_ids:
+                if player_data.id in selected_ids:
                     continue
                 if check_total_limit_reached(my_team):
                     break
 
-                position = player_data["position"]
-                team = player_data["team_name"]
+                position = player_data.position
+                team = player_data.team_name
 
                 # Check other limits
                 team_limit, clubs_usage = check_one_team_limit_reached(clubs_usage, team, player_data)
                 if team_limit:
+                    stats.reject("club limit")
                     continue
                 position_limit, position_usage = check_position_limit_reached(position_usage, position, player_data)
                 if position_limit:
+                    stats.reject("position limit")
                     continue
 
                 # Best performing players - check limit, update counter
                 if condition == PERF_IDX:
                     if bp_counter >= bp_limit:
-                        print("The best performing players limit reached")
+                        logger.debug("The best performing players limit reached")
                         break
                     bp_counter += 1
 
                 # Update wallet
-                print(
-                    f"Approved: {player_data['first_name']} {player_data['second_name']} ({position}@{team}) added to team")
                 my_team.append(player_data)
-                selected_ids.add(player_data['id'])
-                print(f"Collected players: {len(my_team)}")
+                selected_ids.add(player_data.id)
                 clubs_usage[team] += 1
                 position_usage[position] += 1
-                wallet -= player_data['now_cost']
-                print(f"Budget remained: {wallet}")
+                wallet -= player_data.now_cost
+                if debug:
+                    logger.debug("Approved: %s %s (%s@%s) added to team | collected players: %d, budget remained: %d",
+                                 player_data.first_name, player_data.second_name, position, team,
+                                 len(my_team), wallet, extra={"player_id": player_data.id, "wallet": wallet})
 
                 if wallet < 0:
+                    stats.reject("budget")
                     my_team = prev_team
-                    return pd.DataFrame(my_team)
+                    stats.log_summary(len(my_team))
+                    return players_to_frame(my_team)
+
+    stats.log_summary(len(my_team))
+    return players_to_frame(my_team)
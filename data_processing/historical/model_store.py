@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import xgboost as xgb
+
+from ..constants import CACHE_DIR
+
+# Fitted models, one directory per hash of their inputs
+MODELS_DIR = os.path.join(CACHE_DIR, "models")
+MODEL_FILE = "model.ubj"
+META_FILE = "meta.json"
+
+
+def get_model_key(season_dirs: List[str], features: List[str], search_space: Dict[str, Any],
+                  params: Dict[str, Any]) -> str:
+    """Hash everything the model depends on: contents of the season directories, features and hyperparameters"""
+    digest = hashlib.sha256()
+    for season_dir in season_dirs:
+        for root, dirs, files in os.walk(season_dir):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                digest.update(os.path.relpath(file_path, season_dir).encode())
+                with open(file_path, "rb") as file:
+                    for chunk in iter(lambda: file.read(1 << 20), b""):
+                        digest.update(chunk)
+    digest.update(json.dumps([features, search_space, params], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def load_model(model_key: str) -> Optional[Tuple[xgb.Booster, Dict[str, Any]]]:
+    """Return the saved model and its metadata, or None if no model was saved under this key"""
+    model_dir = os.path.join(MODELS_DIR, model_key)
+    try:
+        with open(os.path.join(model_dir, META_FILE), encoding="utf-8") as file:
+            meta = json.load(file)
+        model = xgb.Booster()
+        model.load_model(os.path.join(model_dir, MODEL_FILE))
+    except (OSError, ValueError, xgb.core.XGBoostError):
+        return None
+    return model, meta
+
+
+def save_model(model_key: str, model: xgb.Booster, meta: Dict[str, Any]) -> str:
+    model_dir = os.path.join(MODELS_DIR, model_key)
+    os.makedirs(model_dir, exist_ok=True)
+    meta_path = os.path.join(model_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    model.save_model(os.path.join(model_dir, MODEL_FILE))
+    # written last - a directory without metadata is not a complete model
+    with open(meta_path, "w", encoding="utf-8") as file:
+        json.dump(meta, file, indent=2, default=float)
+    return model_dir
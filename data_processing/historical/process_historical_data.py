@@ -1,62 +1,187 @@
 import os
+import logging
 import pandas as pd
-from typing import Dict
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import xgboost as xgb
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error
-import optuna
 
-from ..constants import BASE_URL, DATA_DIR
-from ..tools.utils import get_actual_season_start_year, get_past_seasons_years
+from ..constants import BASE_URL, DATA_DIR, HIST_SEASONS, PLAYER_FEATURES
+from ..tools.utils import get_actual_season_start_year, get_past_seasons
 from ..tools.fpl_api import get_base_api_data, load_fixtures
+from .feature_store import (FEATURES_VERSION, ROLLING_FEATURES, get_current_features, get_features_before,
+                            get_latest_features, join_features)
 from .hist_team_selection import select_my_team
+from .model_store import get_model_key, load_model, save_model
+from .season_store import read_table
+from .tuning import BASE_PARAMS, N_JOBS, N_TRIALS, SEARCH_SPACE, tune_hyperparameters
 from ..tools.metrics import get_metrics
+from ..tools.pipeline import Pipeline
+from ..tools.profiling import profiled
+from ..tools.schema import as_category
+
+logger = logging.getLogger(__name__)
+
+# Positions in the gameweek files (gws/merged_gw.csv) -> element_type
+GW_POSITIONS = {"GK": 1, "GKP": 1, "DEF": 2, "MID": 3, "FWD": 4}
+# Season totals shown by the API, rebuilt from the gameweek files for every match
+GW_CUMULATIVE_COLS = ['expected_goal_involvements', 'expected_goals_conceded', 'ict_index', 'starts', 'minutes']
+
+
+def get_features(rolling: bool = False) -> List[str]:
+    """Columns of the datasets: PLAYER_FEATURES, then the rolling features of the feature store"""
+    return PLAYER_FEATURES + (ROLLING_FEATURES if rolling else [])
+
+
+class DatasetIter(xgb.DataIter):
+    """Feed XGBoost one dataset (season) at a time, so the whole training set never has to be held as one frame"""
+
+    def __init__(self, loaders: List[Callable[[], pd.DataFrame]], predict_attr: str):
+        self.loaders = loaders
+        self.predict_attr = predict_attr
+        self._it = 0
+        super().__init__()
+
+    def next(self, input_data: Callable) -> bool:
+        if self._it == len(self.loaders):
+            return False
+        dataset_df = self.loaders[self._it]()
+        input_data(data=dataset_df.drop(self.predict_attr, axis=1), label=dataset_df[self.predict_attr])
+        self._it += 1
+        return True
+
+    def reset(self) -> None:
+        self._it = 0
 
 
 class HistoricalDataProcessor:
-    def __init__(self):
-        self.elements_df = get_base_api_data("elements")  # mostly info about PLAYERS from actual season
-        self.element_types_df = get_base_api_data("element_types")
-        self.teams_df = get_base_api_data("teams")
-        self.selected_team = None
-        self.model = xgb.XGBRegressor()
-        self.launch_pipeline()
-
-    def launch_pipeline(self):
-        past_seasons = HistoricalDataProcessor.get_past_season_dates()
-        prev_season_df = self.prepare_dataset(os.path.join(DATA_DIR, "historical", past_seasons['prev']))
-        last_season_df = self.prepare_dataset(os.path.join(DATA_DIR, "historical", past_seasons['last']))
-        # Train and fine-tune the model on data from last 2 seasons
-        self.train_model(prev_season_df, last_season_df, predict_attr="points_per_game")
-
-        actual_set = self.prepare_dataset_from_api()
+    """
+    Preseason pipeline: past seasons -> model (loaded or trained) -> predictions for the API players ->
+    candidates -> selected squad. Every stage is computed lazily and only once, see `Pipeline`.
+    """
+
+    def __init__(self, exact: bool = False, retrain: bool = False, n_seasons: int = HIST_SEASONS,
+                 gw_level: bool = False, rolling: bool = False):
+        if n_seasons < 2:
+            raise ValueError(f"At least 2 past seasons are needed to train the model, got: {n_seasons}")
+        self.pipeline = Pipeline()
+        # Use the exact optimizer instead of the greedy selection
+        self.pipeline.add_input("exact", exact)
+        # Train the model even if a saved one was trained on the same data
+        self.pipeline.add_input("retrain", retrain)
+        self.pipeline.add_input("n_seasons", n_seasons)
+        # Train on one row per player per match (gws/merged_gw.csv) instead of one row per player per season
+        self.pipeline.add_input("gw_level", gw_level)
+        # Add the rolling features of the feature store (form in the last GWs, minutes share, xGI per 90...)
+        self.pipeline.add_input("rolling", rolling)
+        # mostly info about PLAYERS from actual season
+        self.pipeline.add_stage("api_elements", partial(get_base_api_data, "elements"))
+        self.pipeline.add_stage("api_element_types", partial(get_base_api_data, "element_types"))
+        self.pipeline.add_stage("api_teams", partial(get_base_api_data, "teams"))
+
+        self.pipeline.add_stage("seasons", self.get_past_season_dates, ["n_seasons"])
+        self.pipeline.add_stage("rolling_features", self.get_rolling_features, ["rolling"])
+        self.pipeline.add_stage("use_rolling", self.uses_rolling_features, ["rolling_features"])
+        self.pipeline.add_stage("model", self.get_model, ["seasons", "gw_level", "retrain", "use_rolling"])
+        self.pipeline.add_stage("dataset", self.prepare_dataset_from_api,
+                                ["api_elements", "api_teams", "rolling_features"])
+        self.pipeline.add_stage("candidates", self.get_candidates,
+                                ["model", "dataset", "api_elements", "api_element_types", "api_teams"])
+        # Finally select the team based on AI predictions
+        self.pipeline.add_stage("selected_team", select_my_team, ["candidates", "exact"])
+
+    def launch_pipeline(self) -> pd.DataFrame:
+        return self.pipeline["selected_team"]
+
+    @property
+    def selected_team(self) -> pd.DataFrame:
+        return self.pipeline["selected_team"]
+
+    @property
+    def model(self) -> xgb.Booster:
+        return self.pipeline["model"][0]
+
+    @property
+    def model_meta(self) -> Dict[str, Any]:
+        return self.pipeline["model"][1]
+
+    def get_model(self, past_seasons: List[str], gw_level: bool, retrain: bool,
+                  rolling: bool = False) -> Tuple[xgb.Booster, Dict[str, Any]]:
+        """Load the model trained on the same data, or train (and save) a new one"""
+        season_dirs = [os.path.join(DATA_DIR, "historical", season) for season in past_seasons]
+
+        params = {**BASE_PARAMS, "gw_level": gw_level}
+        if rolling:
+            params["rolling_features"] = FEATURES_VERSION
+        model_key = get_model_key(season_dirs, get_features(rolling), SEARCH_SPACE, params)
+        saved_model = None if retrain else load_model(model_key)
+        if saved_model:
+            logger.info("Using the model trained on the same data: %s", model_key)
+            return saved_model
+
+        load_dataset = partial(self.prepare_gw_dataset if gw_level else self.prepare_dataset, rolling=rolling)
+        # Train on the older seasons (loaded one at a time), fine-tune and evaluate on the last one
+        train_loaders = [partial(load_dataset, season_dir) for season_dir in season_dirs[:-1]]
+        last_season_df = load_dataset(season_dirs[-1])
+        model, model_meta = self.train_model(train_loaders, last_season_df, predict_attr="points_per_game",
+                                             study_name=f"xgb-{past_seasons[0]}-{past_seasons[-1]}-{model_key[:12]}")
+        save_model(model_key, model, model_meta)
+        return model, model_meta
+
+    def get_candidates(self, fitted_model: Tuple[xgb.Booster, Dict[str, Any]], actual_set: pd.DataFrame,
+                       elements_df: pd.DataFrame, element_types_df: pd.DataFrame,
+                       teams_df: pd.DataFrame) -> pd.DataFrame:
+        model, _ = fitted_model
         X_actual = actual_set.drop('points_per_game', axis=1)
-        y_actual_preds = self.model.predict(X_actual).round(1)
+        y_actual_preds = model.predict(xgb.DMatrix(X_actual)).round(1)
 
         candidates_df = actual_set.drop('points_per_game', axis=1)
         candidates_df["predicted_ppg"] = y_actual_preds.round(2)
         candidates_df["predicted_value"] = candidates_df["predicted_ppg"] / candidates_df["now_cost"] * 10
-        candidates_df_filtered = self.clean_candidates_dataset(candidates_df)
-        # Finally select the team based on AI predictions
-        self.selected_team = select_my_team(candidates_df_filtered)
+        return self.clean_candidates_dataset(candidates_df, elements_df, element_types_df, teams_df)
+
+    @staticmethod
+    def get_rolling_features(rolling: bool) -> Optional[pd.DataFrame]:
+        """
+        Rolling features of the players after the last finished GW (if they are used). Before the first GW of
+        the season there are none (the players' IDs change between seasons) - the model goes without them then,
+        rather than being trained with the features and predicting from nulls.
+        """
+        if not rolling:
+            return None
+        rolling_features_df = get_current_features(load_fixtures())
+        if rolling_features_df.empty:
+            logger.warning("No rolling features of the current season yet (no GW collected, see backfill.py) - "
+                           "the model is trained and used without them")
+            return None
+        return rolling_features_df
+
+    @staticmethod
+    def uses_rolling_features(rolling_features_df: Optional[pd.DataFrame]) -> bool:
+        """The model is trained with the rolling features only if the players have them to be predicted from"""
+        return rolling_features_df is not None
 
     @staticmethod
-    def get_past_season_dates() -> Dict[str, str]:
+    def get_past_season_dates(n_seasons: int = HIST_SEASONS) -> List[str]:
         fixtures_df = load_fixtures()
         act_start_year = get_actual_season_start_year(fixtures_df)
-        past_seasons_dates = get_past_seasons_years(act_start_year)
+        past_seasons_dates = get_past_seasons(act_start_year, n_seasons)
         return past_seasons_dates
 
-    def clean_candidates_dataset(self, candidates_df: pd.DataFrame):
+    @staticmethod
+    def clean_candidates_dataset(candidates_df: pd.DataFrame, elements_df: pd.DataFrame,
+                                 element_types_df: pd.DataFrame, teams_df: pd.DataFrame):
         candidates_df.team = candidates_df.team.astype(int)
         candidates_df.id = candidates_df.id.astype(int)
         candidates_df.element_type = candidates_df.element_type.astype(int)
 
-        candidates_df['team_name'] = self.elements_df.team.map(self.teams_df.set_index('id').name)
-        candidates_df['position'] = self.elements_df.element_type.map(self.element_types_df.set_index('id').singular_name)
-        candidates_df['first_name'] = self.elements_df.id.map(self.elements_df.set_index('id').first_name)
-        candidates_df['second_name'] = self.elements_df.id.map(self.elements_df.set_index('id').second_name)
+        candidates_df['team_name'] = as_category(elements_df.team.map(teams_df.set_index('id').name), teams_df.name)
+        candidates_df['position'] = as_category(
+            elements_df.element_type.map(element_types_df.set_index('id').singular_name),
+            element_types_df.singular_name)
+        candidates_df['first_name'] = elements_df.id.map(elements_df.set_index('id').first_name)
+        candidates_df['second_name'] = elements_df.id.map(elements_df.set_index('id').second_name)
 
         # Cut off players not expected to be playing
         threshold = 0.6 * candidates_df['starts'].max()
@@ -64,82 +189,108 @@ class HistoricalDataProcessor:
 
         return candidates_df_filtered
 
-    def train_model(self, prev_season_data: pd.DataFrame, last_season_data: pd.DataFrame, predict_attr: str):
-        X_train = prev_season_data.drop(predict_attr, axis=1)
-        y_train = prev_season_data[predict_attr]
-
-        val_set, test_set = train, test = train_test_split(last_season_data, test_size=0.4)
+    @profiled()
+    def train_model(self, train_loaders: List[Callable[[], pd.DataFrame]], last_season_data: pd.DataFrame,
+                    predict_attr: str, study_name: str,
+                    n_trials: int = N_TRIALS) -> Tuple[xgb.Booster, Dict[str, Any]]:
+        # Fixed split, so the trials of a resumed study are evaluated on the same validation set
+        val_set, test_set = train_test_split(last_season_data, test_size=0.4, random_state=0)
         X_val = val_set.drop(predict_attr, axis=1)
         y_val = val_set[predict_attr]
 
         X_test = test_set.drop(predict_attr, axis=1)
         y_test = test_set[predict_attr]
 
-        self.model.fit(X_train, y_train)
+        # Quantized ('hist') matrices - built batch by batch and much smaller than the source frames
+        dtrain = xgb.QuantileDMatrix(DatasetIter(train_loaders, predict_attr), nthread=N_JOBS)
+        dval = xgb.QuantileDMatrix(X_val, label=y_val, ref=dtrain, nthread=N_JOBS)
+        dtest = xgb.QuantileDMatrix(X_test, ref=dtrain, nthread=N_JOBS)
+
+        # Baseline model with default hyperparameters
+        model = xgb.train({**BASE_PARAMS, "nthread": N_JOBS}, dtrain)
         # Optionally log the metrics
-        y_preds = self.model.predict(X_test).round(1)
+        y_preds = model.predict(dtest).round(1)
         get_metrics(y_test, y_preds)
 
-        # for Optuna optimization
-        def objective(trial):
-            params = {
-                "objective": "reg:squarederror",
-                "learning_rate": trial.suggest_float("learning_rate", 1e-3, 0.1, log=True),
-                "max_depth": trial.suggest_int("max_depth", 1, 10),
-            }
-            model = xgb.XGBRegressor(**params)
-            model.fit(X_train, y_train, verbose=False)
-            predictions = model.predict(X_val)
-            rmse = mean_squared_error(y_val, predictions, squared=False)
-            return rmse
-
-        study = optuna.create_study(direction='minimize')
-        study.optimize(objective, n_trials=100)
-        print('Best hyperparameters:', study.best_params)
-        print('Best RMSE:', study.best_value)
-
-        self.model = xgb.XGBRegressor(**study.best_params)
-        self.model.fit(X_train, y_train, verbose=False)
+        best_params, num_boost_round = tune_hyperparameters(dtrain, dval, study_name, n_trials)
+
+        model = xgb.train({**BASE_PARAMS, "nthread": N_JOBS, **best_params}, dtrain, num_boost_round)
 
         # Optionally log the metrics
-        y_preds = self.model.predict(X_test).round(1)
-        get_metrics(y_test, y_preds)
+        y_preds = model.predict(dtest).round(1)
+        model_meta = {
+            "params": best_params,
+            "num_boost_round": num_boost_round,
+            "metrics": get_metrics(y_test, y_preds),
+        }
+        return model, model_meta
 
-    def prepare_dataset(self, dir_path: str):
-        # Relevant
-        teams_map_df = pd.read_csv(os.path.join(dir_path, "teams.csv"), index_col=False)
-        players_df = pd.read_csv(os.path.join(dir_path, "players_raw.csv"))
-        players_df['team_name'] = players_df.team.map(teams_map_df.set_index('id').name)
-        players_df['position'] = players_df.element_type.map(self.element_types_df.set_index('id').singular_name)
+    @profiled()
+    def prepare_dataset(self, dir_path: str, rolling: bool = False):
+        # Relevant columns only, from the columnar store
+        season, historical_dir = os.path.basename(dir_path), os.path.dirname(dir_path)
+        teams_map_df = read_table(season, "teams", columns=['id', 'strength'], historical_dir=historical_dir)
+        player_cols = [col for col in PLAYER_FEATURES if col != 'team_strength']
+        players_df = read_table(season, "players", columns=player_cols, historical_dir=historical_dir)
         players_df['team_strength'] = players_df.team.map(teams_map_df.set_index('id').strength)
+        if rolling:
+            # the state of the players after the last GW, like the season totals
+            players_df = join_features(players_df, get_latest_features(season, historical_dir=historical_dir))
 
-        player_filtered = [
-            'id', 'team', 'now_cost', 'expected_goal_involvements', 'expected_goals_conceded', 'ict_index',
-            'element_type', 'team_strength', 'points_per_game', 'starts', 'minutes']  # 'transfers_in', 'transfers_out'
-
-        players_df_filtered = players_df[player_filtered]
+        players_df_filtered = players_df[get_features(rolling)]
         players_df_filtered.dropna()
 
-        print(f"\nDataset created! Source: {dir_path}\n")
+        logger.info("Dataset created! Source: %s", dir_path)
 
         return players_df_filtered
 
-    def prepare_dataset_from_api(self):
-        # supplement actual data
-        self.elements_df['team_name'] = self.elements_df.team.map(self.teams_df.set_index('id').name)
-        self.elements_df['position'] = self.elements_df.element_type.map(self.element_types_df.set_index('id').singular_name)
-        self.elements_df['team_strength'] = self.elements_df.team.map(self.teams_df.set_index('id').strength)
+    @profiled()
+    def prepare_gw_dataset(self, dir_path: str, rolling: bool = False):
+        """
+        One row per player per match, with the season totals the API showed before that match.
+        The target is the number of points scored in the match.
+        """
+        season, historical_dir = os.path.basename(dir_path), os.path.dirname(dir_path)
+        teams_map_df = read_table(season, "teams", columns=['id', 'name', 'strength'], historical_dir=historical_dir)
+        gws_df = read_table(season, "gws", historical_dir=historical_dir,
+                            columns=['element', 'GW', 'team', 'position', 'kickoff_time', 'value', 'total_points']
+                            + GW_CUMULATIVE_COLS)
+        gws_df = gws_df.sort_values(['kickoff_time', 'element'], kind='stable')
 
-        # Move to constants?
-        player_filtered = ['id', 'team', 'now_cost', 'expected_goal_involvements', 'expected_goals_conceded',
-                           'ict_index', 'element_type', 'team_strength', 'points_per_game', 'starts', 'minutes']
+        team_ids = gws_df['team'].astype(object).map(teams_map_df.set_index('name').id)
+        before_match = gws_df.groupby('element')[GW_CUMULATIVE_COLS].cumsum() - gws_df[GW_CUMULATIVE_COLS]
+        players_df = pd.DataFrame({
+            'id': gws_df['element'],
+            'team': team_ids,
+            'now_cost': gws_df['value'],
+            'element_type': gws_df['position'].astype(object).map(GW_POSITIONS),
+            'team_strength': team_ids.map(teams_map_df.set_index('id').strength),
+            'points_per_game': gws_df['total_points'],
+            **before_match,
+        })
+        if rolling:
+            # the state of the players before the match's GW
+            players_df = pd.concat([players_df, get_features_before(season, gws_df['element'], gws_df['GW'],
+                                                                    historical_dir=historical_dir)], axis=1)
+        # Matches actually played by players from known teams/positions (e.g. assistant managers are skipped)
+        played = (gws_df['minutes'] > 0) & players_df['team'].notna() & players_df['element_type'].notna()
+        players_df_filtered = players_df.loc[played, get_features(rolling)]
 
-        players_df_filtered = self.elements_df[player_filtered]
-        players_df_filtered.dropna()
+        logger.info("Dataset created! Source: %s (%d matches)", dir_path, len(players_df_filtered))
+
+        return players_df_filtered
 
-        # convert all values to numerical ones
-        for col_name in players_df_filtered.columns:
-            players_df_filtered[col_name] = players_df_filtered[col_name].astype(float)
+    @staticmethod
+    def prepare_dataset_from_api(elements_df: pd.DataFrame, teams_df: pd.DataFrame,
+                                 rolling_features_df: Optional[pd.DataFrame] = None):
+        # supplement actual data
+        elements_df = elements_df.assign(team_strength=elements_df.team.map(teams_df.set_index('id').strength))
+        if rolling_features_df is not None:
+            elements_df = join_features(elements_df, rolling_features_df)
+
+        # the features are already numeric (see tools.schema), the model takes them as floats
+        players_df_filtered = elements_df[get_features(rolling_features_df is not None)].astype(float)
+        players_df_filtered.dropna()
 
-        print(f"\nDataset created! Source: {BASE_URL}\n")
+        logger.info("Dataset created! Source: %s", BASE_URL)
         return players_df_filtered
@@ -0,0 +1,259 @@
+"""
+Columnar copy of the historical data.
+Every season folder from vaastav's dump is converted once into typed, column-pruned Parquet files:
+[DATA_DIR]/store/<season>/{players,teams,gws,fixtures}.parquet plus a manifest.json with row counts and source checksums.
+A table is read after a cheap check of the size and modification time of its source; if they changed, the checksums
+tell whether the season has to be converted again.
+
+Usage: python -m data_processing.historical.season_store [--force]
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..constants import DATA_DIR, HISTORICAL_DIR
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = os.path.join(DATA_DIR, "store")
+MANIFEST_FILE = "manifest.json"
+# Bumped whenever the schemas change - stores of an older version are converted again
+STORE_VERSION = 2
+
+# Source file -> typed columns kept in the store. Columns missing in older seasons are stored as nulls.
+# Integers are nullable, text columns listed in CATEGORY_COLS are read back as categoricals.
+PLAYERS_SCHEMA = {
+    'id': 'Int32',
+    'first_name': 'string',
+    'second_name': 'string',
+    'web_name': 'string',
+    'team': 'Int16',
+    'element_type': 'Int8',
+    'now_cost': 'Int16',
+    'points_per_game': 'float32',
+    'total_points': 'Int16',
+    'starts': 'Int16',
+    'minutes': 'Int32',
+    'ict_index': 'float32',
+    'expected_goal_involvements': 'float32',
+    'expected_goals_conceded': 'float32',
+}
+TEAMS_SCHEMA = {
+    'id': 'Int16',
+    'name': 'string',
+    'strength': 'Int8',
+    'strength_overall_home': 'Int16',
+    'strength_overall_away': 'Int16',
+    'strength_attack_home': 'Int16',
+    'strength_attack_away': 'Int16',
+    'strength_defence_home': 'Int16',
+    'strength_defence_away': 'Int16',
+}
+GWS_SCHEMA = {
+    'element': 'Int32',
+    'GW': 'Int8',
+    'fixture': 'Int32',
+    'team': 'string',
+    'position': 'string',
+    'opponent_team': 'Int16',
+    'was_home': 'boolean',
+    'kickoff_time': 'string',
+    'minutes': 'Int16',
+    'starts': 'float32',
+    'total_points': 'Int16',
+    'value': 'Int16',
+    'selected': 'Int32',
+    'ict_index': 'float32',
+    'expected_goal_involvements': 'float32',
+    'expected_goals_conceded': 'float32',
+}
+FIXTURES_SCHEMA = {
+    'id': 'Int32',
+    'code': 'Int32',
+    'event': 'Int8',
+    'finished': 'boolean',
+    'kickoff_time': 'string',
+    'minutes': 'Int16',
+    'started': 'boolean',
+    'team_h': 'Int16',
+    'team_a': 'Int16',
+    'team_h_score': 'Int16',
+    'team_a_score': 'Int16',
+    'team_h_difficulty': 'Int8',
+    'team_a_difficulty': 'Int8',
+}
+TABLES = {
+    "players": ("players_raw.csv", PLAYERS_SCHEMA),
+    "teams": ("teams.csv", TEAMS_SCHEMA),
+    "gws": (os.path.join("gws", "merged_gw.csv"), GWS_SCHEMA),
+    "fixtures": ("fixtures.csv", FIXTURES_SCHEMA),
+}
+CATEGORY_COLS = ['team', 'position']
+# Rows read from a CSV file at once - bounds the memory used by the conversion of big files
+CHUNK_ROWS = 100_000
+
+
+def iter_typed_csv(csv_path: str, schema: Dict[str, str], chunksize: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Read only the columns in `schema`, chunk by chunk, parsed straight into their types"""
+    header = pd.read_csv(csv_path, nrows=0, encoding_errors="replace").columns
+    present = [col for col in schema if col in header]
+    dtypes = {col: schema[col] for col in present}
+    for chunk_df in pd.read_csv(csv_path, usecols=present, dtype=dtypes, chunksize=chunksize,
+                                encoding_errors="replace"):
+        for col, dtype in schema.items():
+            if col not in chunk_df:
+                chunk_df[col] = pd.Series(pd.NA, index=chunk_df.index, dtype=dtype)
+        yield chunk_df[list(schema)]
+
+
+def write_parquet(csv_path: str, schema: Dict[str, str], parquet_path: str) -> int:
+    """Stream a CSV file into a Parquet file, one row group per chunk. Return the number of rows."""
+    rows = 0
+    writer = None
+    try:
+        for chunk_df in iter_typed_csv(csv_path, schema):
+            table = pa.Table.from_pandas(chunk_df, preserve_index=False,
+                                         schema=writer.schema if writer else None)
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, table.schema)
+            writer.write_table(table)
+            rows += len(chunk_df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def file_checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    """Size and modification time of a file - a change of them is verified with the checksum"""
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def ingest_season(season: str, historical_dir: str = HISTORICAL_DIR, store_dir: str = STORE_DIR,
+                  force: bool = False) -> Dict[str, Any]:
+    """Convert one season folder into the store, unless it is already there and the sources haven't changed"""
+    season_dir = os.path.join(historical_dir, season)
+    season_store_dir = os.path.join(store_dir, season)
+    manifest = read_manifest(season, store_dir)
+    sources = {name: os.path.join(season_dir, csv_name) for name, (csv_name, _) in TABLES.items()}
+    sources = {name: path for name, path in sources.items() if os.path.exists(path)}
+    if not sources:
+        raise FileNotFoundError(f"No historical data found in: {season_dir}")
+
+    checksums = {name: file_checksum(path) for name, path in sources.items()}
+    fingerprints = {name: file_fingerprint(path) for name, path in sources.items()}
+    if (not force and manifest and manifest.get("version") == STORE_VERSION
+            and {name: manifest["tables"].get(name, dict()).get("checksum") for name in sources} == checksums):
+        # only touched - the next reads don't have to compute the checksums again
+        if any(manifest["tables"][name].get("fingerprint") != fingerprint
+               for name, fingerprint in fingerprints.items()):
+            for name, fingerprint in fingerprints.items():
+                manifest["tables"][name]["fingerprint"] = fingerprint
+            _write_manifest(season, manifest, store_dir)
+        return manifest
+
+    os.makedirs(season_store_dir, exist_ok=True)
+    # the tables written from the API stay
+    api_tables = {name: table for name, table in (manifest or dict()).get("tables", dict()).items()
+                  if table.get("checksum") is None and name not in sources}
+    manifest = {"season": season, "version": STORE_VERSION, "tables": api_tables}
+    for name, csv_path in sources.items():
+        rows = write_parquet(csv_path, TABLES[name][1], os.path.join(season_store_dir, f"{name}.parquet"))
+        manifest["tables"][name] = {
+            "source": os.path.relpath(csv_path, season_dir),
+            "rows": rows,
+            "checksum": checksums[name],
+            "fingerprint": fingerprints[name],
+        }
+    _write_manifest(season, manifest, store_dir)
+    logger.info("Season %s stored: %s", season,
+                ", ".join(f"{name} ({table['rows']} rows)" for name, table in manifest["tables"].items()))
+    return manifest
+
+
+def ingest_all(historical_dir: str = HISTORICAL_DIR, store_dir: str = STORE_DIR, force: bool = False) -> List[str]:
+    seasons = sorted(os.path.basename(path) for path in glob.glob(os.path.join(historical_dir, "*-*"))
+                     if os.path.isdir(path))
+    for season in seasons:
+        ingest_season(season, historical_dir, store_dir, force)
+    return seasons
+
+
+def read_manifest(season: str, store_dir: str = STORE_DIR) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(store_dir, season, MANIFEST_FILE), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(season: str, manifest: Dict[str, Any], store_dir: str = STORE_DIR) -> None:
+    with open(os.path.join(store_dir, season, MANIFEST_FILE), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def is_stale(season: str, name: str, manifest: Dict[str, Any], historical_dir: str = HISTORICAL_DIR) -> bool:
+    """Whether the source of a stored table changed since its conversion (never for the tables written from the API)"""
+    table = manifest["tables"].get(name)
+    if table is None or table.get("checksum") is None:
+        return False
+    source = os.path.join(historical_dir, season, table["source"])
+    # a store without its sources is still valid
+    return os.path.exists(source) and file_fingerprint(source) != table.get("fingerprint")
+
+
+def write_table(season: str, name: str, df: pd.DataFrame, schema: Dict[str, str], source: str,
+                store_dir: str = STORE_DIR) -> Dict[str, Any]:
+    """Store a table collected some other way than from a CSV file (e.g. from the API) and add it to the manifest"""
+    season_store_dir = os.path.join(store_dir, season)
+    os.makedirs(season_store_dir, exist_ok=True)
+    typed_df = pd.DataFrame({col: (df[col] if col in df else pd.Series(pd.NA, index=df.index)).astype(dtype)
+                             for col, dtype in schema.items()})
+    path = os.path.join(season_store_dir, f"{name}.parquet")
+    pq.write_table(pa.Table.from_pandas(typed_df, preserve_index=False), f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+    manifest = read_manifest(season, store_dir) or {"season": season, "version": STORE_VERSION, "tables": dict()}
+    manifest["tables"][name] = {"source": source, "rows": len(typed_df), "checksum": None}
+    _write_manifest(season, manifest, store_dir)
+    return manifest
+
+
+def read_table(season: str, name: str, columns: Optional[List[str]] = None,
+               historical_dir: str = HISTORICAL_DIR, store_dir: str = STORE_DIR) -> pd.DataFrame:
+    """
+    Read (memory-mapped) only the needed columns of a stored table;
+    the season is ingested on first use and again after a change of the schemas or of the source files
+    """
+    path = os.path.join(store_dir, season, f"{name}.parquet")
+    manifest = read_manifest(season, store_dir)
+    if (manifest is None or manifest.get("version") != STORE_VERSION or not os.path.exists(path)
+            or is_stale(season, name, manifest, historical_dir)):
+        ingest_season(season, historical_dir, store_dir)
+    table = pq.read_table(path, columns=columns, memory_map=True,
+                          read_dictionary=[col for col in CATEGORY_COLS if columns is None or col in columns])
+    return table.to_pandas(ignore_metadata=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the historical seasons into the columnar store")
+    parser.add_argument("--force", action="store_true", help="convert the seasons even if they are up to date")
+    stored = ingest_all(force=parser.parse_args().force)
+    print(f"Seasons in the store: {stored}")
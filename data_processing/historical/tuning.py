@@ -0,0 +1,126 @@
+import logging
+import os
+import threading
+from typing import Any, Dict, Tuple
+
+import optuna
+import xgboost as xgb
+
+from ..constants import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Optuna studies are kept here, so the tuning can be resumed or reused by the next runs
+OPTUNA_STORAGE = f"sqlite:///{os.path.join(CACHE_DIR, 'optuna.db')}"
+N_TRIALS = 100
+# Trials running at the same time; every trial trains its model on a single thread
+N_JOBS = os.cpu_count() or 1
+MAX_BOOST_ROUNDS = 300
+EARLY_STOPPING_ROUNDS = 20
+# How often (in boosting rounds) the validation score is reported to the pruner
+REPORT_EVERY = 25
+
+BASE_PARAMS = {
+    "objective": "reg:squarederror",
+    "eval_metric": "rmse",
+    "tree_method": "hist",
+}
+
+SEARCH_SPACE = {
+    "learning_rate": {"type": "float", "low": 1e-3, "high": 0.1, "log": True},
+    "max_depth": {"type": "int", "low": 1, "high": 10},
+}
+
+
+class PruningCallback(xgb.callback.TrainingCallback):
+    """Report the validation RMSE to Optuna and stop hopeless trials early"""
+
+    def __init__(self, trial: optuna.Trial, data_name: str = "validation", metric_name: str = "rmse"):
+        super().__init__()
+        self.trial = trial
+        self.data_name = data_name
+        self.metric_name = metric_name
+
+    def after_iteration(self, model, epoch: int, evals_log) -> bool:
+        if epoch % REPORT_EVERY:
+            return False
+        score = evals_log[self.data_name][self.metric_name][-1]
+        self.trial.report(score, step=epoch)
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f"Trial was pruned at iteration {epoch}.")
+        return False
+
+
+def suggest_params(trial: optuna.Trial) -> Dict[str, Any]:
+    params = dict()
+    for name, space in SEARCH_SPACE.items():
+        if space["type"] == "int":
+            params[name] = trial.suggest_int(name, space["low"], space["high"], log=space.get("log", False))
+        else:
+            params[name] = trial.suggest_float(name, space["low"], space["high"], log=space.get("log", False))
+    return params
+
+
+def route_optuna_logs() -> None:
+    """Log the trials through the handler of the run (plain or JSON lines), at the level chosen for the project"""
+    optuna.logging.disable_default_handler()
+    optuna.logging.enable_propagation()
+    optuna.logging.set_verbosity(logger.getEffectiveLevel())
+
+
+def tune_hyperparameters(dtrain: xgb.DMatrix, dval: xgb.DMatrix, study_name: str,
+                         n_trials: int = N_TRIALS, n_jobs: int = N_JOBS) -> Tuple[Dict[str, Any], int]:
+    """
+    Run (or resume) the Optuna study named `study_name`.
+    Trials already saved in OPTUNA_STORAGE count towards `n_trials`, so a finished study is only read.
+
+    :return: the best hyperparameters and the number of boosting rounds chosen by early stopping
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    route_optuna_logs()
+    saved_study = optuna.create_study(
+        study_name=study_name,
+        storage=OPTUNA_STORAGE,
+        direction="minimize",
+        load_if_exists=True,
+    )
+    done_states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    done_trials = saved_study.get_trials(deepcopy=False, states=done_states)
+    remaining = n_trials - len(done_trials)
+    if remaining <= 0:
+        logger.info("Reusing the finished study: %s", study_name)
+        logger.info("Best hyperparameters: %s", saved_study.best_params)
+        logger.info("Best RMSE: %s", saved_study.best_value)
+        return saved_study.best_params, saved_study.best_trial.user_attrs["num_boost_round"]
+
+    # Trials run against an in-memory copy of the study (the pruner reports would be a database write each),
+    # every finished trial is saved right away, so an interrupted study can be resumed
+    study = optuna.create_study(
+        direction="minimize",
+        pruner=optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=2 * REPORT_EVERY),
+    )
+    study.add_trials(done_trials)
+    storage_lock = threading.Lock()
+
+    def save_trial(_study, trial):
+        with storage_lock:
+            saved_study.add_trial(trial)
+
+    def objective(trial):
+        params = {**BASE_PARAMS, "nthread": 1, **suggest_params(trial)}
+        booster = xgb.train(
+            params, dtrain,
+            num_boost_round=MAX_BOOST_ROUNDS,
+            evals=[(dval, "validation")],
+            early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+            callbacks=[PruningCallback(trial)],
+            verbose_eval=False,
+        )
+        trial.set_user_attr("num_boost_round", booster.best_iteration + 1)
+        return booster.best_score
+
+    study.optimize(objective, n_trials=remaining, n_jobs=n_jobs, callbacks=[save_trial])
+
+    logger.info("Best hyperparameters: %s", study.best_params)
+    logger.info("Best RMSE: %s", study.best_value)
+    return study.best_params, study.best_trial.user_attrs["num_boost_round"]
@@ -0,0 +1,102 @@
+"""
+Bulk download of many API endpoints at once (e.g. one element-summary per player).
+Requests run concurrently on an asyncio loop, bounded by a semaphore so the API is not flooded,
+over one pooled HTTP session. Throttled (429) and failed (5xx, connection errors) requests are retried
+with exponential backoff and jitter; a Retry-After header is respected.
+"""
+import asyncio
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, Hashable, Mapping, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .profiling import PROFILER
+
+logger = logging.getLogger(__name__)
+
+# Requests in flight at once
+CONCURRENCY = 8
+# Attempts after the first one, the n-th waits about BACKOFF * 2^n seconds
+RETRIES = 4
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class BulkFetcher:
+    """Fetch the JSON payloads of many urls, keyed like the given mapping"""
+
+    def __init__(self, concurrency: int = CONCURRENCY, retries: int = RETRIES, backoff: float = BACKOFF,
+                 timeout: float = 30, session: Optional[requests.Session] = None):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            # one kept-alive connection per concurrent request, the retries are done here
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=concurrency, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+
+    def fetch_all(self, urls: Mapping[Hashable, str]) -> Dict[Hashable, Any]:
+        """
+        :return: key -> payload of every url downloaded successfully; the failed ones are logged and left out
+        """
+        with PROFILER.stage("bulk_fetch") as record:
+            payloads = asyncio.run(self._fetch_all(urls))
+            if record:
+                record.rows = len(payloads)
+        return payloads
+
+    async def _fetch_all(self, urls: Mapping[Hashable, str]) -> Dict[Hashable, Any]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # the blocking session calls run in these threads, the loop only schedules and waits
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="fpl-fetch") as executor:
+            results = await asyncio.gather(*(self._fetch(url, semaphore, executor) for url in urls.values()),
+                                           return_exceptions=True)
+
+        payloads = dict()
+        failed = dict()
+        for key, result in zip(urls, results):
+            if isinstance(result, Exception):
+                failed[key] = result
+            else:
+                payloads[key] = result
+        if failed:
+            key, err = next(iter(failed.items()))
+            logger.warning("%d of %d requests failed, e.g. %s: %s", len(failed), len(urls), key, err)
+        logger.info("Fetched %d payloads", len(payloads))
+        return payloads
+
+    async def _fetch(self, url: str, semaphore: asyncio.Semaphore, executor: ThreadPoolExecutor) -> Any:
+        loop = asyncio.get_running_loop()
+        get = partial(self.session.get, url, timeout=self.timeout)
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            async with semaphore:
+                try:
+                    response = await loop.run_in_executor(executor, get)
+                except requests.RequestException as err:
+                    error = err
+                else:
+                    if response.status_code not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        return response.json()
+                    error = requests.HTTPError(f"{response.status_code} {response.reason}", response=response)
+                    retry_after = response.headers.get("Retry-After")
+
+            if attempt == self.retries:
+                break
+            # waiting outside the semaphore - the other requests go on meanwhile
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logger.debug("Retrying %s in %.1fs (%s)", url, delay, error)
+            await asyncio.sleep(min(delay, MAX_BACKOFF))
+        raise ConnectionError(f"Cannot collect data from: {url} after {self.retries + 1} attempts.\n{error}")
@@ -0,0 +1,76 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Difficulty of a gameweek in which a team does not play at all - worse than the hardest match (FPL scale: 1-5)
+BLANK_GW_DIFFICULTY = 6
+# How many next GWs should be considered in the fixtures difficulty
+FIXTURES_GW_LIMIT = 3
+
+
+def get_fixture_difficulty(fixtures_df: pd.DataFrame) -> pd.DataFrame:
+    """Return fixtures in a long layout: one row per team per fixture - team, event, is_home, difficulty"""
+    # Postponed matches without a new date have no event yet
+    fixtures_df = fixtures_df[fixtures_df['event'].notna()]
+    event = fixtures_df['event'].to_numpy(dtype=int)
+    home_df = pd.DataFrame({
+        "team": fixtures_df['team_h'].to_numpy(dtype=int),
+        "event": event,
+        "is_home": True,
+        "difficulty": fixtures_df['team_h_difficulty'].to_numpy(dtype=int),
+    })
+    away_df = pd.DataFrame({
+        "team": fixtures_df['team_a'].to_numpy(dtype=int),
+        "event": event,
+        "is_home": False,
+        "difficulty": fixtures_df['team_a_difficulty'].to_numpy(dtype=int),
+    })
+    return pd.concat([home_df, away_df], ignore_index=True)
+
+
+def get_difficulty_matrix(difficulty_df: pd.DataFrame, num_of_gws: int = FIXTURES_GW_LIMIT, start_event: Optional[int] = None,
+                          teams: Optional[pd.Index] = None) -> pd.DataFrame:
+    """
+    Return a team x gameweek matrix of difficulties for the next `num_of_gws` gameweeks.
+    A double gameweek is easier than a single one: the mean difficulty is divided by the number of fixtures.
+    A blank gameweek gets BLANK_GW_DIFFICULTY.
+
+    :param difficulty_df: fixtures in the long layout, see get_fixture_difficulty()
+    :param num_of_gws: horizon, limited by the last gameweek of the season
+    :param start_event: first gameweek of the horizon, by default the first one in `difficulty_df`
+    :param teams: team IDs to be included (rows), by default all teams found in `difficulty_df`
+    """
+    if teams is None:
+        teams = pd.Index(np.sort(difficulty_df['team'].unique()), name="team")
+    if difficulty_df.empty:
+        # the season is over
+        return pd.DataFrame(index=teams, columns=pd.RangeIndex(0, name="event"), dtype=float)
+    if start_event is None:
+        start_event = int(difficulty_df['event'].min())
+    last_event = min(start_event + num_of_gws - 1, int(difficulty_df['event'].max()))
+    events = pd.RangeIndex(start_event, last_event + 1, name="event")
+
+    window_df = difficulty_df[difficulty_df['event'].between(start_event, last_event)]
+    per_gw = window_df.groupby(['team', 'event'])['difficulty'].agg(['mean', 'size'])
+    gw_difficulty = per_gw['mean'] / per_gw['size']
+
+    matrix_df = gw_difficulty.unstack('event').reindex(index=teams, columns=events)
+    return matrix_df.fillna(BLANK_GW_DIFFICULTY)
+
+
+def get_future_difficulty_matrix(fixtures_df: pd.DataFrame, num_of_gws: int = FIXTURES_GW_LIMIT) -> pd.DataFrame:
+    """Difficulty matrix of the next `num_of_gws` gameweeks, from the raw API fixtures"""
+    future_fixtures_df = fixtures_df[fixtures_df["finished"] == False]
+    return get_difficulty_matrix(get_fixture_difficulty(future_fixtures_df), num_of_gws)
+
+
+def get_players_difficulty(players_df: pd.DataFrame, matrix_df: pd.DataFrame) -> pd.Series:
+    """Total difficulty of the gameweeks in `matrix_df` for each player, gathered by the player's team"""
+    if matrix_df.columns.empty:
+        # no gameweek left
+        return pd.Series(0.0, index=players_df.index, name="fixtures_difficulty")
+    totals = matrix_df.sum(axis=1).to_numpy()
+    team_pos = matrix_df.index.get_indexer(players_df['team'])
+    difficulty = np.where(team_pos >= 0, totals[team_pos], np.nan)
+    return pd.Series(difficulty, index=players_df.index, name="fixtures_difficulty")
@@ -1,29 +1,204 @@
-from typing import Optional
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
 
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
 
-from ..constants import BASE_URL, FIXTURES_ENDPOINT
+from ..constants import BASE_URL, FIXTURES_ENDPOINT, CACHE_DIR, SNAPSHOT_TTL
+from .profiling import PROFILER
+from .schema import normalize_table
+
+logger = logging.getLogger(__name__)
+
+# Names of the snapshots kept on disk (one per endpoint)
+BOOTSTRAP = "bootstrap-static"
+FIXTURES = "fixtures"
+ENDPOINTS = {
+    BOOTSTRAP: BASE_URL,
+    FIXTURES: FIXTURES_ENDPOINT,
+}
+# Every downloaded payload is also added to this database in the cache directory (see tools.snapshot_history)
+HISTORY_FILE = "history.db"
+
+
+class FplApiClient:
+    """
+    Single entry point to the FPL API.
+    Every endpoint is downloaded at most once per run and every table is served from that one payload.
+    Payloads are also kept as on-disk snapshots: within `ttl` seconds they are reused without any request,
+    later they are revalidated with ETag/Last-Modified, so an unchanged payload is not downloaded again.
+    In offline mode only the saved snapshots are replayed and the network is never touched.
+    With `history` every downloaded payload is also recorded in the snapshot history of the cache directory.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, ttl: int = SNAPSHOT_TTL, offline: Optional[bool] = None,
+                 history: bool = True):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline if offline is not None else os.environ.get("FPL_OFFLINE", "") not in ("", "0")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=2)
+        self.session.mount("https://", adapter)
+        # the local stand-in server
+        self.session.mount("http://", adapter)
+        self._payloads: Dict[str, Any] = dict()
+        self._tables: Dict[str, pd.DataFrame] = dict()
+        self.history = history
+        self._history = None
+
+    def bootstrap(self) -> Dict[str, Any]:
+        return self.get_payload(BOOTSTRAP)
+
+    def get_table(self, data_type: str) -> pd.DataFrame:
+        """Return one of the bootstrap-static tables, e.g. 'elements', 'teams', 'events' - typed by tools.schema"""
+        if data_type not in self._tables:
+            base_json = self.bootstrap()
+            if not base_json:
+                raise ConnectionError(f"Cannot collect data from: {BASE_URL}.\n"
+                                      f"Please check your connection or the url provided.")
+            try:
+                self._tables[data_type] = normalize_table(data_type, pd.DataFrame(base_json[data_type]))
+            except KeyError as err:
+                raise KeyError(f"Cannot access {data_type} in the data from: {BASE_URL}. \n{err}")
+        # callers are free to modify what they get
+        return self._tables[data_type].copy()
+
+    def fixtures(self) -> pd.DataFrame:
+        if FIXTURES not in self._tables:
+            self._tables[FIXTURES] = pd.DataFrame(self.get_payload(FIXTURES))
+        return self._tables[FIXTURES].copy()
+
+    def get_payload(self, name: str) -> Any:
+        if name not in self._payloads:
+            with PROFILER.stage(f"api_fetch:{name}") as record:
+                self._payloads[name] = self._fetch(name)
+                if record:
+                    payload = self._payloads[name]
+                    record.rows = len(payload.get("elements", payload) if isinstance(payload, dict) else payload)
+        return self._payloads[name]
+
+    def preload(self, payloads: Dict[str, Any]) -> None:
+        """Serve these payloads (endpoint name -> payload) instead of fetching them, e.g. past API states"""
+        self.refresh()
+        self._payloads.update(payloads)
+
+    def refresh(self) -> None:
+        """Forget the in-memory payloads, so the next access revalidates the snapshots"""
+        self._payloads.clear()
+        self._tables.clear()
+
+    def _fetch(self, name: str) -> Any:
+        payload, meta = self.load_snapshot(name)
+        if self.offline:
+            if payload is None:
+                raise ConnectionError(f"Offline mode: no snapshot of '{name}' in {self.cache_dir}")
+            return payload
+        if payload is not None and time.time() - meta.get("fetched_at", 0) < self.ttl:
+            return payload
+
+        headers = dict()
+        if payload is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        url = ENDPOINTS[name]
+        try:
+            response = self.session.get(url, headers=headers, timeout=30)
+            response.raise_for_status()
+        except requests.RequestException as err:
+            if payload is None:
+                raise ConnectionError(f"Cannot collect data from: {url}.\n{err}")
+            logger.warning("Cannot refresh %s (%s), using the snapshot from %s", name, err, self._snapshot_path(name))
+            return payload
+
+        if response.status_code == 304 and payload is not None:
+            self._write_json(self._meta_path(name), {**meta, "fetched_at": time.time()})
+            return payload
+
+        payload = response.json()
+        self.save_snapshot(name, payload, etag=response.headers.get("ETag"),
+                           last_modified=response.headers.get("Last-Modified"))
+        self._record_history(name, payload)
+        return payload
+
+    def _record_history(self, name: str, payload: Any) -> None:
+        """Add a downloaded payload to the snapshot history - a failure there never fails the run"""
+        if not self.history:
+            return
+        # SQLAlchemy is only imported by the runs which download something
+        from sqlalchemy.exc import SQLAlchemyError
+        from .snapshot_history import SnapshotHistory
+        try:
+            if self._history is None:
+                self._history = SnapshotHistory(os.path.join(self.cache_dir, HISTORY_FILE))
+            self._history.record(name, payload)
+        except (SQLAlchemyError, RuntimeError, OSError, KeyError, TypeError) as err:
+            logger.warning("Cannot record %s in the snapshot history: %s", name, err)
+
+    def load_snapshot(self, name: str):
+        """Return (payload, metadata) of the saved snapshot or (None, {}) if there is none"""
+        try:
+            with open(self._snapshot_path(name), encoding="utf-8") as file:
+                payload = json.load(file)
+        except (OSError, ValueError):
+            return None, dict()
+        try:
+            with open(self._meta_path(name), encoding="utf-8") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            meta = dict()
+        return payload, meta
+
+    def save_snapshot(self, name: str, payload: Any, etag: Optional[str] = None,
+                      last_modified: Optional[str] = None) -> None:
+        self._write_json(self._snapshot_path(name), payload)
+        self._write_json(self._meta_path(name), {
+            "url": ENDPOINTS.get(name), "etag": etag, "last_modified": last_modified, "fetched_at": time.time()
+        })
+
+    def _snapshot_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def _meta_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}.meta.json")
+
+    @staticmethod
+    def _write_json(path: str, content: Any) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(content, file)
+        os.replace(tmp_path, path)
+
+
+# Client shared by the whole run
+_client: Optional[FplApiClient] = None
+
+
+def get_client() -> FplApiClient:
+    global _client
+    if _client is None:
+        _client = FplApiClient()
+    return _client
+
+
+def set_client(client: FplApiClient) -> None:
+    """Replace the shared client, e.g. with an offline one replaying saved snapshots"""
+    global _client
+    _client = client
 
 
 def get_base_api_data(data_type: str) -> Optional[pd.DataFrame]:
-    base_response = requests.get(BASE_URL)
-    base_json = base_response.json()
-    if not base_json:
-        raise ConnectionError(f"Cannot collect data from: {BASE_URL}.\n"
-                              f"Please check your connection or the url provided.")
-    try:
-        data_type_df = pd.DataFrame(base_json[data_type])
-        return data_type_df
-    except KeyError as err:
-        raise KeyError(f"Cannot access {data_type} in the data from: {BASE_URL}. \n{err}")
+    return get_client().get_table(data_type)
 
 
 def load_fixtures() -> pd.DataFrame:
-    fixtures_response = requests.get(FIXTURES_ENDPOINT)
-    fixtures_json = fixtures_response.json()
-    fixtures_df = pd.DataFrame(fixtures_json)
-    return fixtures_df
+    return get_client().fixtures()
 
 
 def how_many_gws_passed(fixtures_df: pd.DataFrame) -> int:
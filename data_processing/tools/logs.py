@@ -0,0 +1,65 @@
+import json
+import logging
+import sys
+from collections import Counter
+from typing import Optional, TextIO
+
+import colorlog
+
+# Loggers of this project, the level chosen by the user applies to them only (third-party ones stay at WARNING).
+# Optuna's trials follow it too, once the tuning routes them here (historical/tuning.py).
+# "__main__" - the modules run with `python -m`
+PROJECT_LOGGERS = ["data_processing", "fantasy_scout", "scout_daemon", "benchmarks", "__main__"]
+LOG_FORMAT = "%(log_color)s%(levelname)-8s%(reset)s %(message)s"
+# Attributes every LogRecord has - everything else was passed in `extra` and goes to the JSON lines as is
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the `extra` fields included - for log shipping"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level: str = "INFO", json_lines: bool = False, stream: Optional[TextIO] = None) -> None:
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if json_lines:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(colorlog.ColoredFormatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(logging.WARNING)
+    for name in PROJECT_LOGGERS:
+        logging.getLogger(name).setLevel(level.upper())
+
+
+class RejectionStats:
+    """Count the candidates rejected by the selection, by reason, and log a compact summary"""
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.rejected = Counter()
+        self.passes = 0
+
+    def reject(self, reason: str) -> None:
+        self.rejected[reason] += 1
+
+    def log_summary(self, selected: int) -> None:
+        reasons = ", ".join(f"{reason}: {count}" for reason, count in self.rejected.most_common()) or "none"
+        self.logger.info("Selection finished after %d pass(es): %d players selected, rejected - %s",
+                         self.passes, selected, reasons,
+                         extra={"passes": self.passes, "selected": selected, "rejected": dict(self.rejected)})
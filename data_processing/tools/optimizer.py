@@ -0,0 +1,100 @@
+from typing import TYPE_CHECKING, Any, Collection, Dict, List
+
+import numpy as np
+import pandas as pd
+
+if TYPE_CHECKING:
+    # scipy.optimize is imported by the solver itself, so the greedy runs don't pay for it
+    from scipy.optimize import LinearConstraint
+    from scipy.sparse import csr_matrix
+
+from ..constants import BUDGET, LIMITS
+
+
+def select_optimal_team(players_df: pd.DataFrame, score_col: str, budget: int = BUDGET,
+                        limits: Dict[str, Any] = LIMITS, locked: Collection[int] = ()) -> pd.DataFrame:
+    """Return the squad with the highest total `score_col` that fits in the budget and the LIMITS"""
+    return select_top_teams(players_df, score_col, budget=budget, limits=limits, top_k=1, locked=locked)[0]
+
+
+def select_top_teams(players_df: pd.DataFrame, score_col: str, budget: int = BUDGET,
+                     limits: Dict[str, Any] = LIMITS, top_k: int = 1,
+                     locked: Collection[int] = ()) -> List[pd.DataFrame]:
+    """
+    Solve the squad selection as a binary integer program (scipy's milp / HiGHS):
+    maximize the total score subject to the budget, players per position, players per club and squad size.
+    Every next squad is forced to differ from the ones already found by at least one player.
+
+    :param players_df: candidates with `score_col`, 'now_cost', 'position' and 'team_name' columns
+    :param locked: IDs of the players every squad must include
+    :return: up to `top_k` distinct squads, best first, each sorted by the score
+    """
+    players_df = players_df[players_df[score_col].notna()]
+    from scipy.optimize import Bounds, LinearConstraint, milp
+    from scipy.sparse import csr_matrix
+
+    if players_df['id'].duplicated().any():
+        players_df = players_df.drop_duplicates(subset='id')
+
+    missing = set(locked) - set(players_df['id'])
+    if missing:
+        raise ValueError(f"Locked players not among the candidates: {sorted(missing)}")
+
+    score = players_df[score_col].to_numpy(dtype=float)
+    constraints = get_squad_constraints(players_df, budget, limits)
+    # locked players have both bounds at 1
+    lower_bounds = players_df['id'].isin(locked).to_numpy(dtype=float)
+
+    squads = list()
+    cuts = list()
+    for _ in range(top_k):
+        if cuts:
+            # no-good cut: at most (all - 1) players of an already found squad
+            cut_rows = csr_matrix(np.vstack(cuts))
+            constraints_k = constraints + [LinearConstraint(cut_rows, -np.inf, limits['all'] - 1)]
+        else:
+            constraints_k = constraints
+        result = milp(
+            c=-score,
+            constraints=constraints_k,
+            integrality=np.ones(len(score)),
+            bounds=Bounds(lower_bounds, 1),
+        )
+        if not result.success:
+            if not squads:
+                raise ValueError(f"Cannot select a squad within the budget {budget}: {result.message}")
+            break
+
+        chosen = result.x > 0.5
+        cuts.append(chosen.astype(float))
+        squad_df = players_df[chosen].sort_values(score_col, ascending=False)
+        squads.append(squad_df)
+    return squads
+
+
+def get_squad_constraints(players_df: pd.DataFrame, budget: int, limits: Dict[str, Any]) -> List['LinearConstraint']:
+    from scipy.optimize import LinearConstraint
+
+    n_players = len(players_df)
+    constraints = [
+        LinearConstraint(players_df['now_cost'].to_numpy(dtype=float)[np.newaxis, :], -np.inf, budget),
+        LinearConstraint(np.ones((1, n_players)), limits['all'], limits['all']),
+    ]
+
+    position_codes, positions = pd.factorize(players_df['position'])
+    position_matrix = _one_hot(position_codes, len(positions))
+    required = np.array([limits['position'].get(position, 0) for position in positions], dtype=float)
+    constraints.append(LinearConstraint(position_matrix, required, required))
+
+    club_codes, clubs = pd.factorize(players_df['team_name'])
+    club_matrix = _one_hot(club_codes, len(clubs))
+    constraints.append(LinearConstraint(club_matrix, -np.inf, limits['one_team']))
+    return constraints
+
+
+def _one_hot(codes: np.ndarray, n_groups: int) -> 'csr_matrix':
+    """(groups x players) membership matrix"""
+    from scipy.sparse import csr_matrix
+
+    n_players = len(codes)
+    return csr_matrix((np.ones(n_players), (codes, np.arange(n_players))), shape=(n_groups, n_players))
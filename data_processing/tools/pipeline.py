@@ -0,0 +1,116 @@
+import logging
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def is_same(old: Any, new: Any) -> bool:
+    """Value equality that also works for frames, arrays and containers of them"""
+    if old is new:
+        return True
+    if type(old) is not type(new):
+        return False
+    if isinstance(old, (pd.DataFrame, pd.Series)):
+        return old.equals(new)
+    if isinstance(old, np.ndarray):
+        return np.array_equal(old, new)
+    if isinstance(old, (list, tuple)):
+        return len(old) == len(new) and all(is_same(a, b) for a, b in zip(old, new))
+    if isinstance(old, dict):
+        return old.keys() == new.keys() and all(is_same(old[key], new[key]) for key in old)
+    try:
+        return bool(old == new)
+    except (TypeError, ValueError):
+        return False
+
+
+class Stage:
+    __slots__ = ("name", "func", "deps", "value", "version", "dep_versions", "stale")
+
+    def __init__(self, name: str, func: Optional[Callable], deps: Sequence[str]):
+        self.name = name
+        # None for the inputs, which are only set from outside
+        self.func = func
+        self.deps = tuple(deps)
+        self.value: Any = None
+        # Bumped every time the value really changes
+        self.version = 0
+        # Versions of the dependencies the value was computed from
+        self.dep_versions: Optional[Tuple[int, ...]] = None
+        self.stale = func is not None
+
+
+class Pipeline:
+    """
+    A small DAG of named stages.
+    A stage is computed only when it (or a stage depending on it) is requested, and its value is kept.
+    It is computed again only when one of its dependencies has really changed - a recomputed dependency
+    with an equal value doesn't propagate any further.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Stage] = dict()
+
+    def add_input(self, name: str, value: Any = None) -> None:
+        self._add(Stage(name, None, ()))
+        self._stages[name].value = value
+
+    def add_stage(self, name: str, func: Callable, deps: Iterable[str] = ()) -> None:
+        """`func` is called with the values of `deps`, in order"""
+        deps = tuple(deps)
+        missing = [dep for dep in deps if dep not in self._stages]
+        if missing:
+            raise KeyError(f"Stage '{name}' depends on unknown stages: {missing}")
+        self._add(Stage(name, func, deps))
+
+    def set_input(self, name: str, value: Any) -> None:
+        stage = self._get_stage(name)
+        if stage.func is not None:
+            raise ValueError(f"'{name}' is a computed stage, not an input")
+        if not is_same(stage.value, value):
+            stage.value = value
+            stage.version += 1
+
+    def invalidate(self, *names: str) -> None:
+        """Compute the stages again on the next request, e.g. to reload the data they read from outside"""
+        for name in names:
+            self._get_stage(name).stale = True
+
+    def get(self, name: str) -> Any:
+        stage = self._get_stage(name)
+        if stage.func is None:
+            return stage.value
+
+        dep_values = [self.get(dep) for dep in stage.deps]
+        dep_versions = tuple(self._stages[dep].version for dep in stage.deps)
+        if not stage.stale and dep_versions == stage.dep_versions:
+            return stage.value
+
+        logger.debug("Running stage: %s", name)
+        value = stage.func(*dep_values)
+        if stage.dep_versions is None or not is_same(stage.value, value):
+            stage.value = value
+            stage.version += 1
+        stage.dep_versions = dep_versions
+        stage.stale = False
+        return stage.value
+
+    def __getitem__(self, name: str) -> Any:
+        return self.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._stages
+
+    def _add(self, stage: Stage) -> None:
+        if stage.name in self._stages:
+            raise KeyError(f"Stage '{stage.name}' already exists")
+        self._stages[stage.name] = stage
+
+    def _get_stage(self, name: str) -> Stage:
+        try:
+            return self._stages[name]
+        except KeyError:
+            raise KeyError(f"Unknown stage: '{name}'")
@@ -0,0 +1,45 @@
+from typing import Iterator, List
+
+import pandas as pd
+
+
+class PlayerView:
+    """
+    One candidate of the greedy selection loops - just the fields they read, as plain Python values.
+    Much lighter than the Series built by iterrows; the full row stays in the frame it came from.
+    """
+    __slots__ = ("frame", "row", "id", "first_name", "second_name", "position", "team_name", "now_cost")
+    FIELDS = __slots__[2:]
+
+    def __init__(self, frame: pd.DataFrame, row: int, id: int, first_name: str, second_name: str, position: str,
+                 team_name: str, now_cost: int):
+        self.frame = frame
+        self.row = row
+        self.id = id
+        self.first_name = first_name
+        self.second_name = second_name
+        self.position = position
+        self.team_name = team_name
+        self.now_cost = now_cost
+
+
+def iter_players(players_df: pd.DataFrame) -> Iterator[PlayerView]:
+    """Rows of `players_df` in order; every column is converted to Python values once, not per row"""
+    columns = [players_df[col].tolist() for col in PlayerView.FIELDS]
+    for row, values in enumerate(zip(*columns)):
+        yield PlayerView(players_df, row, *values)
+
+
+def players_to_frame(players: List[PlayerView]) -> pd.DataFrame:
+    """The full rows of the selected players, in the order of selection"""
+    if not players:
+        return pd.DataFrame()
+    # every distinct source frame is concatenated once, the rows are then taken in one go
+    frames = list({id(player.frame): player.frame for player in players}.values())
+    offsets = dict()
+    offset = 0
+    for frame in frames:
+        offsets[id(frame)] = offset
+        offset += len(frame)
+    all_rows = frames[0] if len(frames) == 1 else pd.concat(frames)
+    return all_rows.iloc[[offsets[id(player.frame)] + player.row for player in players]]
@@ -0,0 +1,149 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class StageRecord:
+    __slots__ = ("name", "wall", "cpu", "mem_peak", "max_rss", "rows", "_peak_seen", "_profile")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        # peak of the memory allocated by Python within the stage (tracemalloc), in bytes
+        self.mem_peak = 0
+        # max resident set size of the process at the end of the stage, in bytes
+        self.max_rss = 0
+        self.rows: Optional[int] = None
+        self._peak_seen = 0
+        self._profile: Optional[cProfile.Profile] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "wall_s": self.wall, "cpu_s": self.cpu, "mem_peak_mb": self.mem_peak / 2 ** 20,
+                "max_rss_mb": self.max_rss / 2 ** 20, "rows": self.rows}
+
+
+class StageProfiler:
+    """
+    Records wall time, CPU time, memory and row counts of the pipeline stages.
+    Disabled by default - then a stage costs a single flag check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.dump_dir: Optional[str] = None
+        self.records: List[StageRecord] = list()
+        self._stack: List[StageRecord] = list()
+
+    def enable(self, dump_dir: Optional[str] = None) -> None:
+        """Start recording; with `dump_dir` a cProfile dump is also saved for every stage"""
+        self.enabled = True
+        self.dump_dir = dump_dir
+        if dump_dir:
+            os.makedirs(dump_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Optional[StageRecord]]:
+        if not self.enabled:
+            yield None
+            return
+
+        record = StageRecord(name)
+        if self._stack:
+            parent = self._stack[-1]
+            parent._peak_seen = max(parent._peak_seen, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        mem_start = tracemalloc.get_traced_memory()[0]
+        # cProfile can't be nested - only the outermost profiled stage gets a dump
+        if self.dump_dir and not any(outer._profile for outer in self._stack):
+            record._profile = cProfile.Profile()
+            record._profile.enable()
+        self._stack.append(record)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall = time.perf_counter() - wall_start
+            record.cpu = time.process_time() - cpu_start
+            self._stack.pop()
+            peak = max(tracemalloc.get_traced_memory()[1], record._peak_seen)
+            record.mem_peak = max(peak - mem_start, 0)
+            if self._stack:
+                self._stack[-1]._peak_seen = max(self._stack[-1]._peak_seen, peak)
+            if resource:
+                # kilobytes on Linux
+                record.max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            if record._profile:
+                record._profile.disable()
+                safe_name = re.sub(r"[^\w.-]", "_", name)
+                file_name = f"{len(self.records):02d}-{safe_name}.pstats"
+                record._profile.dump_stats(os.path.join(self.dump_dir, file_name))
+                record._profile = None
+            self.records.append(record)
+
+    def profiled(self, name: Optional[str] = None, rows_of: Optional[str] = None) -> Callable:
+        """
+        Decorator recording every call as a stage.
+        Rows are the length of the returned value, or of the `rows_of` attribute of the first argument (self).
+        """
+        def decorator(func: Callable) -> Callable:
+            stage_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.stage(stage_name) as record:
+                    result = func(*args, **kwargs)
+                    if rows_of and args:
+                        record.rows = len(getattr(args[0], rows_of))
+                    elif isinstance(result, (pd.DataFrame, pd.Series, list, dict)):
+                        record.rows = len(result)
+                    return result
+            return wrapper
+        return decorator
+
+    def summary(self) -> pd.DataFrame:
+        """One row per stage name, in the order of the first call"""
+        records_df = pd.DataFrame([record.as_dict() for record in self.records])
+        if records_df.empty:
+            return records_df
+        return records_df.groupby("name", sort=False).agg(
+            calls=("name", "size"),
+            wall_s=("wall_s", "sum"),
+            cpu_s=("cpu_s", "sum"),
+            mem_peak_mb=("mem_peak_mb", "max"),
+            max_rss_mb=("max_rss_mb", "max"),
+            rows=("rows", "last"),
+        ).astype({"rows": "Int64"})
+
+    def report(self) -> str:
+        return self.summary().to_string(float_format=lambda value: f"{value:.3f}")
+
+    def save(self, path: str) -> None:
+        """Save every recorded call as JSON, to be compared between releases"""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump([record.as_dict() for record in self.records], file, indent=2, default=float)
+
+
+# Profiler shared by the whole run
+PROFILER = StageProfiler()
+profiled = PROFILER.profiled
@@ -0,0 +1,136 @@
+"""
+Report of a run: a multi-sheet workbook written in openpyxl's write-only (streaming) mode, so full tables of all the
+players cost little, plus sidecar files of every stage (Parquet, CSV, JSON) for other jobs.
+The sidecars have a fixed schema per stage, whatever the run: the columns a run doesn't have are written as nulls and
+the wide matrices (team x GW, player x GW) are written in a long layout.
+"""
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever a schema changes, readers can check it in the manifest
+REPORT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+SIDECAR_FORMATS = ("parquet", "csv", "json")
+# Rows converted to cells at once
+CHUNK_ROWS = 1_000
+# Longest sheet title Excel accepts
+MAX_SHEET_TITLE = 31
+
+# Stage -> typed columns of its sidecars (nullable pandas dtypes, as in the historical season store)
+PLAYERS_SCHEMA = {
+    'id': 'Int32',
+    'first_name': 'string',
+    'second_name': 'string',
+    'web_name': 'string',
+    'team': 'Int16',
+    'team_name': 'string',
+    'element_type': 'Int8',
+    'position': 'string',
+    'now_cost': 'Int16',
+    'chance_of_playing_next_round': 'float64',
+    'selected_by_percent': 'float64',
+    'form': 'float64',
+    'points_per_game': 'float64',
+    'form_ppg': 'float64',
+    'total_points': 'Int16',
+    'starts': 'Int16',
+    'minutes': 'Int32',
+    'ict_index': 'float64',
+    'expected_goal_involvements': 'float64',
+    'expected_goals_conceded': 'float64',
+    'predicted_ppg': 'float64',
+    'predicted_value': 'float64',
+    'expected_points': 'float64',
+    'fixtures_difficulty': 'float64',
+}
+STAGE_SCHEMAS = {
+    "my_team": {**PLAYERS_SCHEMA, 'comments': 'string'},
+    "candidates": {**PLAYERS_SCHEMA, 'selected': 'boolean'},
+    "teams_idx": {'id': 'Int16', 'name': 'string', 'DEF_IDX': 'Int32', 'OFF_IDX': 'Int32'},
+    "fixture_difficulty": {'team': 'Int16', 'event': 'Int8', 'difficulty': 'float64'},
+    "expected_points": {'id': 'Int32', 'event': 'Int8', 'expected_points': 'float64'},
+}
+
+
+def conform(stage_df: pd.DataFrame, schema: Dict[str, str]) -> pd.DataFrame:
+    """Only the columns of `schema`, in its order and types - the missing ones as nulls"""
+    columns = dict()
+    for col, dtype in schema.items():
+        if col in stage_df:
+            column = stage_df[col]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                column = column.astype(object)
+            columns[col] = column.astype(dtype)
+        else:
+            columns[col] = pd.Series(None, index=stage_df.index, dtype=dtype)
+    return pd.DataFrame(columns).reset_index(drop=True)
+
+
+def to_long(matrix_df: pd.DataFrame, value_name: str) -> pd.DataFrame:
+    """A matrix (e.g. team x event) as one row per cell: both index names and the value"""
+    return matrix_df.stack().rename(value_name).reset_index()
+
+
+def iter_rows(sheet_df: pd.DataFrame, chunk_rows: int = CHUNK_ROWS) -> Iterator[Tuple[Any, ...]]:
+    """Rows of plain Python values (numpy scalars, categories and missing values converted), chunk by chunk"""
+    for start in range(0, len(sheet_df), chunk_rows):
+        chunk_df = sheet_df.iloc[start:start + chunk_rows].astype(object)
+        yield from chunk_df.where(chunk_df.notna(), None).itertuples(index=False, name=None)
+
+
+def write_workbook(sheets: Dict[str, pd.DataFrame], path: str) -> None:
+    """Stream every frame into its own sheet, in the given order - rows are written and forgotten one by one"""
+    # openpyxl is only imported by the runs which save a report
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    for title, sheet_df in sheets.items():
+        worksheet = workbook.create_sheet(title=title[:MAX_SHEET_TITLE])
+        worksheet.append([str(col) for col in sheet_df.columns])
+        for row in iter_rows(sheet_df):
+            worksheet.append(row)
+    workbook.save(path)
+
+
+def write_sidecars(stages: Dict[str, pd.DataFrame], out_dir: str,
+                   formats: Sequence[str] = SIDECAR_FORMATS) -> Dict[str, Any]:
+    """
+    Write <out_dir>/<stage>.<format> for every stage with a schema in STAGE_SCHEMAS and a manifest.json
+    with the version, the schemas and the row counts. Return the manifest.
+    """
+    unknown = set(formats) - set(SIDECAR_FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown sidecar formats: {sorted(unknown)}, choose from {list(SIDECAR_FORMATS)}")
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {"version": REPORT_VERSION, "stages": dict()}
+    for stage, stage_df in stages.items():
+        if stage not in STAGE_SCHEMAS:
+            continue
+        table_df = conform(stage_df, STAGE_SCHEMAS[stage])
+        path = os.path.join(out_dir, stage)
+        if "parquet" in formats:
+            table_df.to_parquet(f"{path}.parquet", index=False)
+        if "csv" in formats:
+            table_df.to_csv(f"{path}.csv", index=False)
+        if "json" in formats:
+            table_df.to_json(f"{path}.json", orient="records", lines=True)
+        manifest["stages"][stage] = {"rows": len(table_df), "schema": STAGE_SCHEMAS[stage]}
+    with open(os.path.join(out_dir, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def save_report(stages: Dict[str, pd.DataFrame], workbook_path: str, sidecar_dir: Optional[str] = None,
+                formats: Iterable[str] = SIDECAR_FORMATS) -> None:
+    """The workbook with every stage as a sheet and, if `sidecar_dir` is given, the sidecars of the stages"""
+    write_workbook(stages, workbook_path)
+    logger.info("Report saved: %s (%s)", workbook_path, ", ".join(stages))
+    formats = list(formats)
+    if sidecar_dir and formats:
+        write_sidecars(stages, sidecar_dir, formats)
+        logger.info("Sidecars (%s) saved in: %s", ", ".join(formats), sidecar_dir)
@@ -0,0 +1,63 @@
+"""
+Types of the API tables, applied once when a table is built from its payload:
+numbers sent as strings are parsed, ids and counts are downcast to small ints and the columns nobody reads are dropped.
+"""
+from typing import Dict
+
+import pandas as pd
+
+# Columns of 'elements' read anywhere in the pipeline. Floats are sent as strings (e.g. "5.5"), missing as None.
+ELEMENTS_SCHEMA = {
+    'id': 'int16',
+    'first_name': 'object',
+    'second_name': 'object',
+    'web_name': 'object',
+    'element_type': 'int8',
+    'team': 'int8',
+    'status': 'object',
+    'now_cost': 'int16',
+    'total_points': 'int16',
+    'points_per_game': 'float64',
+    'form': 'float64',
+    'value_form': 'float64',
+    'value_season': 'float64',
+    'selected_by_percent': 'float64',
+    'ict_index': 'float64',
+    'ict_index_rank': 'int16',
+    'expected_goal_involvements': 'float64',
+    'expected_goals_conceded': 'float64',
+    'clean_sheets': 'int16',
+    'bps': 'int16',
+    'starts': 'int16',
+    'minutes': 'int16',
+    'chance_of_playing_next_round': 'float64',
+    'chance_of_playing_this_round': 'float64',
+    'penalties_order': 'float64',
+}
+TABLE_SCHEMAS: Dict[str, Dict[str, str]] = {
+    "elements": ELEMENTS_SCHEMA,
+}
+
+
+def normalize_table(name: str, table_df: pd.DataFrame) -> pd.DataFrame:
+    """Only the columns of the table's schema (those the payload has), in their types; other tables as they are"""
+    schema = TABLE_SCHEMAS.get(name)
+    if schema is None:
+        return table_df
+    columns = dict()
+    for col, dtype in schema.items():
+        if col not in table_df:
+            continue
+        values = table_df[col]
+        if dtype.startswith("float") and values.dtype == object:
+            values = pd.to_numeric(values, errors="coerce")
+        columns[col] = values.astype(dtype)
+    return pd.DataFrame(columns, index=table_df.index)
+
+
+def as_category(values: pd.Series, categories: pd.Series) -> pd.Series:
+    """
+    Categorical with a fixed set of categories (e.g. every team name), so frames built from different subsets
+    of the rows share the same dtype
+    """
+    return values.astype(pd.CategoricalDtype(categories.drop_duplicates().tolist()))
@@ -0,0 +1,76 @@
+"""
+NumPy arrays shared by a pool of processes without copying them into every task:
+the arrays are copied once into one block of shared memory, the workers map them by the block's name.
+
+    with SharedArrays({"xp": xp, "cost": cost}) as shared:
+        ProcessPoolExecutor(initializer=init, initargs=(shared.spec,))   # init: attach_arrays(spec)
+"""
+from multiprocessing import shared_memory
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+
+# Every array starts at a multiple of this offset
+ALIGNMENT = 64
+
+
+class ArraySpec(NamedTuple):
+    name: str
+    dtype: str
+    shape: Tuple[int, ...]
+    offset: int
+
+
+class SharedSpec(NamedTuple):
+    """What a worker needs to map the arrays - small and picklable"""
+    block: str
+    arrays: List[ArraySpec]
+
+
+class SharedArrays:
+    """Owner of the shared block: creates it with copies of the arrays, unlinks it on close()"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        specs = list()
+        size = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            specs.append(ArraySpec(name, array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        self.block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.spec = SharedSpec(self.block.name, specs)
+        for spec, array in zip(specs, arrays.values()):
+            view = np.ndarray(spec.shape, dtype=spec.dtype, buffer=self.block.buf, offset=spec.offset)
+            view[...] = array
+        self.arrays = map_arrays(self.block, self.spec)
+
+    def close(self) -> None:
+        # the views have to go before the buffer is released
+        self.arrays = dict()
+        self.block.close()
+        self.block.unlink()
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def map_arrays(block: shared_memory.SharedMemory, spec: SharedSpec) -> Dict[str, np.ndarray]:
+    """Read-only views of the arrays in the block"""
+    arrays = dict()
+    for array_spec in spec.arrays:
+        view = np.ndarray(array_spec.shape, dtype=array_spec.dtype, buffer=block.buf, offset=array_spec.offset)
+        view.flags.writeable = False
+        arrays[array_spec.name] = view
+    return arrays
+
+
+def attach_arrays(spec: SharedSpec) -> Tuple[shared_memory.SharedMemory, Dict[str, np.ndarray]]:
+    """
+    Map the arrays of another process. The block has to stay referenced as long as the arrays are used,
+    and it is only closed (never unlinked) by the workers - the owner unlinks it.
+    """
+    block = shared_memory.SharedMemory(name=spec.block)
+    return block, map_arrays(block, spec)
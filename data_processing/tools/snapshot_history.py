@@ -0,0 +1,350 @@
+"""
+History of the API payloads: every downloaded bootstrap-static (its elements and teams) and fixtures payload is kept
+in a local SQLite database ([CACHE_DIR]/history.db), so the past is queryable - how a player's price, ownership or
+chance of playing evolved, or what the whole league looked like at any past moment.
+
+A snapshot is stored as deltas: per record (player, team, fixture) only the fields changed since the previous snapshot
+of the endpoint - nothing for an unchanged record, all the fields for a new one. Every KEYFRAME_INTERVAL snapshots
+of an endpoint its whole state is also kept (compressed), so a past state is rebuilt from the last keyframe before it
+plus a bounded number of deltas, and a record's time series is one index range of its deltas.
+
+    history = SnapshotHistory()
+    history.player_series(328, ['now_cost', 'selected_by_percent'])   # one row per change of the player
+    history.league_state("2024-10-05 12:00")["elements"]              # the players as they were then
+
+Usage: python -m data_processing.tools.snapshot_history (--player ID [--fields FIELD ...] | --at TIME | --gameweek GW
+                                                         | --record) [--db FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+from sqlalchemy import (BigInteger, Column, ForeignKey, Index, Integer, LargeBinary, MetaData, String, Table, Text,
+                        create_engine, event, func, inspect, insert, select)
+from sqlalchemy.engine import Connection
+
+from ..constants import CACHE_DIR
+from .fpl_api import BOOTSTRAP, FIXTURES, HISTORY_FILE, FplApiClient
+from .logs import setup_logging
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DB = os.path.join(CACHE_DIR, HISTORY_FILE)
+# Bumped whenever the schema changes - kept as the database's user_version, an older history has to be moved away
+HISTORY_VERSION = 1
+# Every this many snapshots of an endpoint its whole state is stored too
+KEYFRAME_INTERVAL = 48
+# Endpoint -> its recorded tables (table -> column of the record's ID)
+RECORDED = {
+    BOOTSTRAP: {"elements": "element_id", "teams": "team_id"},
+    FIXTURES: {"fixtures": "fixture_id"},
+}
+# The endpoint every table comes from
+TABLE_ENDPOINTS = {table: endpoint for endpoint, tables in RECORDED.items() for table in tables}
+
+# record ID -> its fields, per table
+State = Dict[str, Dict[int, Dict[str, Any]]]
+Instant = Union[None, float, str, datetime, pd.Timestamp]
+
+metadata = MetaData()
+snapshots = Table(
+    "snapshots", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("endpoint", String(32), nullable=False),
+    # milliseconds since the epoch (UTC)
+    Column("taken_at", BigInteger, nullable=False),
+    # the current GW when the snapshot was taken
+    Column("gameweek", Integer),
+    # zlib-compressed JSON of the whole state, in every KEYFRAME_INTERVAL-th snapshot of the endpoint
+    Column("keyframe", LargeBinary),
+    Index("ix_snapshots_endpoint_taken_at", "endpoint", "taken_at"),
+    Index("ix_snapshots_gameweek", "gameweek"),
+)
+
+
+def _delta_table(name: str, id_col: str) -> Table:
+    return Table(
+        name, metadata,
+        Column("snapshot_id", Integer, ForeignKey("snapshots.id"), primary_key=True),
+        Column(id_col, Integer, primary_key=True),
+        Column("taken_at", BigInteger, nullable=False),
+        Column("gameweek", Integer),
+        # JSON of the changed fields, NULL - the record is gone
+        Column("changes", Text),
+        Index(f"ix_{name}_{id_col}_taken_at", id_col, "taken_at"),
+        Index(f"ix_{name}_gameweek", "gameweek"),
+    )
+
+
+DELTA_TABLES = {
+    "elements": _delta_table("element_deltas", "element_id"),
+    "teams": _delta_table("team_deltas", "team_id"),
+    "fixtures": _delta_table("fixture_deltas", "fixture_id"),
+}
+# Marks a field a record didn't have
+_MISSING = object()
+
+
+def to_millis(at: Instant = None) -> int:
+    """Milliseconds since the epoch of a moment: seconds (like time.time()), a datetime or text (UTC if naive)"""
+    if at is None:
+        return int(time.time() * 1000)
+    if isinstance(at, (int, float)):
+        return int(at * 1000)
+    timestamp = pd.Timestamp(at)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return int(timestamp.timestamp() * 1000)
+
+
+def get_gameweek(endpoint: str, payload: Any) -> Optional[int]:
+    """The current GW of a payload: the current event, or the last one with a started fixture"""
+    if endpoint == BOOTSTRAP:
+        events = payload.get("events", list())
+        current = [event_["id"] for event_ in events if event_.get("is_current")]
+        finished = [event_["id"] for event_ in events if event_.get("finished")]
+        return (current or finished or [None])[-1]
+    started = [fixture["event"] for fixture in payload if fixture.get("started") and fixture.get("event")]
+    return max(started) if started else None
+
+
+def get_records(endpoint: str, payload: Any) -> State:
+    """The recorded tables of a payload, by the ID of the record (copied - the payload may change later)"""
+    tables = {"fixtures": payload} if endpoint == FIXTURES else {table: payload.get(table, list())
+                                                                  for table in RECORDED[endpoint]}
+    return {table: {record["id"]: dict(record) for record in records} for table, records in tables.items()}
+
+
+def diff_records(previous: Dict[int, Dict[str, Any]],
+                 current: Dict[int, Dict[str, Any]]) -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+    """(ID, changed fields) of every changed record: all the fields of a new one, None for a removed one"""
+    for record_id, record in current.items():
+        old = previous.get(record_id)
+        if old is None:
+            yield record_id, record
+            continue
+        changes = {field: value for field, value in record.items() if old.get(field, _MISSING) != value}
+        changes.update({field: None for field in old.keys() - record.keys()})
+        if changes:
+            yield record_id, changes
+    for record_id in previous.keys() - current.keys():
+        yield record_id, None
+
+
+def apply_changes(records: Dict[int, Dict[str, Any]], record_id: int, changes: Optional[str]) -> None:
+    if changes is None:
+        records.pop(record_id, None)
+    else:
+        records.setdefault(record_id, dict()).update(json.loads(changes))
+
+
+def _compress(state: State) -> bytes:
+    return zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+
+
+def _decompress(keyframe: bytes) -> State:
+    return {table: {int(record_id): record for record_id, record in records.items()}
+            for table, records in json.loads(zlib.decompress(keyframe)).items()}
+
+
+class SnapshotHistory:
+    """The snapshot history in a SQLite database, created on first use"""
+
+    def __init__(self, path: str = HISTORY_DB, keyframe_interval: int = KEYFRAME_INTERVAL):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.engine = create_engine(f"sqlite:///{path}")
+        event.listen(self.engine, "connect", _set_pragmas)
+        with self.engine.begin() as conn:
+            version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+            if inspect(conn).has_table("snapshots") and version != HISTORY_VERSION:
+                raise RuntimeError(f"The snapshot history {path} has the schema version {version}, expected "
+                                   f"{HISTORY_VERSION} - move it away to start a new one")
+            metadata.create_all(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {HISTORY_VERSION}")
+        # endpoint -> (ID, state) of its last snapshot recorded by this process
+        self._last: Dict[str, Tuple[int, State]] = dict()
+
+    def record(self, endpoint: str, payload: Any, taken_at: Instant = None) -> Optional[int]:
+        """Add a payload as the next snapshot of its endpoint, return the snapshot's ID (None if not recorded)"""
+        if endpoint not in RECORDED:
+            return None
+        state = get_records(endpoint, payload)
+        taken_at, gameweek = to_millis(taken_at), get_gameweek(endpoint, payload)
+        with self.engine.begin() as conn:
+            previous = self._last_state(conn, endpoint)
+            snapshot_id = conn.execute(insert(snapshots).values(
+                endpoint=endpoint, taken_at=taken_at, gameweek=gameweek,
+                keyframe=_compress(state) if self._keyframe_due(conn, endpoint) else None)).inserted_primary_key[0]
+            changed = dict()
+            for table, records in state.items():
+                id_col = RECORDED[endpoint][table]
+                rows = [{"snapshot_id": snapshot_id, id_col: record_id, "taken_at": taken_at, "gameweek": gameweek,
+                         "changes": None if changes is None else json.dumps(changes, separators=(",", ":"))}
+                        for record_id, changes in diff_records(previous.get(table, dict()), records)]
+                if rows:
+                    conn.execute(insert(DELTA_TABLES[table]), rows)
+                changed[table] = len(rows)
+        self._last[endpoint] = (snapshot_id, state)
+        logger.debug("Snapshot %d of %s recorded, changed records: %s", snapshot_id, endpoint, changed)
+        return snapshot_id
+
+    def _keyframe_due(self, conn: Connection, endpoint: str) -> bool:
+        last_keyframe = conn.execute(select(func.max(snapshots.c.id)).where(
+            snapshots.c.endpoint == endpoint, snapshots.c.keyframe.isnot(None))).scalar()
+        if last_keyframe is None:
+            return True
+        since = conn.execute(select(func.count()).where(snapshots.c.endpoint == endpoint,
+                                                        snapshots.c.id >= last_keyframe)).scalar()
+        return since >= self.keyframe_interval
+
+    def _last_state(self, conn: Connection, endpoint: str) -> State:
+        last_id = conn.execute(select(func.max(snapshots.c.id)).where(snapshots.c.endpoint == endpoint)).scalar()
+        if last_id is None:
+            return dict()
+        if endpoint in self._last and self._last[endpoint][0] == last_id:
+            return self._last[endpoint][1]
+        # recorded by another process (or before this one started)
+        return self._state_of(conn, endpoint, last_id)
+
+    def _state_of(self, conn: Connection, endpoint: str, snapshot_id: int) -> State:
+        """The whole state of the endpoint after the snapshot: its last keyframe, then the deltas after it"""
+        keyframe = conn.execute(select(snapshots.c.id, snapshots.c.keyframe).where(
+            snapshots.c.endpoint == endpoint, snapshots.c.id <= snapshot_id, snapshots.c.keyframe.isnot(None))
+            .order_by(snapshots.c.id.desc()).limit(1)).first()
+        state = _decompress(keyframe.keyframe) if keyframe else {table: dict() for table in RECORDED[endpoint]}
+        start = keyframe.id if keyframe else 0
+        for table, id_col in RECORDED[endpoint].items():
+            deltas = DELTA_TABLES[table]
+            rows = conn.execute(select(deltas.c[id_col], deltas.c.changes).where(
+                deltas.c.snapshot_id > start, deltas.c.snapshot_id <= snapshot_id).order_by(deltas.c.snapshot_id))
+            records = state.setdefault(table, dict())
+            for record_id, changes in rows:
+                apply_changes(records, record_id, changes)
+        return state
+
+    def _snapshot_at(self, conn: Connection, endpoint: str, at: Instant = None,
+                     gameweek: Optional[int] = None) -> Optional[int]:
+        query = select(snapshots.c.id).where(snapshots.c.endpoint == endpoint)
+        if gameweek is not None:
+            query = query.where(snapshots.c.gameweek == gameweek)
+        if at is not None:
+            query = query.where(snapshots.c.taken_at <= to_millis(at))
+        return conn.execute(query.order_by(snapshots.c.taken_at.desc(), snapshots.c.id.desc()).limit(1)).scalar()
+
+    def league_state(self, at: Instant = None, gameweek: Optional[int] = None) -> Dict[str, pd.DataFrame]:
+        """
+        The recorded tables ('elements', 'teams', 'fixtures') as they were at the moment `at` (default: now),
+        or at the end of a GW - the last snapshot taken during it. A table without a snapshot by then is empty.
+        """
+        tables = dict()
+        with self.engine.connect() as conn:
+            for endpoint in RECORDED:
+                snapshot_id = self._snapshot_at(conn, endpoint, at, gameweek)
+                state = self._state_of(conn, endpoint, snapshot_id) if snapshot_id is not None else dict()
+                for table in RECORDED[endpoint]:
+                    records = state.get(table, dict())
+                    tables[table] = pd.DataFrame([records[record_id] for record_id in sorted(records)])
+        return tables
+
+    def series(self, table: str, record_id: int, fields: Optional[List[str]] = None, start: Instant = None,
+               end: Instant = None) -> pd.DataFrame:
+        """
+        The fields of a record after each of its changes, by the time of the snapshot (UTC) - with `start`,
+        the first row is the record as it was then. A removed record has a row of nulls.
+        """
+        deltas = DELTA_TABLES[table]
+        id_col = RECORDED[TABLE_ENDPOINTS[table]][table]
+        query = select(deltas.c.taken_at, deltas.c.gameweek, deltas.c.changes).where(deltas.c[id_col] == record_id)
+        if end is not None:
+            query = query.where(deltas.c.taken_at <= to_millis(end))
+        start = to_millis(start) if start is not None else None
+        with self.engine.connect() as conn:
+            rows = conn.execute(query.order_by(deltas.c.taken_at, deltas.c.snapshot_id)).all()
+
+        records = dict()
+        series_rows = list()
+        for taken_at, gameweek, changes in rows:
+            apply_changes(records, record_id, changes)
+            row = {"taken_at": taken_at, "gameweek": gameweek, **records.get(record_id, dict())}
+            # only the state at the start is kept from the changes before it
+            if start is not None and taken_at < start:
+                series_rows[:] = [{**row, "taken_at": start}]
+            else:
+                series_rows.append(row)
+        series_df = pd.DataFrame(series_rows)
+        if series_df.empty:
+            return pd.DataFrame(columns=["gameweek"] + (fields or list()),
+                                index=pd.DatetimeIndex([], tz="UTC", name="taken_at"))
+        series_df["taken_at"] = pd.to_datetime(series_df["taken_at"], unit="ms", utc=True)
+        series_df = series_df.set_index("taken_at")
+        return series_df.reindex(columns=["gameweek"] + fields) if fields else series_df
+
+    def player_series(self, element_id: int, fields: Optional[List[str]] = None, start: Instant = None,
+                      end: Instant = None) -> pd.DataFrame:
+        """e.g. player_series(328, ['now_cost', 'selected_by_percent', 'chance_of_playing_next_round'])"""
+        return self.series("elements", element_id, fields, start, end)
+
+    def snapshots_df(self, gameweek: Optional[int] = None) -> pd.DataFrame:
+        """The recorded snapshots (of a GW) with their number of changed records"""
+        counts = [select(deltas.c.snapshot_id, func.count().label("changed")).group_by(deltas.c.snapshot_id)
+                  for deltas in DELTA_TABLES.values()]
+        query = select(snapshots.c.id, snapshots.c.endpoint, snapshots.c.taken_at, snapshots.c.gameweek,
+                       snapshots.c.keyframe.isnot(None).label("keyframe"))
+        if gameweek is not None:
+            query = query.where(snapshots.c.gameweek == gameweek)
+        with self.engine.connect() as conn:
+            snapshots_df = pd.DataFrame(conn.execute(query.order_by(snapshots.c.taken_at)).all(),
+                                        columns=["id", "endpoint", "taken_at", "gameweek", "keyframe"])
+            changed = pd.concat([pd.DataFrame(conn.execute(count).all(), columns=["id", "changed"])
+                                 for count in counts]).groupby("id")["changed"].sum()
+        snapshots_df["taken_at"] = pd.to_datetime(snapshots_df["taken_at"], unit="ms", utc=True)
+        snapshots_df["changed"] = snapshots_df["id"].map(changed).fillna(0).astype(int)
+        return snapshots_df
+
+
+def _set_pragmas(dbapi_connection, _) -> None:
+    # the history is only appended to - the write-ahead log keeps the readers (e.g. the scout daemon) unblocked
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def record_saved_snapshots(history: SnapshotHistory, cache_dir: str = CACHE_DIR) -> List[int]:
+    """Add the snapshots saved in `cache_dir` (e.g. downloaded before the history was kept), as of their download"""
+    client = FplApiClient(cache_dir=cache_dir, offline=True, history=False)
+    snapshot_ids = list()
+    for endpoint in RECORDED:
+        payload, meta = client.load_snapshot(endpoint)
+        if payload is not None:
+            snapshot_ids.append(history.record(endpoint, payload, meta.get("fetched_at")))
+    return snapshot_ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the history of the API snapshots")
+    query_group = parser.add_mutually_exclusive_group(required=True)
+    query_group.add_argument("--player", type=int, help="the time series of a player (element ID)")
+    query_group.add_argument("--at", help="the players as they were at this moment, e.g. '2024-10-05 12:00' (UTC)")
+    query_group.add_argument("--gameweek", type=int, help="the players as they were at the end of this GW")
+    query_group.add_argument("--record", action="store_true", help="add the snapshots saved in data/cache")
+    parser.add_argument("--fields", nargs="+", help="with --player: only these fields")
+    parser.add_argument("--db", default=HISTORY_DB, help="the history database")
+    args = parser.parse_args()
+    setup_logging()
+    snapshot_history = SnapshotHistory(args.db)
+
+    if args.record:
+        logger.info("Recorded snapshots: %s", record_saved_snapshots(snapshot_history))
+    elif args.player is not None:
+        print(snapshot_history.player_series(args.player, args.fields).to_string())
+    else:
+        print(snapshot_history.league_state(args.at, args.gameweek)["elements"].to_string(max_rows=50))
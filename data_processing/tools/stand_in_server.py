@@ -0,0 +1,111 @@
+"""
+Local stand-in for the FPL API, serving recorded payloads - for offline and load testing of the fetchers and the
+whole pipeline. A request path maps to a JSON file under the data directory:
+/api/bootstrap-static/ -> bootstrap-static.json, /api/element-summary/12/ -> element-summary/12.json,
+/api/event/5/live/ -> event/5/live.json (the snapshots of the API client are already in this layout).
+ETag/Last-Modified revalidation is supported; a latency and a share of failing (503) responses can be simulated.
+
+Usage: python -m data_processing.tools.stand_in_server [--dir data/cache] [--port 8765] [--delay 0.05]
+                                                       [--fail-rate 0.1]
+       FPL_API_URL=http://127.0.0.1:8765/api/ python fantasy_scout.py
+"""
+import argparse
+import logging
+import os
+import random
+import time
+from email.utils import formatdate
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from ..constants import CACHE_DIR
+from .logs import setup_logging
+
+logger = logging.getLogger(__name__)
+
+HOST = "127.0.0.1"
+PORT = 8765
+API_PREFIX = "/api/"
+
+
+class RecordedApiHandler(BaseHTTPRequestHandler):
+    # keep-alive, so pooled clients reuse their connections
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, data_dir: str, delay: float = 0.0, fail_rate: float = 0.0, **kwargs):
+        self.data_dir = data_dir
+        self.delay = delay
+        self.fail_rate = fail_rate
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_rate and random.random() < self.fail_rate:
+            self._send(503, b'{"detail": "Simulated failure"}')
+            return
+
+        path = self.resolve(self.path)
+        if path is None or not os.path.isfile(path):
+            self._send(404, b'{"detail": "Not found."}')
+            return
+        stat = os.stat(path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        headers = {"ETag": etag, "Last-Modified": formatdate(stat.st_mtime, usegmt=True)}
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", headers)
+            return
+        with open(path, "rb") as file:
+            self._send(200, file.read(), headers)
+
+    def resolve(self, request_path: str) -> Optional[str]:
+        """File of a request path, None for paths outside the data directory"""
+        path = request_path.split("?")[0]
+        if path.startswith(API_PREFIX):
+            path = path[len(API_PREFIX):]
+        parts = [part for part in path.split("/") if part]
+        if not parts or any(part in (".", "..") for part in parts):
+            return None
+        return os.path.join(self.data_dir, *parts) + ".json"
+
+    def _send(self, status: int, body: bytes, headers: Optional[dict] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def make_server(data_dir: str = CACHE_DIR, host: str = HOST, port: int = PORT, delay: float = 0.0,
+                fail_rate: float = 0.0) -> ThreadingHTTPServer:
+    """A server ready to serve_forever(); port 0 picks a free one (see server.server_address)"""
+    handler = partial(RecordedApiHandler, data_dir=os.path.abspath(data_dir), delay=delay, fail_rate=fail_rate)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded FPL API payloads locally")
+    parser.add_argument("--dir", default=CACHE_DIR, help="directory of the recorded payloads")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--delay", type=float, default=0.0, help="latency of every response, in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with 503")
+    args = parser.parse_args()
+    setup_logging()
+    server = make_server(args.dir, args.host, args.port, args.delay, args.fail_rate)
+    host, port = server.server_address[:2]
+    logger.info("Serving %s on http://%s:%d%s", os.path.abspath(args.dir), host, port, API_PREFIX)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,17 +1,18 @@
+import logging
 import pandas as pd
 from typing import Dict, List, Any
 
 from data_processing.constants import LIMITS
 
+logger = logging.getLogger(__name__)
+
 
 def check_total_limit_reached(my_team: List[Any]) -> bool:
     """Check if the total limit of players per team has been reached"""
     if len(my_team) < LIMITS['all']:
         return False
     else:
-        print(f"Total limit reached")
-        print(f"Team collected! :)")
-        print("\n\n")
+        logger.debug("Total limit reached - team collected! :)")
         return True
 
 
@@ -31,10 +32,12 @@ def get_actual_season_start_year(fixtures_df: pd.DataFrame) -> str:
     return start_new
 
 
-def get_past_seasons_years(new_season_start: str) -> Dict[str, str]:
-    """Return a dictionary containing the names (years) of the last two seasons"""
-    result = {
-        "prev": f"{str(int(new_season_start)-2)}-{str(int(new_season_start)-1)[2:4]}",
-        "last": f"{str(int(new_season_start)-1)}-{new_season_start[2:4]}"
-    }
-    return result
\ No newline at end of file
+def get_past_seasons(new_season_start: str, n_seasons: int) -> List[str]:
+    """Return the names (years) of the last `n_seasons` seasons, from the oldest one"""
+    start_years = range(int(new_season_start) - n_seasons, int(new_season_start))
+    return [f"{year}-{str(year + 1)[2:4]}" for year in start_years]
+
+
+def get_actual_season(fixtures_df: pd.DataFrame) -> str:
+    """The name of the current season (or of the next one, before it starts), e.g. '2024-25'"""
+    return get_past_seasons(str(int(get_actual_season_start_year(fixtures_df)) + 1), 1)[0]
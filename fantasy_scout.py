@@ -1,31 +1,41 @@
 import os
+import argparse
+import logging
 import pandas as pd
 
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 from pathlib import Path
 
-from data_processing.constants import PLAYER_PROFILE
-from data_processing.tools.fpl_api import how_many_gws_passed, load_fixtures
+from data_processing.constants import HIST_SEASONS, MIN_RELATABLE_GWS, PLAYER_PROFILE, ROLLING_SCORE
+from data_processing.tools.fpl_api import FplApiClient, how_many_gws_passed, load_fixtures, set_client
 from data_processing.actual.process_actual_data import ActualDataProcessor
-from data_processing.historical.process_historical_data import HistoricalDataProcessor
-from tools import find_matchups
+from data_processing.actual.expected_points import EXPECTED_POINTS, XP_GW_LIMIT, add_expected_points
+from data_processing.actual.incremental import IncrementalDataProcessor
+from data_processing.actual.simulation import SIMULATIONS, get_alternative_squads, save_simulation_report, \
+    simulate_squads
+from data_processing.tools.logs import setup_logging
+from data_processing.tools.profiling import PROFILER, profiled
+from data_processing.tools.fixtures import FIXTURES_GW_LIMIT, get_future_difficulty_matrix, get_players_difficulty
+from data_processing.tools.report import SIDECAR_FORMATS, save_report, to_long
 
-# How many GWs should pass to consider data from ongoing season relatable
-MIN_RELATABLE_GWS = 5
+logger = logging.getLogger("fantasy_scout")
 
 
 class FantasyScout:
     def __init__(self):
         self.my_team: Optional[pd.DataFrame] = None
         self.save_dir = os.path.join(os.getcwd(), "results")
+        # processor of the last selection, its intermediate results go to the report
+        self.engine = None
 
-    @staticmethod
-    def select_team():
+    def select_team(self, exact: bool = False, retrain: bool = False, n_seasons: int = HIST_SEASONS,
+                    gw_level: bool = False, incremental: bool = False, score_col: str = "form_ppg",
+                    xp_gw_limit: int = XP_GW_LIMIT, rolling: bool = False):
         if FantasyScout.check_if_in_season():
-            return FantasyScout.run_in_season_pipeline()
+            return self.run_in_season_pipeline(exact, incremental, score_col, xp_gw_limit)
         else:
-            return FantasyScout.run_preseason_pipeline()
+            return self.run_preseason_pipeline(exact, retrain, n_seasons, gw_level, rolling)
 
     @staticmethod
     def check_if_in_season():
@@ -39,33 +49,77 @@ class FantasyScout:
         past_gws_count = how_many_gws_passed(fixtures_df)
         return past_gws_count >= MIN_RELATABLE_GWS
 
-    @staticmethod
-    def run_preseason_pipeline():
-        preseason_engine = HistoricalDataProcessor()
-        preseason_engine.launch_pipeline()
-        return preseason_engine.selected_team
-
-    @staticmethod
-    def run_in_season_pipeline():
-        in_season_engine = ActualDataProcessor()
-        in_season_engine.launch_pipeline()
-        print(f"Collected {len(in_season_engine.selected_team)} players")
-        return in_season_engine.selected_team
-
-    def save_to_excel(self, team_df: pd.DataFrame):
+    def run_preseason_pipeline(self, exact: bool = False, retrain: bool = False, n_seasons: int = HIST_SEASONS,
+                               gw_level: bool = False, rolling: bool = False):
+        # the ML stack (XGBoost, scikit-learn, Optuna) takes most of the start-up time - load it only when needed
+        from data_processing.historical.process_historical_data import HistoricalDataProcessor
+
+        self.engine = preseason_engine = HistoricalDataProcessor(exact, retrain, n_seasons, gw_level, rolling)
+        return preseason_engine.launch_pipeline()
+
+    def run_in_season_pipeline(self, exact: bool = False, incremental: bool = False, score_col: str = "form_ppg",
+                               xp_gw_limit: int = XP_GW_LIMIT):
+        processor_cls = IncrementalDataProcessor if incremental else ActualDataProcessor
+        self.engine = in_season_engine = processor_cls(exact, score_col=score_col, xp_gw_limit=xp_gw_limit)
+        selected_team = in_season_engine.launch_pipeline()
+        logger.info("Collected %d players", len(selected_team))
+        # expected points of the squad in each of the next GWs, for the report
+        return add_expected_points(selected_team, in_season_engine.expected_points_df)
+
+    def get_report_stages(self, team_df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+        """The squad first, then what led to it: all the rated players, team indices, fixtures and expected points"""
+        if self.engine is None:
+            return {"my_team": team_df}
+        if isinstance(self.engine, ActualDataProcessor):
+            candidates_df = add_expected_points(self.engine.elements_df, self.engine.expected_points_df)
+            if not self.engine.rolling_features_df.empty:
+                from data_processing.historical.feature_store import join_features
+                candidates_df = join_features(candidates_df, self.engine.rolling_features_df)
+            score_col = self.engine.pipeline["score_col"]
+        else:
+            # the model predictions
+            candidates_df = self.engine.pipeline["candidates"]
+            score_col = "predicted_ppg"
+        difficulty_matrix_df = get_future_difficulty_matrix(load_fixtures(), FIXTURES_GW_LIMIT)
+        candidates_df = candidates_df.assign(
+            fixtures_difficulty=get_players_difficulty(candidates_df, difficulty_matrix_df),
+            selected=candidates_df['id'].isin(team_df['id']))
+        stages = {
+            "my_team": team_df,
+            "candidates": candidates_df.sort_values(score_col, ascending=False),
+            "fixture_difficulty": to_long(difficulty_matrix_df, "difficulty"),
+        }
+        if isinstance(self.engine, ActualDataProcessor):
+            stages["teams_idx"] = self.engine.get_team_off_def_idx().reset_index()
+            stages["expected_points"] = to_long(self.engine.expected_points_df, "expected_points")
+        return stages
+
+    @profiled(rows_of="my_team")
+    def save_report(self, team_df: pd.DataFrame, formats: List[str] = SIDECAR_FORMATS):
+        """The workbook (the squad in the first sheet) and the sidecars of every stage in results/<date>-FPL-Report/"""
         Path(self.save_dir).mkdir(parents=True, exist_ok=True)
         ds = datetime.today().strftime('%Y-%m-%d')
-        file_name = f"{ds}-FPL-MyTeam.xlsx"
-        team_df.to_excel(os.path.join(self.save_dir, file_name))
+        save_report(self.get_report_stages(team_df), os.path.join(self.save_dir, f"{ds}-FPL-MyTeam.xlsx"),
+                    os.path.join(self.save_dir, f"{ds}-FPL-Report"), formats)
+
+    def simulate(self, team_df: pd.DataFrame, n_sims: int = SIMULATIONS, seed: int = 0, exact: bool = False,
+                 score_col: str = "form_ppg", xp_gw_limit: int = XP_GW_LIMIT):
+        """Simulated points of the squad and of the squads of the other selection modes in the next GW"""
+        processor = ActualDataProcessor(exact, score_col=score_col, xp_gw_limit=xp_gw_limit)
+        squads = {"selected": team_df, **get_alternative_squads(processor, exact, score_col)}
+        squads_df, players_df = simulate_squads(processor, squads, n_sims, seed)
+        ds = datetime.today().strftime('%Y-%m-%d')
+        save_simulation_report(squads_df, players_df, os.path.join(self.save_dir, f"{ds}-FPL-Simulation.xlsx"))
 
     @staticmethod
-    def calc_fixtures(my_team: pd.DataFrame):
-        fixtures_df = load_fixtures()
-        future_fixtures_df = fixtures_df[fixtures_df["finished"] == False]
-        my_team['fixtures_difficulty'] = my_team.apply(lambda row: find_matchups(future_fixtures_df, row), axis=1)
-        return my_team
+    @profiled()
+    def calc_fixtures(players_df: pd.DataFrame, num_of_gws: int = FIXTURES_GW_LIMIT):
+        difficulty_matrix_df = get_future_difficulty_matrix(load_fixtures(), num_of_gws)
+        players_df['fixtures_difficulty'] = get_players_difficulty(players_df, difficulty_matrix_df)
+        return players_df
 
     @staticmethod
+    @profiled()
     def add_comments(my_team: pd.DataFrame):
         my_team["comments"] = None
 
@@ -86,13 +140,73 @@ class FantasyScout:
         return my_team
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Select a 15-players FPL lineup")
+    parser.add_argument("--offline", action="store_true",
+                        help="replay the API snapshots saved in data/cache instead of using the network "
+                             "(also set by FPL_OFFLINE=1)")
+    parser.add_argument("--exact", action="store_true",
+                        help="select the optimal squad within the budget instead of the greedy selection")
+    parser.add_argument("--retrain", action="store_true",
+                        help="train the preseason model even if a saved one was trained on the same historical data")
+    parser.add_argument("--seasons", type=int, default=HIST_SEASONS,
+                        help="how many past seasons the preseason model should use (at least 2)")
+    parser.add_argument("--gw-level", action="store_true",
+                        help="train the preseason model on gameweek rows (gws/merged_gw.csv) instead of season totals")
+    parser.add_argument("--rolling-features", action="store_true",
+                        help="preseason: add the rolling features of the feature store to the model (form in the "
+                             "last GWs, minutes share, xGI per 90, home/away and opponent-adjusted points)")
+    parser.add_argument("--score", default="form_ppg", choices=["form_ppg", EXPECTED_POINTS, ROLLING_SCORE],
+                        help="in season: rate the players by their form and points per game, by their "
+                             "expected points in the next GWs, or by their points in the last GWs weighted by "
+                             "the strength of the opponents (after backfill.py)")
+    parser.add_argument("--xp-gws", type=int, default=XP_GW_LIMIT,
+                        help="in season: how many next GWs the expected points cover")
+    parser.add_argument("--incremental", action="store_true",
+                        help="in season: update only what changed since the last run (state kept in data/cache)")
+    parser.add_argument("--simulate", type=int, nargs="?", const=SIMULATIONS,
+                        help="in season: simulate the next GW of the squad and the alternatives this many times "
+                             f"(default {SIMULATIONS}) and save the points distribution next to the report")
+    parser.add_argument("--seed", type=int, default=0, help="with --simulate: seed of the simulations")
+    parser.add_argument("--sidecars", nargs="*", default=list(SIDECAR_FORMATS), choices=SIDECAR_FORMATS,
+                        help="formats of the per-stage files saved next to the report (none: only the workbook)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG shows every approved/rejected candidate")
+    parser.add_argument("--log-json", action="store_true", help="write the logs as JSON lines")
+    parser.add_argument("--profile", action="store_true",
+                        help="measure time, memory and rows of every pipeline stage and print a summary")
+    parser.add_argument("--profile-dir",
+                        help="with --profile: save cProfile stats of every stage and the measurements here")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+    setup_logging(args.log_level, json_lines=args.log_json)
+    if args.profile:
+        PROFILER.enable(dump_dir=args.profile_dir)
+    # without --offline the client follows FPL_OFFLINE
+    set_client(FplApiClient(offline=args.offline or None))
+
     scout = FantasyScout()
-    scout.my_team = FantasyScout.select_team()
+    scout.my_team = scout.select_team(args.exact, args.retrain, args.seasons, args.gw_level,
+                                      args.incremental, args.score, args.xp_gws, args.rolling_features)
     scout.my_team = FantasyScout.calc_fixtures(scout.my_team)
     scout.my_team = FantasyScout.add_comments(scout.my_team)
-    scout.save_to_excel(scout.my_team)
-    print(f"ALL DONE! Please check your results here: {scout.save_dir}")
+    scout.save_report(scout.my_team, args.sidecars)
+    if args.simulate:
+        if FantasyScout.check_if_in_season():
+            scout.simulate(scout.my_team, args.simulate, args.seed, args.exact, args.score, args.xp_gws)
+        else:
+            logger.warning("The simulation needs the stats of the current season, skipped before GW %d",
+                           MIN_RELATABLE_GWS)
+    logger.info("ALL DONE! Please check your results here: %s", scout.save_dir)
+
+    if args.profile:
+        # the result asked for - printed whatever the log level
+        print(f"Pipeline stages:\n{PROFILER.report()}")
+        if args.profile_dir:
+            PROFILER.save(os.path.join(args.profile_dir, "stages.json"))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,299 @@
+"""
+Long-running scout: keeps the API snapshot, the derived frames (pipeline stages) and the preseason model in memory
+and answers requests over local HTTP or a Unix socket, so a warm request takes milliseconds instead of a whole run.
+
+Endpoints (GET, JSON responses):
+    /health                                         phase, gameweeks passed and age of the data
+    /select-team?exact=0&score=form_ppg&xp_gws=5     the squad with fixtures difficulty and comments
+    /score-players?ids=1,2,3&score=form_ppg          form, expected points per GW (predicted ppg before the season)
+    /fixture-difficulty?gws=3&ids=1,2,3              team x GW difficulty matrix, or the players' totals
+POST /refresh reads the API again; otherwise the data is refreshed after SNAPSHOT_TTL seconds.
+
+Usage: python scout_daemon.py [--offline] [--port 8766 | --socket /tmp/scout.sock]
+       curl 'http://127.0.0.1:8766/select-team?exact=1'
+       curl --unix-socket /tmp/scout.sock 'http://scout/score-players?ids=328,355'
+"""
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from data_processing.constants import HIST_SEASONS, MIN_RELATABLE_GWS, ROLLING_SCORE, SNAPSHOT_TTL
+from data_processing.actual.expected_points import EXPECTED_POINTS, XP_GW_LIMIT, add_expected_points
+from data_processing.actual.process_actual_data import ActualDataProcessor
+from data_processing.tools.fixtures import FIXTURES_GW_LIMIT, get_future_difficulty_matrix, get_players_difficulty
+from data_processing.tools.fpl_api import FplApiClient, how_many_gws_passed, set_client
+from data_processing.tools.logs import setup_logging
+from fantasy_scout import FantasyScout
+
+logger = logging.getLogger("scout_daemon")
+
+HOST = "127.0.0.1"
+PORT = 8766
+SCORES = ["form_ppg", EXPECTED_POINTS, ROLLING_SCORE]
+# Columns of the players in the responses (the ones a frame has)
+PLAYER_COLUMNS = ['id', 'first_name', 'second_name', 'web_name', 'position', 'team_name', 'now_cost', 'form_ppg',
+                  'predicted_ppg', EXPECTED_POINTS, ROLLING_SCORE, 'fixtures_difficulty', 'comments']
+
+
+class ScoutService:
+    """
+    The in-memory state of the scout. The processors are created once and their pipelines keep every stage,
+    so a request recomputes only the stages depending on the options that changed since the previous one.
+    Requests are served one at a time (the pipelines are not thread-safe).
+    """
+
+    def __init__(self, client: FplApiClient, ttl: int = SNAPSHOT_TTL, n_seasons: int = HIST_SEASONS):
+        self.client = client
+        self.ttl = ttl
+        self.n_seasons = n_seasons
+        self.lock = threading.Lock()
+        self.in_season_engine = ActualDataProcessor()
+        # created on the first preseason request - it loads the ML stack and the model
+        self.preseason_engine = None
+        self.loaded_at = time.time()
+
+    def refresh(self) -> None:
+        """Read the API again, only the stages depending on the changed tables will be recomputed"""
+        self.client.refresh()
+        self.in_season_engine.refresh()
+        if self.preseason_engine is not None:
+            self.preseason_engine.pipeline.invalidate("api_elements", "api_element_types", "api_teams")
+        self.loaded_at = time.time()
+
+    def reload(self) -> Dict[str, Any]:
+        self.refresh()
+        return self.health()
+
+    def call(self, method: Callable[..., Any], **kwargs) -> Any:
+        with self.lock:
+            if time.time() - self.loaded_at > self.ttl:
+                self.refresh()
+            return method(**kwargs)
+
+    def gws_passed(self) -> int:
+        return int(how_many_gws_passed(self.client.fixtures()))
+
+    def in_season(self) -> bool:
+        return self.gws_passed() >= MIN_RELATABLE_GWS
+
+    def get_preseason_engine(self):
+        if self.preseason_engine is None:
+            from data_processing.historical.process_historical_data import HistoricalDataProcessor
+
+            self.preseason_engine = HistoricalDataProcessor(n_seasons=self.n_seasons)
+        return self.preseason_engine
+
+    def health(self) -> Dict[str, Any]:
+        return {"phase": "in-season" if self.in_season() else "preseason", "gws_passed": self.gws_passed(),
+                "data_age_s": round(time.time() - self.loaded_at, 1),
+                "model_loaded": self.preseason_engine is not None}
+
+    def select_team(self, exact: bool = False, score_col: str = "form_ppg",
+                    xp_gw_limit: int = XP_GW_LIMIT) -> Dict[str, Any]:
+        if self.in_season():
+            engine = self.in_season_engine
+            engine.pipeline.set_input("exact", exact)
+            engine.pipeline.set_input("score_col", score_col)
+            engine.pipeline.set_input("xp_gw_limit", xp_gw_limit)
+            team_df = add_expected_points(engine.launch_pipeline(), engine.expected_points_df)
+            phase = "in-season"
+        else:
+            engine = self.get_preseason_engine()
+            engine.pipeline.set_input("exact", exact)
+            team_df = engine.launch_pipeline().copy()
+            phase = "preseason"
+        if len(team_df):
+            team_df = FantasyScout.calc_fixtures(team_df)
+            team_df = FantasyScout.add_comments(team_df)
+        return {"phase": phase, "players": to_records(team_df)}
+
+    def score_players(self, ids: Optional[List[int]] = None, score_col: str = "form_ppg") -> Dict[str, Any]:
+        if self.in_season():
+            engine = self.in_season_engine
+            players_df = add_expected_points(engine.elements_df, engine.expected_points_df)
+            if score_col == ROLLING_SCORE:
+                from data_processing.historical.feature_store import join_features
+                players_df = join_features(players_df, engine.rolling_features_df)
+            xp_columns = [column for column in players_df.columns if column.startswith("xP_GW")]
+            phase = "in-season"
+        else:
+            players_df = self.get_preseason_engine().pipeline["candidates"]
+            xp_columns = list()
+            score_col = "predicted_ppg"
+            phase = "preseason"
+        if ids:
+            players_df = players_df[players_df['id'].isin(ids)]
+        players_df = players_df.sort_values(score_col, ascending=False)
+        return {"phase": phase, "score": score_col, "players": to_records(players_df, xp_columns)}
+
+    def fixture_difficulty(self, num_of_gws: int = FIXTURES_GW_LIMIT,
+                           ids: Optional[List[int]] = None) -> Dict[str, Any]:
+        matrix_df = get_future_difficulty_matrix(self.client.fixtures(), num_of_gws)
+        if ids:
+            players_df = self.in_season_engine.elements_df
+            players_df = players_df[players_df['id'].isin(ids)]
+            players_df = players_df.assign(fixtures_difficulty=get_players_difficulty(players_df, matrix_df))
+            return {"gws": matrix_df.columns.tolist(), "players": to_records(players_df)}
+        teams = self.client.get_table("teams").set_index('id')['name']
+        matrix_df = matrix_df.rename(index=teams).rename(columns=lambda event: f"GW{event}")
+        return {"gws": matrix_df.columns.tolist(), "teams": json.loads(matrix_df.to_json(orient="index"))}
+
+
+def to_records(players_df: pd.DataFrame, extra_columns: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """JSON-ready rows of the players: numpy types, categories and NaN (-> null) are handled by pandas"""
+    columns = [column for column in PLAYER_COLUMNS if column in players_df.columns] + (extra_columns or list())
+    return json.loads(players_df[columns].to_json(orient="records", double_precision=4))
+
+
+def parse_ids(values: List[str]) -> Optional[List[int]]:
+    ids = [int(part) for value in values for part in value.split(",") if part]
+    return ids or None
+
+
+def parse_bool(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes")
+
+
+class ScoutHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a client can send many requests over one connection
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, service: ScoutService, **kwargs):
+        self.service = service
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+
+        def arg(name: str, default: str) -> str:
+            return query.get(name, [default])[-1]
+
+        routes: Dict[str, Tuple[Callable[..., Any], Callable[[], Dict[str, Any]]]] = {
+            "/health": (self.service.health, lambda: dict()),
+            "/select-team": (self.service.select_team, lambda: {
+                "exact": parse_bool(arg("exact", "0")), "score_col": check_score(arg("score", "form_ppg")),
+                "xp_gw_limit": int(arg("xp_gws", str(XP_GW_LIMIT)))}),
+            "/score-players": (self.service.score_players, lambda: {
+                "ids": parse_ids(query.get("ids", [])), "score_col": check_score(arg("score", "form_ppg"))}),
+            "/fixture-difficulty": (self.service.fixture_difficulty, lambda: {
+                "num_of_gws": int(arg("gws", str(FIXTURES_GW_LIMIT))), "ids": parse_ids(query.get("ids", []))}),
+        }
+        if url.path.rstrip("/") not in routes:
+            self._send(404, {"detail": f"Unknown endpoint: {url.path}", "endpoints": sorted(routes)})
+            return
+        method, get_kwargs = routes[url.path.rstrip("/")]
+        self._answer(method, get_kwargs)
+
+    def do_POST(self) -> None:
+        # the body (if any) is not used
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path.rstrip("/") != "/refresh":
+            self._send(404, {"detail": f"Unknown endpoint: {self.path}"})
+            return
+        self._answer(self.service.reload, lambda: dict())
+
+    def _answer(self, method: Callable[..., Any], get_kwargs: Callable[[], Dict[str, Any]]) -> None:
+        start = time.perf_counter()
+        try:
+            result = self.service.call(method, **get_kwargs())
+        except ValueError as err:
+            self._send(400, {"detail": str(err)})
+            return
+        except Exception as err:
+            logger.exception("Failed to answer %s", self.path)
+            self._send(500, {"detail": f"{type(err).__name__}: {err}"})
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logger.info("%s answered in %.1f ms", self.path, elapsed_ms)
+        self._send(200, result, {"X-Elapsed-Ms": f"{elapsed_ms:.1f}"})
+
+    def _send(self, status: int, content: Any, headers: Optional[dict] = None) -> None:
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def check_score(score_col: str) -> str:
+    if score_col not in SCORES:
+        raise ValueError(f"Unknown score '{score_col}', choose one from {SCORES}")
+    return score_col
+
+
+def make_server(service: ScoutService, host: str = HOST, port: int = PORT,
+                socket_path: Optional[str] = None) -> socketserver.BaseServer:
+    """A server ready to serve_forever(): on the Unix socket if given, otherwise on host:port (0 picks a free one)"""
+    handler = partial(ScoutHandler, service=service)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the scout warm and answer requests over HTTP")
+    parser.add_argument("--offline", action="store_true",
+                        help="replay the API snapshots saved in data/cache instead of using the network "
+                             "(also set by FPL_OFFLINE=1)")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--seasons", type=int, default=HIST_SEASONS,
+                        help="how many past seasons the preseason model should use (at least 2)")
+    parser.add_argument("--ttl", type=int, default=SNAPSHOT_TTL,
+                        help="read the API again after this many seconds (POST /refresh does it at once)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    client = FplApiClient(offline=args.offline or None)
+    # the stages of the engines read the API through the default client
+    set_client(client)
+    service = ScoutService(client, args.ttl, args.seasons)
+    # warm up: load the API data and compute the squad, so the first request is already fast
+    logger.info("Warming up (%s)", service.health()["phase"])
+    service.call(service.select_team)
+
+    server = make_server(service, args.host, args.port, args.socket)
+    logger.info("Serving on %s", args.socket or "http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()